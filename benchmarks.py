@@ -0,0 +1,226 @@
+#!/usr/bin/env python3.5
+
+'''Times the pipeline stages on synthetic data sets at several scales
+and records their throughput and peak memory, so a change can be
+measured against a baseline. Scale N is N seqfiles of --seqs reads
+each, made by synthetic_data.py. Each stage runs in a freshly spawned
+worker process in the data set dir, in pipeline order:
+
+seqfile_stats    get_all_stats on the fasta files
+blastn_proc      blastn_batch_proc on the csv and fasta files
+get_xml_seqyear  run years of the xml files into a db and seq_year_csv
+make_db          create_tables and ingest into a new db
+get_non_hitters  file_batch on the csv and fasta files
+
+The results are written to a json file, and compared stage by stage
+with an earlier results file given as --baseline.'''
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from glob import glob
+from time import perf_counter
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+
+from blast_runner import count_lines
+from instrument import maxrss_to_mb
+from synthetic_data import generate
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+def run_seqfile_stats(jobs):
+    '''Runs the seqfile_stats stage.'''
+    from seqfile_stats import get_all_stats
+    get_all_stats('_seqs.fa', jobs)
+
+
+def run_blastn_proc(jobs):
+    '''Runs the blastn_proc stage, including building the fasta
+    indexes.'''
+    from blastn_proc import blastn_batch_proc
+    for filename in glob('*.fai'):
+        os.unlink(filename)
+    blastn_batch_proc(jobs)
+
+
+def run_get_xml_seqyear(jobs):
+    '''Runs the get_xml_seqyear stage.'''
+    from get_xml_seqyear import get_seq_years
+    from get_xml_seqyear import write_seq_year_csv
+    from get_xml_seqyear import write_seq_year_db
+    results = get_seq_years(sorted(glob('xml*')), jobs)
+    write_seq_year_db('seq_year.sqlite', results)
+    write_seq_year_csv('seq_year_csv', results)
+
+
+def run_make_db(jobs):
+    '''Runs the make_db stage into a new db.'''
+    from make_db import create_tables
+    from make_db import ingest
+    for filename in glob('chimp_trace_25k.sqlite*'):
+        os.unlink(filename)
+    create_tables('chimp_trace_25k.sqlite')
+    ingest('chimp_trace_25k.sqlite', '.', 'nh', 'seq_year_csv')
+
+
+def run_get_non_hitters(jobs):
+    '''Runs the get_non_hitters stage.'''
+    from get_non_hitters import file_batch
+    file_batch(jobs)
+
+
+# Start method of the stage worker processes
+spawn_context = multiprocessing.get_context('spawn')
+
+# Stage name, function and the files the stage reads
+stages = [('seqfile_stats', run_seqfile_stats, ['*_seqs.fa']),
+          ('blastn_proc', run_blastn_proc, ['*_on_homo.csv',
+                                            '*_seqs.fa']),
+          ('get_xml_seqyear', run_get_xml_seqyear, ['xml*']),
+          ('make_db', run_make_db, ['*_on_homo.csv', '*_seqs.fa',
+                                    'nh/*.csv']),
+          ('get_non_hitters', run_get_non_hitters, ['*_on_homo.csv',
+                                                    '*_seqs.fa'])]
+
+
+def own_peak_rss_mb():
+    '''Returns the peak resident memory of this process in MB. On Linux
+    the ru_maxrss of a spawned process starts from the peak of the
+    process that spawned it, as exec keeps it, so the VmHWM of
+    /proc/self/status is taken instead where there is one.'''
+    try:
+        with open('/proc/self/status', 'r') as fi:
+            for line in fi:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    return maxrss_to_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def peak_rss_mb():
+    '''Returns the peak resident memory in MB of this process and of
+    its finished child processes, whichever is larger.'''
+    return max(own_peak_rss_mb(), maxrss_to_mb(
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+
+
+def _run_stage(args):
+    '''Runs a stage in a data set dir with its output discarded and
+    returns (seconds, peak rss MB). Runs in a fresh spawned worker
+    process, so its peak rss does not include the memory of this
+    process, as that of a forked one would.'''
+    data_dir, stage_num, jobs = args
+    os.chdir(data_dir)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = perf_counter()
+        stages[stage_num][1](jobs)
+        elapsed = perf_counter() - start
+    return elapsed, peak_rss_mb()
+
+
+def input_size(data_dir, patterns):
+    '''Returns the number and total bytes of the files a stage reads.'''
+    files = set()
+    for pattern in patterns:
+        files.update(glob(os.path.join(data_dir, pattern)))
+    return len(files), sum(os.path.getsize(file) for file in files)
+
+
+def run_scale(work_dir, scale, num_seqs, jobs=1, seed=1):
+    '''Generates the data set of a scale, or reuses it if present, and
+    times each stage on it. Returns a dict of stage name to results.'''
+    data_dir = os.path.abspath(os.path.join(work_dir,
+                                            'scale_{}'.format(scale)))
+    done_flag = os.path.join(data_dir, '.generated')
+    if not os.path.exists(done_flag):
+        if os.path.exists(data_dir):
+            shutil.rmtree(data_dir)
+        start = perf_counter()
+        generate(data_dir, scale, num_seqs, seed)
+        open(done_flag, 'w').close()
+        print("scale {}: generated {} seqfiles in {:.1f} s".format(
+              scale, scale, perf_counter() - start))
+
+    num_records = {'seqs': scale * num_seqs,
+                   'hits': sum(count_lines(file) for file in
+                               glob(os.path.join(data_dir,
+                                                 '*_on_homo.csv')))}
+    results = {}
+    for stage_num, (name, _, patterns) in enumerate(stages):
+        with ProcessPoolExecutor(max_workers=1,
+                                 mp_context=spawn_context) as pool:
+            elapsed, peak_rss = pool.submit(
+                _run_stage, (data_dir, stage_num, jobs)).result()
+        num_files, num_bytes = input_size(data_dir, patterns)
+        records = (num_records['seqs'] if name != 'blastn_proc'
+                   else num_records['hits'])
+        results[name] = {'seconds': elapsed,
+                         'files': num_files,
+                         'records': records,
+                         'records_per_sec': records / elapsed,
+                         'mb_per_sec': num_bytes / 1e6 / elapsed,
+                         'peak_rss_mb': peak_rss}
+        print("scale {:>3}  {:<16} {:8.2f} s {:>12,.0f} rec/s "
+              "{:8.1f} MB/s {:8.1f} MB rss".format(
+                  scale, name, elapsed, records / elapsed,
+                  num_bytes / 1e6 / elapsed, peak_rss), flush=True)
+    return results
+
+
+def compare(results, baseline):
+    '''Prints the time of each stage relative to a baseline results
+    dict, e.g. 0.50x for twice as fast.'''
+    for scale, stage_results in sorted(results.items(),
+                                       key=lambda item: int(item[0])):
+        for name, result in stage_results.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                continue
+            print("scale {:>3}  {:<16} {:5.2f}x time {:5.2f}x rss".format(
+                  scale, name, result['seconds'] / base['seconds'],
+                  result['peak_rss_mb'] / base['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+
+    os.environ['MPLBACKEND'] = 'Agg'
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--work-dir', default='bench_data',
+                        help='dir for the data sets (default bench_data)')
+    parser.add_argument('--scales', type=int, nargs='+',
+                        default=[1, 10, 100],
+                        help='scales to run (default 1 10 100)')
+    parser.add_argument('--seqs', type=int, default=2500,
+                        help='reads per seqfile (default 2500)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='worker processes for the stages (default 1)')
+    parser.add_argument('--out', default='bench_results.json',
+                        help='results json file (default '
+                             'bench_results.json)')
+    parser.add_argument('--baseline',
+                        help='earlier results json file to compare with')
+    args = parser.parse_args()
+
+    results = {}
+    for scale in args.scales:
+        results[str(scale)] = run_scale(args.work_dir, scale, args.seqs,
+                                        args.jobs)
+
+    with open(args.out, 'w') as fo:
+        json.dump({'seqs_per_file': args.seqs, 'jobs': args.jobs,
+                   'results': results}, fo, indent=2)
+        fo.write("\n")
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fi:
+            compare(results, json.load(fi)['results'])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3.5
+
+'''Opt-in columnar cache of blastn outfmt 10 csv files. The first time
+a csv file is seen it is parsed into a typed Arrow IPC file, with the
+seqfile id attached as a column, under a .blast_cache dir next to it.
+Later reads memory-map the cache file instead of parsing csv text. A
+cache file is rebuilt when the size and mtime of its csv file change
+and the contents hash differs, and only has its size and mtime
+updated when the hash is the same. Needs the pyarrow package. Can be run
+as a script to build the cache for csv files and time cached against
+csv reads.'''
+
+from time import perf_counter
+import os
+import sys
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    from pyarrow import ipc as pa_ipc
+except ImportError:
+    pa = None
+
+from gzip_io import open_input
+from make_db import file_hash
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+CACHE_DIR = '.blast_cache'
+
+# Column names of the blastn outfmt 10 csv files
+blast_columns = ['qseqid', 'qstart', 'qend', 'mismatch', 'gapopen',
+                 'pident', 'nident', 'length', 'qlen']
+
+
+def _check_pyarrow():
+    '''Raises ImportError if pyarrow is not installed.'''
+    if pa is None:
+        raise ImportError('The blastn csv cache needs the pyarrow package')
+
+
+def blast_schema():
+    '''Returns the Arrow column types of a blastn csv file.'''
+    _check_pyarrow()
+    types = {'qseqid': pa.string(), 'pident': pa.float64()}
+    return dict((name, types.get(name, pa.int32()))
+                for name in blast_columns)
+
+
+def get_cache_filename(csvfile):
+    '''Returns the cache file name of a csv file, e.g.
+    .blast_cache/pan_001_25k_on_homo.arrow next to the csv file.'''
+    directory, filename = os.path.split(os.path.abspath(csvfile))
+    return os.path.join(directory, CACHE_DIR,
+                        filename.rsplit('.', 1)[0] + '.arrow')
+
+
+def _source_info(csvfile):
+    '''Returns the size and mtime of a csv file as cache metadata.'''
+    stat = os.stat(csvfile)
+    return {b'size': str(stat.st_size).encode(),
+            b'mtime': repr(stat.st_mtime).encode()}
+
+
+def build_cache(csvfile):
+    '''Parses a blastn csv file, gzip or BGZF compressed or not, into a
+    typed Arrow table with a seqfile column, writes it to the cache
+    file and returns it.'''
+    _check_pyarrow()
+    with open_input(csvfile, 'rb') as fi:
+        table = pa_csv.read_csv(
+            fi,
+            read_options=pa_csv.ReadOptions(column_names=blast_columns),
+            convert_options=pa_csv.ConvertOptions(
+                column_types=blast_schema()))
+    seqfile = os.path.basename(csvfile)[4:7]
+    table = table.append_column(
+        'seqfile', pa.array([seqfile] * table.num_rows,
+                            pa.string()).dictionary_encode())
+
+    metadata = _source_info(csvfile)
+    metadata[b'hash'] = file_hash(csvfile).encode()
+    return _write_cache(get_cache_filename(csvfile),
+                        table.replace_schema_metadata(metadata))
+
+
+def _write_cache(cache_file, table):
+    '''Writes a table to a cache file, through a .part file so a
+    reader never sees a partial one, and returns the table.'''
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    part_file = cache_file + '.part'
+    with pa.OSFile(part_file, 'wb') as sink:
+        with pa_ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(part_file, cache_file)
+    return table
+
+
+def _read_cache(cache_file):
+    '''Memory-maps a cache file and returns its Arrow table.'''
+    return pa_ipc.open_file(pa.memory_map(cache_file, 'r')).read_all()
+
+
+def read_blast_table(csvfile):
+    '''Returns a blastn csv file as an Arrow table, from the cache if
+    it is fresh, otherwise parsing the csv and building the cache. The
+    cache is fresh if the size and mtime of the csv file match, or
+    failing that its contents hash, in which case the new size and
+    mtime are recorded so the file is not hashed again.'''
+    _check_pyarrow()
+    cache_file = get_cache_filename(csvfile)
+    if os.path.exists(cache_file):
+        table = _read_cache(cache_file)
+        metadata = table.schema.metadata or {}
+        info = _source_info(csvfile)
+        if all(metadata.get(key) == value for key, value in info.items()):
+            return table
+        if metadata.get(b'hash') == file_hash(csvfile).encode():
+            # Touched or copied but not changed
+            metadata = dict(metadata)
+            metadata.update(info)
+            return _write_cache(cache_file,
+                                table.replace_schema_metadata(metadata))
+    return build_cache(csvfile)
+
+
+def read_blast_dataframe(csvfile, columns=None):
+    '''Returns a blastn csv file as a pandas dataframe through the
+    cache, optionally with only some of the columns.'''
+    table = read_blast_table(csvfile)
+    if columns is not None:
+        table = table.select(columns)
+    return table.to_pandas()
+
+
+def benchmark(csvfile, repeat=3):
+    '''Prints the best time to read a blastn csv file with pandas and
+    through the cache.'''
+    import pandas as pd
+
+    read_blast_table(csvfile)
+    for name, func in (('csv', lambda: pd.read_csv(csvfile, header=None,
+                                                   names=blast_columns)),
+                       ('cache', lambda: read_blast_dataframe(csvfile))):
+        best_time = None
+        for _ in range(repeat):
+            start = perf_counter()
+            func()
+            elapsed = perf_counter() - start
+            if best_time is None or elapsed < best_time:
+                best_time = elapsed
+        print("{:<6}: {:8.4f} s  {}".format(name, best_time, csvfile))
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: blast_cache.py <blastn csv file> ...")
+        sys.exit()
+
+    for filename in sys.argv[1:]:
+        benchmark(filename)
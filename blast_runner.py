@@ -0,0 +1,319 @@
+#!/usr/bin/env python3.5
+
+'''Runs the blastn jobs for a set of trace read fasta files. Builds
+the blastn command line for each query file from one config, runs the
+jobs in a bounded pool that shares the machine's cores between the
+concurrent jobs and blastn's -num_threads, retries failed jobs and
+skips jobs whose output is already complete. Replaces the shell
+scripts written by blast_scipt_generator.pl.
+
+Each query file can be split into shards balanced by total bases that
+run as separate jobs, so one slow file does not hold up the batch.
+The shard outputs are merged back into the usual output file in query
+order.
+
+The config is a json file of keys to override in DEFAULT_CONFIG, e.g.
+{"db": "/data/homo_genome_GRCh37.71.fa", "cores": 16, "num_threads": 4}
+Set "blastn" to a stand-in executable such as blastn_stub.py to check
+the scheduling without a genome db.'''
+
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from time import perf_counter
+from time import strftime
+import argparse
+import json
+import os
+import shutil
+import subprocess
+
+from fasta_index import get_seqlens
+from fasta_io import BUFSIZE
+from fasta_io import read_fasta_text
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+DEFAULT_CONFIG = {
+    'blastn': 'blastn',
+    'db': '/home/jtomkins/homo_genome/homo_genome_GRCh37.71.fa',
+    'query_dir': '.',
+    'query_pattern': 'pan_???_25000_seqs.fa',
+    'out_dir': '.',
+    'out_suffix': '_25k_on_homo.csv',
+    # Cores to share between jobs, all of them if null
+    'cores': None,
+    # blastn -num_threads for each job
+    'num_threads': 10,
+    # Extra attempts for a failed job
+    'retries': 2,
+    # Shards to split each query file into
+    'shards': 1,
+    # blastn options in command line order
+    'options': [
+        ['-task', 'blastn'],
+        ['-evalue', '0.1'],
+        ['-word_size', '11'],
+        ['-outfmt',
+         '10 qseqid qstart qend mismatch gapopen pident nident length qlen'],
+        ['-max_target_seqs', '1'],
+        ['-max_hsps', '1'],
+        ['-dust', 'no'],
+        ['-soft_masking', 'false'],
+        ['-perc_identity', '50'],
+        ['-gapopen', '3'],
+        ['-gapextend', '3']]}
+
+
+def load_config(config_filename=None):
+    '''Returns DEFAULT_CONFIG updated with the keys of a json config
+    file.'''
+    config = dict(DEFAULT_CONFIG)
+    if config_filename is not None:
+        with open(config_filename, 'r') as fi:
+            config.update(json.load(fi))
+    return config
+
+
+def get_pool_size(config):
+    '''Returns (number of concurrent jobs, threads per job) that fit
+    the config's cores.'''
+    cores = config['cores'] or os.cpu_count() or 1
+    num_threads = max(1, min(config['num_threads'], cores))
+    return max(1, cores // num_threads), num_threads
+
+
+def get_out_filename(query_file, config):
+    '''Returns the blastn output file name for a query file, e.g.
+    pan_001_25k_on_homo.csv for pan_001_25000_seqs.fa.'''
+    return os.path.join(config['out_dir'],
+                        os.path.basename(query_file)[:7] +
+                        config['out_suffix'])
+
+
+def get_jobs(config):
+    '''Returns a sorted list of (query file, output file) jobs for the
+    query files matching the config.'''
+    query_files = sorted(glob(os.path.join(config['query_dir'],
+                                           config['query_pattern'])))
+    if not query_files:
+        print("No files matching", config['query_pattern'], "found! in",
+              config['query_dir'])
+    return [(query_file, get_out_filename(query_file, config))
+            for query_file in query_files]
+
+
+def build_command(query_file, out_file, config, num_threads):
+    '''Returns the blastn command line for a job as a list of args.'''
+    command = [config['blastn'],
+               '-query', query_file,
+               '-db', config['db'],
+               '-out', out_file]
+    for option in config['options']:
+        command.extend(option)
+    command.extend(['-num_threads', str(num_threads)])
+    return command
+
+
+def count_lines(filename):
+    '''Returns the number of lines in a file.'''
+    with open(filename, 'rb') as fi:
+        return sum(block.count(b'\n')
+                   for block in iter(lambda: fi.read(1024 * 1024), b''))
+
+
+def log(*items):
+    '''Prints a time stamped log line.'''
+    print(strftime('%Y-%m-%d %H:%M:%S'), *items, flush=True)
+
+
+def run_job(job, config, num_threads):
+    '''Runs one blastn job, retrying it on failure. blastn writes to a
+    .part file that is renamed to the output file once it completes,
+    so an existing output file is always complete and is skipped.
+    Returns a dict of query, out, status (done, skipped or failed),
+    attempts, wall time and rows produced.'''
+    query_file, out_file = job
+    result = {'query': query_file, 'out': out_file, 'status': 'skipped',
+              'attempts': 0, 'wall': 0.0, 'rows': 0}
+    if os.path.exists(out_file):
+        result['rows'] = count_lines(out_file)
+        log("skip", query_file, "->", out_file, "exists")
+        return result
+
+    part_file = out_file + '.part'
+    command = build_command(query_file, part_file, config, num_threads)
+    start = perf_counter()
+    for attempt in range(1, config['retries'] + 2):
+        result['attempts'] = attempt
+        try:
+            returncode = subprocess.call(command)
+        except OSError as err:
+            returncode = err
+        if returncode == 0 and os.path.exists(part_file):
+            os.replace(part_file, out_file)
+            result['status'] = 'done'
+            result['rows'] = count_lines(out_file)
+            break
+        log("fail", query_file, "attempt", attempt, "exit", returncode)
+    else:
+        result['status'] = 'failed'
+        if os.path.exists(part_file):
+            os.unlink(part_file)
+    result['wall'] = perf_counter() - start
+
+    log(result['status'], query_file, "->", out_file,
+        "{:.1f} s".format(result['wall']),
+        "{:,} rows".format(result['rows']))
+    return result
+
+
+def run_jobs(jobs, config):
+    '''Runs a list of (query file, output file) blastn jobs in a pool
+    sized by get_pool_size and returns their run_job results in job
+    order.'''
+    pool_size, num_threads = get_pool_size(config)
+    log("running", len(jobs), "jobs,", pool_size, "at a time with",
+        num_threads, "threads each")
+    with ThreadPoolExecutor(max_workers=pool_size) as pool:
+        return list(pool.map(lambda job: run_job(job, config, num_threads),
+                             jobs))
+
+
+def get_shard_cuts(seqlens, num_shards):
+    '''Returns the record numbers at which to start each of up to
+    num_shards contiguous shards so that each has about the same total
+    bases. Cut j is the first record whose preceding records hold at
+    least j / num_shards of the bases. Cuts that fall on the same
+    record or past the last one are dropped, so no shard is empty.'''
+    total = sum(seqlens)
+    cuts = [0]
+    seen = 0
+    j = 1
+    for i, seqlen in enumerate(seqlens):
+        while j < num_shards and seen * num_shards >= total * j:
+            if i > cuts[-1]:
+                cuts.append(i)
+            j += 1
+        seen += seqlen
+    return cuts
+
+
+def get_shard_filenames(filename, num_shards):
+    '''Returns the shard file names for a query or output file, e.g.
+    pan_001_25000_seqs.fa.shard01of04.'''
+    return [filename + '.shard{:02d}of{:02d}'.format(i, num_shards)
+            for i in range(1, num_shards + 1)]
+
+
+def split_query(query_file, num_shards):
+    '''Splits a query fasta file into up to num_shards contiguous
+    shard files balanced by total bases, copying whole records, and
+    returns the shard file names. Every shard has at least one record,
+    and a file with no records gives no shards.'''
+    seqlens = get_seqlens(query_file)
+    if not seqlens:
+        return []
+    cuts = get_shard_cuts(seqlens, min(num_shards, len(seqlens)))
+    shard_files = get_shard_filenames(query_file, len(cuts))
+    ends = cuts[1:] + [len(seqlens)]
+
+    records = read_fasta_text(query_file)
+    for shard_file, start, end in zip(shard_files, cuts, ends):
+        with open(shard_file, 'w', buffering=BUFSIZE) as fo:
+            for _ in range(end - start):
+                fo.write('>' + next(records) + '\n')
+    return shard_files
+
+
+def merge_shards(shard_outs, out_file):
+    '''Concatenates shard output files in shard order into the output
+    file, which keeps the query order, and removes the shard outputs.'''
+    part_file = out_file + '.part'
+    with open(part_file, 'wb') as fo:
+        for shard_out in shard_outs:
+            with open(shard_out, 'rb') as fi:
+                shutil.copyfileobj(fi, fo, BUFSIZE)
+    os.replace(part_file, out_file)
+    for shard_out in shard_outs:
+        os.unlink(shard_out)
+
+
+def run_sharded_jobs(jobs, config):
+    '''Runs a list of (query file, output file) blastn jobs with each
+    query file split into config['shards'] shards. All shards of all
+    queries share one pool. The shard outputs of a query are merged
+    into its output file once every shard is done, and the merged
+    result for each job is returned in job order. Shard outputs of
+    failed queries are kept so a rerun only repeats the failed shards.'''
+    shard_jobs = []
+    shard_groups = []
+    for query_file, out_file in jobs:
+        if os.path.exists(out_file):
+            shard_groups.append((query_file, out_file, [], []))
+            continue
+        shard_queries = split_query(query_file, config['shards'])
+        shard_outs = get_shard_filenames(out_file, len(shard_queries))
+        shard_jobs.extend(zip(shard_queries, shard_outs))
+        shard_groups.append((query_file, out_file, shard_queries,
+                             shard_outs))
+
+    shard_results = dict((result['out'], result)
+                         for result in run_jobs(shard_jobs, config))
+
+    results = []
+    for query_file, out_file, shard_queries, shard_outs in shard_groups:
+        if not shard_outs:
+            results.append(run_job((query_file, out_file), config, 0))
+            continue
+        group = [shard_results[shard_out] for shard_out in shard_outs]
+        result = {'query': query_file, 'out': out_file,
+                  'attempts': max(item['attempts'] for item in group),
+                  'wall': max(item['wall'] for item in group),
+                  'rows': sum(item['rows'] for item in group)}
+        if all(item['status'] != 'failed' for item in group):
+            merge_shards(shard_outs, out_file)
+            result['status'] = 'done'
+        else:
+            result['status'] = 'failed'
+        for shard_query in shard_queries:
+            os.unlink(shard_query)
+        log(result['status'], query_file, "->", out_file,
+            len(shard_outs), "shards",
+            "{:.1f} s".format(result['wall']),
+            "{:,} rows".format(result['rows']))
+        results.append(result)
+    return results
+
+
+def print_summary(results):
+    '''Prints the number of jobs done, skipped and failed.'''
+    for status in ('done', 'skipped', 'failed'):
+        jobs = [result for result in results if result['status'] == status]
+        print("{:<8}: {} jobs, {:,} rows".format(
+              status, len(jobs), sum(result['rows'] for result in jobs)))
+    for result in results:
+        if result['status'] == 'failed':
+            print("Failed  :", result['query'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Runs blastn on each trace read fasta file.')
+    parser.add_argument('--config', help='json config file')
+    parser.add_argument('--shards', type=int,
+                        help='split each query file into this many shards')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.shards is not None:
+        config['shards'] = args.shards
+
+    if config['shards'] > 1:
+        print_summary(run_sharded_jobs(get_jobs(config), config))
+    else:
+        print_summary(run_jobs(get_jobs(config), config))
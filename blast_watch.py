@@ -0,0 +1,303 @@
+#!/usr/bin/env python3.5
+
+'''Watches a dir for the blastn csv files of the trace read fasta
+files as the blastn jobs complete, and processes each one as soon as
+it lands instead of after the whole batch. A pan_NNN_*_on_homo.csv
+file is taken as complete once its mtime is --settle seconds old
+(blast_runner writes to a .part file that is renamed when blastn
+finishes, so its files are complete as soon as they appear). It is
+paired with the fasta file of the same seqfile number, pan_NNN_*.fa,
+and then
+
+1. summarized as by blastn_proc, the row appended to the csv summary
+   file
+2. its non-hitters written to pan_NNN_*_non_hitters.fa as by
+   get_non_hitters
+3. loaded into the chimp_trace_25k db as by make_db, replacing the
+   rows of its seqfile
+
+Steps 1 and 2 run in a pool of worker processes and the db loads one
+at a time in a thread, as sqlite has a single writer. Seqfiles that
+are already in the summary file are skipped, so a stopped watch can
+be restarted. The summary file is --summary, or else the dated
+blastn_proc summary file of the day the watch was first started, whose
+name is kept in .blast_watch_summary so that a watch restarted on a
+later day resumes it. The watch stops once --expect seqfiles are done,
+or after --idle seconds with nothing to do, and then sorts the summary
+file and prints the final stats.'''
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from time import time
+import argparse
+import asyncio
+import os
+import re
+
+from blast_runner import log
+from blastn_proc import csv_outfilename
+from blastn_proc import get_blast_summary
+from blastn_proc import get_finalstats
+from blastn_proc import set_csv_header
+from blastn_proc import write_blast_summary
+from gzip_io import strip_gz
+from get_non_hitters import get_non_hitters
+from instrument import add_report_arguments
+from instrument import finish_from_args
+from instrument import start_from_args
+from instrument import worker
+from instrument import worker_result
+from make_db import blast_csv_pattern
+from make_db import create_tables
+from make_db import ingest_seqfile
+from seq_pack import SEQ_FORMATS
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+# File recording the summary file of the watch, for a restart
+WATCH_STATE_FILE = '.blast_watch_summary'
+
+fasta_pattern = re.compile(r'^pan_(\d{3})_.*\.fa(\.gz)?$')
+
+
+def scan_csv_files(blast_dir):
+    '''Returns a dict of seqfile id to (path, size, mtime) of the blastn
+    csv files in a dir.'''
+    files = {}
+    for entry in os.scandir(blast_dir):
+        match = blast_csv_pattern.match(entry.name)
+        if match and entry.is_file():
+            stat = entry.stat()
+            files[match.group(1)] = (entry.path, stat.st_size,
+                                     stat.st_mtime)
+    return files
+
+
+def find_fasta(blast_dir, seqfile):
+    '''Returns the path of the fasta file of a seqfile in a dir, or None
+    if there is none yet.'''
+    for name in sorted(os.listdir(blast_dir)):
+        match = fasta_pattern.match(name)
+        if (match and match.group(1) == seqfile and
+                not strip_gz(name).endswith('_non_hitters.fa')):
+            return os.path.join(blast_dir, name)
+    return None
+
+
+def get_summary_filename(summary_filename=None):
+    '''Returns the summary file of the watch: summary_filename if
+    given, otherwise the one recorded in WATCH_STATE_FILE by an earlier
+    watch, or failing that today's blastn_proc summary file. The file
+    name is recorded for the next restart.'''
+    if summary_filename is None:
+        try:
+            with open(WATCH_STATE_FILE, 'r') as fi:
+                summary_filename = fi.read().strip() or None
+        except IOError:
+            pass
+    if summary_filename is None:
+        summary_filename = csv_outfilename
+    try:
+        with open(WATCH_STATE_FILE, 'w') as fo:
+            fo.write(summary_filename + "\n")
+    except IOError:
+        print('Cannot open', WATCH_STATE_FILE)
+    return summary_filename
+
+
+def summarized_seqfiles(summary_filename):
+    '''Returns the set of seqfile ids already in the csv summary file,
+    whose file ids are pan + the seqfile id.'''
+    try:
+        with open(summary_filename, 'r') as fi:
+            next(fi, None)
+            return set(line.split(',', 1)[0][3:] for line in fi
+                       if line.strip())
+    except IOError:
+        return set()
+
+
+def sort_summary_file(summary_filename):
+    '''Sorts the rows of the csv summary file by file id, as they are
+    appended in the order the seqfiles complete.'''
+    try:
+        with open(summary_filename, 'r') as fi:
+            header = next(fi, '')
+            rows = sorted(line for line in fi if line.strip())
+        with open(summary_filename, 'w') as fo:
+            fo.write(header)
+            fo.writelines(rows)
+    except IOError:
+        print('Cannot open', summary_filename)
+
+
+def process_seqfile(csv_filename, fasta_filename, use_cache=False):
+    '''Summarizes a blastn csv file and writes the non-hitters of its
+    fasta file. Runs in a worker process. Returns (get_blast_summary
+    list, number of non-hitters).'''
+    return (get_blast_summary(csv_filename, fasta_filename, use_cache),
+            get_non_hitters(csv_filename, fasta_filename))
+
+
+async def handle_seqfile(loop, pool, db_pool, seqfile, csv_filename,
+                         fasta_filename, db_name, use_cache, seq_format,
+                         summary_filename):
+    '''Summarizes a seqfile and writes its non-hitters in the process
+    pool while its files load into the db in the db thread. Returns
+    True if all of the steps succeed.'''
+    start = perf_counter()
+    steps = [loop.run_in_executor(pool, worker(process_seqfile),
+                                  csv_filename, fasta_filename, use_cache)]
+    if db_name is not None:
+        steps.append(loop.run_in_executor(db_pool, ingest_seqfile, db_name,
+                                          csv_filename, fasta_filename,
+                                          seq_format))
+    results = await asyncio.gather(*steps, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        log("fail", seqfile, *errors)
+        return False
+
+    outline, num_non_hitters = worker_result(results[0])
+    write_blast_summary(outline, summary_filename)
+    log("done", seqfile, "{:,} hits {:,} non-hitters {:.1f} s".format(
+        outline[7], num_non_hitters, perf_counter() - start))
+    return True
+
+
+async def watch(blast_dir='.', db_name=None, jobs=1, interval=10.0,
+                settle=5.0, expect=None, idle=None, use_cache=False,
+                seq_format='text', summary_filename=csv_outfilename):
+    '''Polls blast_dir every interval seconds and processes each
+    complete blastn csv file with handle_seqfile, up to jobs at a time,
+    adding its row to summary_filename.
+    A seqfile that fails is tried again once its csv file changes.
+    Returns when expect seqfiles are done, or after idle seconds with
+    none running or started; runs until interrupted if both are None.
+    Returns the number of seqfiles processed.'''
+    loop = asyncio.get_running_loop()
+    done = summarized_seqfiles(summary_filename)
+    if not os.path.exists(summary_filename):
+        set_csv_header(summary_filename)
+    if db_name is not None:
+        create_tables(db_name)
+    log("watching", os.path.abspath(blast_dir), "with", len(done),
+        "seqfiles done")
+
+    tasks = {}
+    tried = {}
+    waiting = set()
+    num_processed = 0
+    last_active = perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool, \
+            ThreadPoolExecutor(max_workers=1) as db_pool:
+        while True:
+            for seqfile, task in list(tasks.items()):
+                if task.done():
+                    del tasks[seqfile]
+                    if task.result():
+                        done.add(seqfile)
+                        num_processed += 1
+                    last_active = perf_counter()
+
+            now = time()
+            for seqfile, stat in sorted(scan_csv_files(blast_dir).items()):
+                csv_filename, _, mtime = stat
+                if (seqfile in done or seqfile in tasks or
+                        tried.get(seqfile) == stat or
+                        now - mtime < settle):
+                    continue
+                fasta_filename = find_fasta(blast_dir, seqfile)
+                if fasta_filename is None:
+                    if seqfile not in waiting:
+                        log("wait", csv_filename, "has no fasta file")
+                        waiting.add(seqfile)
+                    continue
+                log("start", csv_filename, "and", fasta_filename)
+                tried[seqfile] = stat
+                tasks[seqfile] = loop.create_task(handle_seqfile(
+                    loop, pool, db_pool, seqfile, csv_filename,
+                    fasta_filename, db_name, use_cache, seq_format,
+                    summary_filename))
+                last_active = perf_counter()
+
+            if expect is not None and len(done) >= expect:
+                break
+            if (idle is not None and not tasks and
+                    perf_counter() - last_active >= idle):
+                log("idle for", idle, "s, stopping")
+                break
+            if tasks:
+                await asyncio.wait(list(tasks.values()), timeout=interval)
+            else:
+                await asyncio.sleep(interval)
+    return num_processed
+
+
+def add_arguments(parser):
+    '''Adds the command line options of the watch to an argparse
+    parser.'''
+    parser.add_argument('blast_dir', nargs='?', default='.',
+                        help='dir the blastn csv files are written to, '
+                             'with the fasta files (default .)')
+    parser.add_argument('--db', default='chimp_trace_25k.sqlite',
+                        help='sqlite db file (default chimp_trace_25k.sqlite)')
+    parser.add_argument('--no-db', action='store_true',
+                        help='only summarize and write the non-hitters')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help='seconds between polls of the dir (default 10)')
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help='seconds since a csv file was last written '
+                             'before it is taken as complete (default 5)')
+    parser.add_argument('--expect', type=int,
+                        help='stop once this many seqfiles are done, '
+                             'e.g. 101')
+    parser.add_argument('--idle', type=float,
+                        help='stop after this many seconds with nothing '
+                             'to do')
+    parser.add_argument('--cache', action='store_true',
+                        help='read the blast data through the columnar '
+                             'cache (needs pyarrow)')
+    parser.add_argument('--seq-format', choices=SEQ_FORMATS, default='text',
+                        help='storage format of chimp_seq_data.dna_seq '
+                             '(default text)')
+    parser.add_argument('--summary',
+                        help='csv summary file to add to (default the one '
+                             'of an earlier watch, or else ' +
+                             csv_outfilename + ')')
+    add_report_arguments(parser)
+
+
+def main(args):
+    '''Runs the watch with add_arguments args, then sorts the summary
+    file and prints the final stats.'''
+    start_from_args('blast_watch', args)
+    summary_filename = get_summary_filename(args.summary)
+    log("summary file", summary_filename)
+    try:
+        num_processed = asyncio.run(watch(
+            args.blast_dir, None if args.no_db else args.db, args.jobs,
+            args.interval, args.settle, args.expect, args.idle, args.cache,
+            args.seq_format, summary_filename))
+        log(num_processed, "seqfiles processed")
+    except KeyboardInterrupt:
+        log("interrupted")
+
+    sort_summary_file(summary_filename)
+    if summarized_seqfiles(summary_filename):
+        get_finalstats(summary_filename)
+    finish_from_args(args)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -5,11 +5,28 @@ as a batch script to analyze eaach of an entire set of blastn
 output files in csv format. Also generates a summary of the
 entire set of blastn output files.'''
 
+from concurrent.futures import ProcessPoolExecutor
 from os import listdir
+from time import perf_counter
 from time import strftime
+import argparse
+import os
 
+import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
+
+from blast_cache import read_blast_dataframe
+from fasta_index import get_seqlens
+from gzip_io import open_input
+from gzip_io import strip_gz
+from instrument import add_report_arguments
+from instrument import finish_from_args
+from instrument import stage
+from instrument import start_from_args
+from instrument import worker
+from instrument import worker_result
+from make_db import list_blast_files
+from make_db import pair_by_seqfile
 
 
 __author__ = "Jeffrey P Tomkins, PhD"
@@ -22,202 +39,416 @@ date = strftime('%m_%d_%Y')
 # Set final csv summary outfile name
 csv_outfilename = 'blastn_summary_' + date + '.dat'
 
+# Column names of the blastn outfmt 10 csv files
+blast_columns = ['qseqid', 'qstart', 'qend', 'mismatch', 'gapopen',
+                 'pident', 'nident', 'length', 'qlen']
+
+# Column dtypes used for the summary - pident is kept as float64 so
+# the summary values are the same as when it was parsed by default
+blast_dtypes = {'qstart': np.int32, 'qend': np.int32,
+                'mismatch': np.int32, 'gapopen': np.int32,
+                'pident': np.float64, 'nident': np.int32,
+                'length': np.int32, 'qlen': np.int32}
+
+# Columns of the csv summary file averaged for each group of data sets
+summary_columns = ['aln_ident', 'qseq_ident', 'aln_len', 'qseqret',
+                   'qseqall', 'num_qseqs', 'num_hits', 'hitfreq',
+                   'overall_ident']
+
+# Columns averaged for each pident bin of the hits
+hit_bin_columns = ['pident', 'gapopen', 'mismatch', 'length']
+
+# The pident ranges of chimp_trace_25k.sql and the overall ident split
+# of the data sets in get_finalstats
+aln_range_edges = [60.0, 70.0, 80.0, 90.0, 100.0]
+overall_ident_edges = [-np.inf, 90.0, np.inf]
+
 
 def get_dataframe(csvfile):
     '''Puts a csv file into a pandas dataframe'''
     try:
-        with open(csvfile, 'r') as fi:
+        with open_input(csvfile) as fi:
             # Open *csv as a pandas data frame
             return pd.read_csv(fi)
     except IOError:
         print('Cannot open', csvfile)
 
 
-def set_csv_header():
+def get_blast_dataframe(csvfile, use_cache=False, skiprows=1):
+    '''Puts a blastn csv file into a pandas dataframe with named and
+    typed columns, leaving out the qseqid column. The first line is
+    skipped by default as it was always taken as the header by
+    get_dataframe. With use_cache the data is read from the
+    blast_cache columnar cache of the csv file instead of parsing the
+    csv.'''
+    if use_cache:
+        df = read_blast_dataframe(csvfile, list(blast_dtypes))
+        return df.iloc[skiprows:].reset_index(drop=True)
+    try:
+        with open_input(csvfile) as fi:
+            return pd.read_csv(fi, header=None, skiprows=skiprows,
+                               names=blast_columns,
+                               usecols=list(blast_dtypes),
+                               dtype=blast_dtypes)
+    except IOError:
+        print('Cannot open', csvfile)
+
+
+def get_ident(df):
+    '''Returns the overall qseq aln identity of each hit as a series:
+    nident over the longer of the aln length and the qseq length.'''
+    return df['nident'] / np.maximum(df['length'], df['qlen'])
+
+
+def _apply_ident(df):
+    '''The original row by row ident calc, kept for benchmarking only.'''
+    return df.apply(lambda row: (row['nident']/row['length']
+                    if row['length'] > row['qlen']
+                    else row['nident']/row['qlen']), axis=1)
+
+
+def get_bin_ids(values, edges):
+    '''Returns the bin number of each value for ascending bin edges:
+    bin i holds edges[i] <= value < edges[i + 1], and the last bin also
+    holds edges[-1]. Values outside the edges get -1.'''
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    num_bins = len(edges) - 1
+    ids = np.searchsorted(edges, values, side='right') - 1
+    ids[values == edges[-1]] = num_bins - 1
+    ids[(ids < 0) | (ids >= num_bins)] = -1
+    return ids
+
+
+def bin_sums(df, column, edges, value_columns):
+    '''Bins the rows of a dataframe by a column in one pass and returns
+    a dataframe with the bin_lo and bin_hi edges, count and the sum of
+    each of value_columns for each bin. Sums of separate dataframes
+    binned with the same edges can be added up.'''
+    ids = get_bin_ids(df[column], edges)
+    inside = ids >= 0
+    ids = ids[inside]
+    num_bins = len(edges) - 1
+    sums = pd.DataFrame({'bin_lo': edges[:-1], 'bin_hi': edges[1:],
+                         'count': np.bincount(ids, minlength=num_bins)})
+    for name in value_columns:
+        sums['sum_' + name] = np.bincount(
+            ids, weights=np.asarray(df[name], dtype=np.float64)[inside],
+            minlength=num_bins)
+    return sums
+
+
+def bin_means(sums):
+    '''Returns the bin_lo and bin_hi edges, count and the average of
+    each summed column of a bin_sums dataframe. Empty bins average to
+    NaN.'''
+    stats = sums[['bin_lo', 'bin_hi', 'count']].copy()
+    count = sums['count'].replace(0, np.nan)
+    for name in sums.columns:
+        if name.startswith('sum_'):
+            stats['avg_' + name[4:]] = sums[name] / count
+    return stats
+
+
+def get_hit_bins(csv_filenames, edges=aln_range_edges, use_cache=False):
+    '''Returns the count and average pident, gapopen, mismatch and
+    length of the hits of blastn csv files in each pident bin, for
+    any bin edges, e.g. numpy.arange(60, 100.5, 0.5) for 0.5% bins.
+    Each file is read once and all of its rows are binned.'''
+    edges = np.asarray(edges, dtype=np.float64)
+    total = bin_sums(pd.DataFrame(columns=hit_bin_columns), 'pident',
+                     edges, hit_bin_columns)
+    for csv_filename in csv_filenames:
+        sums = bin_sums(get_blast_dataframe(csv_filename, use_cache, 0),
+                        'pident', edges, hit_bin_columns)
+        for name in sums.columns[2:]:
+            total[name] += sums[name]
+    return bin_means(total)
+
+
+def get_file_bins(df, edges=overall_ident_edges):
+    '''Returns the number of data sets and the averages of the csv
+    summary columns of a summary dataframe in each overall ident bin.'''
+    return bin_means(bin_sums(df, 'overall_ident',
+                              np.asarray(edges, dtype=np.float64),
+                              summary_columns))
+
+
+def print_bins(stats):
+    '''Prints a get_hit_bins or get_file_bins dataframe as a table.'''
+    print(stats.to_string(index=False, float_format='{:.2f}'.format))
+
+
+def set_csv_header(summary_filename=csv_outfilename):
     '''Set the csv data file header line for blastn results.'''
     try:
-        with open(csv_outfilename, 'w') as fo:
+        with open(summary_filename, 'w') as fo:
             header = ['file_id', 'aln_ident', 'qseq_ident', 'aln_len',
                       'qseqret', 'qseqall', 'num_qseqs', 'num_hits',
                       'hitfreq', 'overall_ident']
             fo.write(",".join(header) + "\n")
     except IOError:
-            print('Cannot open', csv_outfilename)
+            print('Cannot open', summary_filename)
 
 
-def get_blast_data(csv_filename, fasta_filename):
+def get_blast_summary(csv_filename, fasta_filename, use_cache=False):
     '''Takes a blastn output file in csv format along with it's
-    corresponding fasta file and generates a set of basic stats
-    for the blast results and the sequences used to generate them.'''
-
-    def _get_fastadata(fastafile):
-        '''Makes a list of tuples, each with a list containing fasta
-        header data and a string containing DNA seq ([info], 'seq')'''
-        try:
-            with open(fastafile, 'r') as fi:
-                return [(part[0],
-                        part[2].replace('\n', ''))
-                        for part in
-                        [entry.partition('\n')
-                        for entry in fi.read().split('>')[1:]]]
-        except IOError:
-            print('Cannot open', fasta_file)
+    corresponding fasta file and returns a list of basic stats for
+    the blast results and the sequences used to generate them, in
+    the column order of the csv summary file. With use_cache the blast
+    data is read through the blast_cache columnar cache.'''
 
     # Get and setup the pandas dataframe
-    df = get_dataframe(csv_filename)
-    seqdata = _get_fastadata(fasta_filename)
-    file_id = "pan" + csv_filename[4:7]
-
-    num_hits = df.count()[0]
-    num_qseqs = len(seqdata)
+    with stage('csv parsing') as st:
+        df = get_blast_dataframe(csv_filename, use_cache)
+        st.add(len(df), os.path.getsize(csv_filename))
+    file_id = "pan" + os.path.basename(csv_filename)[4:7]
 
-    # Assign column headings - replaces default [0,1,2...etc]
-    df.columns = \
-        'qseqid qstart qend mismatch gapopen pident nident length qlen'.split()
+    # Get the number and total length of the seqs from the fasta index
+    with stage('fasta index') as st:
+        seqlens = get_seqlens(fasta_filename)
+        st.add(len(seqlens), os.path.getsize(fasta_filename))
+    num_qseqs = len(seqlens)
+    total_seq_len = sum(seqlens)
 
-    # Speeds calc and removes this col as an obj dtype
-    del df['qseqid']
+    num_hits = len(df)
 
-    # Get overall qseq aln identity and put in new column called 'ident'
-    df['ident'] = df.apply(lambda row: (row['nident']/row['length']
-                           if row['length'] > row['qlen']
-                           else row['nident']/row['qlen']), axis=1)
+    # Get overall qseq aln identity for every hit as a whole column
+    with stage('ident calc') as st:
+        ident = get_ident(df)
+        st.add(num_hits)
 
     # Create variables for outputs
-    total_aligned = (df['ident'].mean() * df['qlen'].mean()) * num_hits
-    total_seq_len = sum(len(s[1]) for s in (seqdata))
-    ave_seqlen = ((total_seq_len/num_qseqs) * 100, 2)
+    ave_qseq_ident = ident.mean() * 100
+    ave_qseqret = df['qlen'].mean()
+    total_aligned = (ident.mean() * ave_qseqret) * num_hits
     overall_ident = (total_aligned/total_seq_len) * 100
     ave_aln_ident = df['pident'].mean()
-    ave_qseq_ident = df['ident'].mean() * 100
     ave_aln_len = df['length'].mean()
-    ave_qseqret = df['qlen'].mean()
     ave_qseqall = total_seq_len/num_qseqs
     ave_hitfreq = num_hits/num_qseqs * 100
 
-    # Make a human readable report
-    print("Ave aln ident   : ", round(ave_aln_ident, 2))
-    print("Ave qseq ident  : ", round(ave_qseq_ident, 2))
-    print("Ave aln len     : ", round(ave_aln_len, 2))
-    print("Ave qseqret len : ", round(ave_qseqret, 2))
-    print("Ave qseqall len : ", round(ave_qseqall, 2))
-    print("Num queryseqs   : ", num_qseqs)
-    print("Num queryhits   : ", num_hits)
-    print("Ave hit freq    : ", round(ave_hitfreq, 2))
-    print("Overall ident   : ", round(overall_ident, 2))
-
-    # Append csv data rows to header line
+    return [file_id, ave_aln_ident, ave_qseq_ident,
+            ave_aln_len, ave_qseqret, ave_qseqall,
+            num_qseqs, num_hits, ave_hitfreq,
+            overall_ident]
+
+
+def print_blast_summary(outline):
+    '''Prints a human readable report of a get_blast_summary list.'''
+    print("Ave aln ident   : ", round(outline[1], 2))
+    print("Ave qseq ident  : ", round(outline[2], 2))
+    print("Ave aln len     : ", round(outline[3], 2))
+    print("Ave qseqret len : ", round(outline[4], 2))
+    print("Ave qseqall len : ", round(outline[5], 2))
+    print("Num queryseqs   : ", outline[6])
+    print("Num queryhits   : ", outline[7])
+    print("Ave hit freq    : ", round(outline[8], 2))
+    print("Overall ident   : ", round(outline[9], 2))
+
+
+def write_blast_summary(outline, summary_filename=csv_outfilename):
+    '''Appends a get_blast_summary list as a row of the csv summary
+    file.'''
     try:
-        with open(csv_outfilename, 'a') as fo:
-            outline = [file_id, ave_aln_ident, ave_qseq_ident,
-                       ave_aln_len, ave_qseqret, ave_qseqall,
-                       num_qseqs, num_hits, ave_hitfreq,
-                       overall_ident]
+        with open(summary_filename, 'a') as fo:
             fo.write(",".join(str(item) for item in outline) + "\n")
     except IOError:
-        print('Cannot open', csv_outfilename)
+        print('Cannot open', summary_filename)
+
+
+def get_blast_data(csv_filename, fasta_filename, use_cache=False):
+    '''Takes a blastn output file in csv format along with it's
+    corresponding fasta file, prints a report of the basic stats and
+    appends them to the csv summary file.'''
+    outline = get_blast_summary(csv_filename, fasta_filename, use_cache)
+    print_blast_summary(outline)
+    write_blast_summary(outline)
+
+
+def _get_blast_summary(args):
+    '''Unpacks (csv, fasta, use_cache) args for the process pool.'''
+    return get_blast_summary(*args)
+
+
+def print_summary_stats(title, means):
+    '''Prints the averages of the csv summary columns for a group of
+    data sets, keyed by column name or avg_ column name.'''
+    def mean(name):
+        return means[name] if name in means else means['avg_' + name]
+
+    print("<{}>".format(title))
+    print("Ave aln ident   : ", round(mean('aln_ident'), 2))
+    print("Ave qseq ident  : ", round(mean('qseq_ident'), 2))
+    print("Ave aln len     : ", round(mean('aln_len'), 2))
+    print("Ave qseqret len : ", round(mean('qseqret'), 2))
+    print("Ave qseqall len : ", round(mean('qseqall'), 2))
+    print("Num queryseqs   : ", round(mean('num_qseqs'), 0))
+    print("Num queryhits   : ", round(mean('num_hits'), 0))
+    print("Ave hit freq    : ", round(mean('hitfreq'), 2))
+    print("Overall ident   : ", round(mean('overall_ident'), 2))
+    print()
 
 
 def get_finalstats(csv_filename):
     '''Gets the final summary stats of csv file produced from the
     get_blast_data function. Header line of csv file: file_id,
     aln_ident,qseq_ident,aln_len,qseqret,qseqall,num_qseqs,num_hits,
-    hitfreq,overall_ident'''
+    hitfreq,overall_ident. The overall ident graph is written to
+    overall_ident_<date>.png.'''
 
     df = get_dataframe(csv_filename)
+    with stage('final stats') as st:
+        _get_finalstats(df)
+        st.add(len(df))
+
+    # Line graph the overall ident of the fasta files
+    with stage('plotting'):
+        plot_overall_ident(df)
 
-    # Create two new dataframes based on overall ident
-    hi = df[df['overall_ident'] > 89.99]
-    lo = df[df['overall_ident'] < 90.00]
+
+def _get_finalstats(df):
+    '''Prints the summary stats of a summary dataframe, split at 90%
+    overall ident, and writes the high and low data sets to files.'''
+
+    # Bin the datasets below and at or over 90% overall ident in one
+    # pass
+    bin_ids = get_bin_ids(df['overall_ident'], overall_ident_edges)
+    lo, hi = get_file_bins(df).to_dict('records')
 
     # Get the statistics for all of the datasets
-    print("<Summary stats for all datasets>")
-    print("Ave aln ident   : ", round(df['aln_ident'].mean(), 2))
-    print("Ave qseq ident  : ", round(df['qseq_ident'].mean(), 2))
-    print("Ave aln len     : ", round(df['aln_len'].mean(), 2))
-    print("Ave qseqret len : ", round(df['qseqret'].mean(), 2))
-    print("Ave qseqall len : ", round(df['qseqall'].mean(), 2))
-    print("Num queryseqs   : ", round(df['num_qseqs'].mean(), 0))
-    print("Num queryhits   : ", round(df['num_hits'].mean(), 0))
-    print("Ave hit freq    : ", round(df['hitfreq'].mean(), 2))
-    print("Overall ident   : ", round(df['overall_ident'].mean(), 2))
-    print()
+    print_summary_stats("Summary stats for all datasets",
+                        df[summary_columns].mean())
 
     # Get the number of data sets grouped by overall ident
     print("<Num entries by overall ident>")
-    print("Over  89.99% :", hi.count()[0])
-    print("Below 90.00% :", lo.count()[0])
+    print("90.00% and over :", hi['count'])
+    print("Below 90.00%    :", lo['count'])
     print()
     # Print the data to file
+    groups = dict(iter(df.groupby(bin_ids)))
     hi_file = "high_overallident_" + date + ".dat"
-    hi.to_csv(hi_file)
+    groups.get(1, df.iloc[:0]).to_csv(hi_file)
     lo_file = "low_overallident_" + date + ".dat"
-    lo.to_csv(lo_file)
-
-    # Get stats for high overall identity data
-    print("<Summary stats for high identity data>")
-    print("Ave aln ident   : ", round(hi['aln_ident'].mean(), 2))
-    print("Ave qseq ident  : ", round(hi['qseq_ident'].mean(), 2))
-    print("Ave aln len     : ", round(hi['aln_len'].mean(), 2))
-    print("Ave qseqret len : ", round(hi['qseqret'].mean(), 2))
-    print("Ave qseqall len : ", round(hi['qseqall'].mean(), 2))
-    print("Num queryseqs   : ", round(hi['num_qseqs'].mean(), 0))
-    print("Num queryhits   : ", round(hi['num_hits'].mean(), 0))
-    print("Ave hit freq    : ", round(hi['hitfreq'].mean(), 2))
-    print("Overall ident   : ", round(hi['overall_ident'].mean(), 2))
-    print()
-
-    # Get stats for low overall identity data
-    print("<Summary stats for low identity data>")
-    print("Ave aln ident   : ", round(lo['aln_ident'].mean(), 2))
-    print("Ave qseq ident  : ", round(lo['qseq_ident'].mean(), 2))
-    print("Ave aln len     : ", round(lo['aln_len'].mean(), 2))
-    print("Ave qseqret len : ", round(lo['qseqret'].mean(), 2))
-    print("Ave qseqall len : ", round(lo['qseqall'].mean(), 2))
-    print("Num queryseqs   : ", round(lo['num_qseqs'].mean(), 0))
-    print("Num queryhits   : ", round(lo['num_hits'].mean(), 0))
-    print("Ave hit freq    : ", round(lo['hitfreq'].mean(), 2))
-    print("Overall ident   : ", round(lo['overall_ident'].mean(), 2))
-    print()
-
-    # Line graph the overall ident of the fasta files
-    fasta_files = df['file_id']
-    fasta_nums = [int(item[3:7]) for item in fasta_files]
-    ident_dat = df['overall_ident']
-    plt.plot(fasta_nums, ident_dat, color='green',
-             marker='o', linestyle='solid')
-    plt.title("Overall Identity of Each Fasta Trace Read Data Set")
-    plt.ylabel("Overall Data Set Percent Identity")
-    plt.xlabel("Fasta Trace Read Data Sets (001 to 101)")
-    plt.xlim(0, 102)
-    plt.show()
-
-
-def blastn_batch_proc():
+    groups.get(0, df.iloc[:0]).to_csv(lo_file)
+
+    # Get stats for high and low overall identity data
+    print_summary_stats("Summary stats for high identity data", hi)
+    print_summary_stats("Summary stats for low identity data", lo)
+
+
+def plot_overall_ident(df, name='overall_ident_' + date,
+                       formats=('png',)):
+    '''Line graphs the overall ident of each data set of a summary
+    dataframe to image files, name.png by default, with no display
+    needed. matplotlib is only imported here, as it is slow to load.
+    Returns the names of the files written.'''
+    from report_figures import render_figure
+    return render_figure(('overall_ident', name, formats,
+                          (list(df['file_id']),
+                           list(df['overall_ident']))))
+
+
+def benchmark(csv_filename, repeat=3):
+    '''Prints the best time to read a blastn csv file and get the
+    ident of each hit the original way (untyped read_csv and df.apply)
+    and the vectorized way (typed read_csv and get_ident).'''
+
+    def _original():
+        df = get_dataframe(csv_filename)
+        df.columns = blast_columns
+        del df['qseqid']
+        return _apply_ident(df).mean()
+
+    def _vectorized():
+        return get_ident(get_blast_dataframe(csv_filename)).mean()
+
+    for name, func in (('apply', _original), ('vector', _vectorized)):
+        best_time = None
+        for _ in range(repeat):
+            start = perf_counter()
+            func()
+            elapsed = perf_counter() - start
+            if best_time is None or elapsed < best_time:
+                best_time = elapsed
+        print("{:<7}: {:8.4f} s per file".format(name, best_time))
+
+
+def blastn_batch_proc(jobs=1, use_cache=False, bin_width=None):
     '''Run this module as a batch script on all blastn csv and fasta
-    files in the working directory.'''
+    files in the working directory. With jobs > 1 the files are
+    summarized in a pool of worker processes and the rows are written
+    out in file order by this process. With use_cache the blast data
+    is read through the blast_cache columnar cache. With bin_width the
+    hits of all files are also binned by pident in bins of that width
+    from 60 to 100%.'''
 
     set_csv_header()
 
-    csv_files = sorted([file for file in listdir('.')
-                        if file.endswith('csv')])
-    if not csv_files:
-        print("No files with *.csv found!")
+    csv_files = [os.path.basename(file) for file in list_blast_files('.')]
 
     fasta_files = sorted([file for file in listdir('.')
-                          if file.endswith('fa')])
+                          if strip_gz(file).endswith('fa') and
+                          not strip_gz(file).endswith('_non_hitters.fa')])
     if not fasta_files:
         print("No files with *.fa found!")
 
-    for csv_filename, fa_filename in zip(csv_files, fasta_files):
-        print("<{}>".format(csv_filename))
-        print("<{}>".format(fa_filename))
-        get_blast_data(csv_filename, fa_filename)
-        print()
+    pairs = pair_by_seqfile(csv_files, fasta_files)
+
+    if jobs > 1:
+        with stage('summary pool') as st, \
+                ProcessPoolExecutor(max_workers=jobs) as pool:
+            st.add(len(pairs))
+            outputs = pool.map(worker(_get_blast_summary),
+                               [pair + (use_cache,) for pair in pairs])
+            for (csv_filename, fa_filename), output in zip(pairs, outputs):
+                outline = worker_result(output)
+                print("<{}>".format(csv_filename))
+                print("<{}>".format(fa_filename))
+                print_blast_summary(outline)
+                write_blast_summary(outline)
+                print()
+    else:
+        for csv_filename, fa_filename in pairs:
+            print("<{}>".format(csv_filename))
+            print("<{}>".format(fa_filename))
+            get_blast_data(csv_filename, fa_filename, use_cache)
+            print()
 
     get_finalstats(csv_outfilename)
 
+    if bin_width is not None:
+        print("<Hits by pident>")
+        with stage('hit bins'):
+            print_bins(get_hit_bins([pair[0] for pair in pairs],
+                                    np.arange(60.0, 100.0 + bin_width / 2,
+                                              bin_width), use_cache))
+
+
+def add_arguments(parser):
+    '''Adds the command line options of blastn_batch_proc to an
+    argparse parser.'''
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('--cache', action='store_true',
+                        help='read the blast data through the columnar '
+                             'cache (needs pyarrow)')
+    parser.add_argument('--bin-width', type=float,
+                        help='also print the hits of all files binned by '
+                             'pident in bins of this width, e.g. 0.5')
+    add_report_arguments(parser)
+
+
+def main(args):
+    '''Runs blastn_batch_proc with add_arguments args.'''
+    start_from_args('blastn_proc', args)
+    blastn_batch_proc(jobs=args.jobs, use_cache=args.cache,
+                      bin_width=args.bin_width)
+    finish_from_args(args)
+
 
 if __name__ == '__main__':
-    
-    blastn_batch_proc()
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    main(parser.parse_args())
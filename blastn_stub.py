@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+'''Stand-in for blastn for checking the blast_runner scheduling
+without a genome db. Takes the same command line, reads the -query
+fasta file and writes an outfmt 10 row (qseqid qstart qend mismatch
+gapopen pident nident length qlen) to -out for about 80% of the
+query seqs. The rows depend only on the seq ids, so reruns give the
+same output. If the file named by the BLASTN_STUB_FAIL_ONCE env var
+exists, it is removed and the stub exits with an error, to exercise
+retries.'''
+
+import os
+import sys
+import zlib
+
+from fasta_io import read_fasta
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+def get_arg(args, name, default=None):
+    '''Returns the value following an option in a blastn arg list.'''
+    if name in args:
+        return args[args.index(name) + 1]
+    return default
+
+
+def stub_rows(query_file):
+    '''Generator that yields an outfmt 10 line for the hitting seqs
+    of a query fasta file.'''
+    for header, seq in read_fasta(query_file):
+        qseqid = header.split()[0]
+        key = zlib.crc32(qseqid.encode('ascii'))
+        if key % 5 == 0:
+            continue
+        qlen = len(seq)
+        length = max(1, qlen - key % 50)
+        pident = 60 + (key % 4001) / 100
+        nident = int(length * pident / 100)
+        mismatch = length - nident
+        gapopen = key % 4
+        yield ",".join(str(item) for item in
+                       [qseqid, 1, length, mismatch, gapopen,
+                        '{:.3f}'.format(pident), nident, length,
+                        qlen]) + "\n"
+
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+    fail_flag = os.environ.get('BLASTN_STUB_FAIL_ONCE')
+    if fail_flag and os.path.exists(fail_flag):
+        os.unlink(fail_flag)
+        print("blastn_stub: failing once as asked", file=sys.stderr)
+        sys.exit(1)
+
+    query_file = get_arg(args, '-query')
+    out_file = get_arg(args, '-out')
+    if query_file is None or out_file is None:
+        print("blastn_stub: -query and -out are needed", file=sys.stderr)
+        sys.exit(2)
+
+    with open(out_file, 'w') as fo:
+        fo.writelines(stub_rows(query_file))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3.5
+
+'''Single command line entry point for the chimp trace read pipeline.
+
+    chimp_trace.py <command> [options]
+
+commands:
+  stats       basic stats of the trace read fasta files (seqfile_stats)
+  summarize   summary of each blastn csv file and of the whole set
+              (blastn_proc)
+  nonhitters  fasta files of the reads with no blastn hit
+              (get_non_hitters)
+  seqyear     run years of the trace info xml files (get_xml_seqyear)
+  build-db    build or update the chimp_trace_25k db (make_db)
+  watch       process the blastn csv files as they land (blast_watch)
+  report      render the report figures to image files (report_figures)
+  query       run the chimp_trace_25k.sql queries on the db, or on the
+              source files with duckdb (query_engine)
+
+Run chimp_trace.py <command> -h for the options of a command. Only
+the module of the command is imported, and numpy, pandas and
+matplotlib are only imported by the commands that use them, so short
+runs are not held up loading libraries they never call. Figures are
+drawn on the matplotlib Agg canvas and written to image files, so no
+display is needed.'''
+
+from collections import OrderedDict
+import argparse
+import importlib
+import sys
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+# Module of each command, with add_arguments(parser) and main(args)
+commands = OrderedDict([('stats', 'seqfile_stats'),
+                        ('summarize', 'blastn_proc'),
+                        ('nonhitters', 'get_non_hitters'),
+                        ('seqyear', 'get_xml_seqyear'),
+                        ('build-db', 'make_db'),
+                        ('watch', 'blast_watch'),
+                        ('report', 'report_figures'),
+                        ('query', 'query_engine')])
+
+
+def main(argv=None):
+    '''Runs a command with its options, from sys.argv by default, and
+    returns its exit status.'''
+    parser = argparse.ArgumentParser(
+        prog='chimp_trace.py', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(commands),
+                        help='command to run')
+    parser.add_argument('options', nargs=argparse.REMAINDER,
+                        help='options of the command')
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(commands[args.command])
+    command_parser = argparse.ArgumentParser(
+        prog='chimp_trace.py ' + args.command, description=module.__doc__)
+    module.add_arguments(command_parser)
+    return module.main(command_parser.parse_args(args.options))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
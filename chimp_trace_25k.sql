@@ -87,38 +87,70 @@ from num_seqs_99_8 join perc_hits_overall_ident
   on seqfile = seq_file
 order by seqfile + 0 asc;
 
---Get avg aln data in specific ranges
-SELECT count(*)
-  ,round(avg(pident),1) as avg_pident
-  ,round(avg(gapopen),1) as avg_gapopen
-  ,round(avg(mismatch),1) as avg_mismatch
-  ,round(avg(length),1) as avg_aln_len
-from chimp_blast_on_homo
-where pident between 90.00 and 100.00;
+--Get avg aln data in specific ranges in one pass,
+--60-70, 70-80, 80-90 and 90-100 (other edges can be
+--added to bin_edges with make_db.set_bin_edges)
+select bin_lo, bin_hi, num_hits
+  ,round(avg_pident,1) as avg_pident
+  ,round(avg_gapopen,1) as avg_gapopen
+  ,round(avg_mismatch,1) as avg_mismatch
+  ,round(avg_aln_len,1) as avg_aln_len
+from hit_bins
+where name = 'aln_ranges'
+order by bin_lo;
+
+--Same in 0.5% steps
+select bin_lo, bin_hi, num_hits
+  ,round(avg_pident,2) as avg_pident
+  ,round(avg_gapopen,2) as avg_gapopen
+  ,round(avg_mismatch,2) as avg_mismatch
+  ,round(avg_aln_len,1) as avg_aln_len
+from hit_bins
+where name = 'pident_0.5'
+order by bin_lo;
+
+--Seqfiles below and at or over 90% overall ident
+select bin_lo, bin_hi, num_files
+  ,round(avg_pident,2) as avg_pident
+  ,round(avg_perc_hits,2) as avg_perc_hits
+  ,round(overall_ident,2) as overall_ident
+from file_bins
+where name = 'overall_ident'
+order by bin_lo;
 
-SELECT count(*)
-  ,round(avg(pident),1) as avg_pident
-  ,round(avg(gapopen),1) as avg_gapopen
-  ,round(avg(mismatch),1) as avg_mismatch
-  ,round(avg(length),1) as avg_aln_len
-from chimp_blast_on_homo
-where pident between 80.00 and 90.00;
+--====================================
+--Same results from the summary tables
+--kept up to date by make_db.py
+--====================================
 
-SELECT count(*)
-  ,round(avg(pident),1) as avg_pident
-  ,round(avg(gapopen),1) as avg_gapopen
-  ,round(avg(mismatch),1) as avg_mismatch
-  ,round(avg(length),1) as avg_aln_len
-from chimp_blast_on_homo
-where pident between 70.00 and 80.00;
+--Averages, perc hits and seqs > 99.7 for each seqfile
+select seqfile
+    ,round(avg_pident,1) as avg_pident
+    ,min_pident
+    ,round(avg_gapopen,1) as avg_gapopen
+    ,round(avg_mismatch,1) as avg_mismatch
+    ,round(avg_qlen,1) as avg_qlen
+    ,round(avg_nident,1) as avg_nident
+    ,overall_ident
+    ,perc_hits
+    ,num_seqs_99_8
+from seqfile_summary
+order by seqfile + 0 asc;
 
-SELECT count(*)
-  ,round(avg(pident),1) as avg_pident
-  ,round(avg(gapopen),1) as avg_gapopen
-  ,round(avg(mismatch),1) as avg_mismatch
-  ,round(avg(length),1) as avg_aln_len
-from chimp_blast_on_homo
-where pident between 60.00 and 70.00;
+--Num seqfiles < 90.5% overall ident
+select count(*) from seqfile_summary
+where round(overall_ident,2) < 90.5;
+
+--Avg aln data in a pident range from the 0.1% bins,
+--pident_bin 900 to 999 is pident 90.0 to 99.9... and bin
+--1000 holds the hits of exactly 100.0
+select sum(num_hits)
+  ,round(sum(sum_pident)/sum(num_hits),1) as avg_pident
+  ,round(sum(sum_gapopen)*1.0/sum(num_hits),1) as avg_gapopen
+  ,round(sum(sum_mismatch)*1.0/sum(num_hits),1) as avg_mismatch
+  ,round(sum(sum_length)*1.0/sum(num_hits),1) as avg_aln_len
+from pident_histogram
+where pident_bin between 900 and 1000;
 
 --====================================
 --Analysis with seq year data
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3.5
+
+'''Indexed random access into multi-fasta files. A sidecar index in
+the samtools faidx format (<fasta file>.fai) records the id, seq
+length, byte offset, bases per line and bytes per line of each record,
+so records can be fetched by id through mmap without parsing the rest
+of the file, and seq lengths can be had without reading any seqs.
+The index of a gzip or BGZF compressed file gives offsets into the
+decompressed data, so it serves the seq lengths but not fetches.
+Can be run as a script to build the index of each file given.'''
+
+from collections import OrderedDict
+import mmap
+import os
+import sys
+import tempfile
+
+from fasta_io import read_fasta
+from gzip_io import get_format
+from gzip_io import open_input
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+def build_index(fastafile):
+    '''Scans a multi-fasta file and returns an ordered dict of
+    seq id: (seqlen, offset, linebases, linewidth). A record whose
+    lines are not all the same width but the last gets linebases and
+    linewidth 0, so its length is known but it cannot be fetched.
+    Raises ValueError for a duplicate or empty seq id.'''
+    index = OrderedDict()
+
+    def _add(seq_id, seqlen, offset, linebases, linewidth):
+        if seq_id in index:
+            raise ValueError('Duplicate seq id ' + seq_id + ' in ' +
+                             fastafile)
+        if uneven:
+            linebases = linewidth = 0
+        index[seq_id] = (seqlen, offset, linebases, linewidth)
+
+    with open_input(fastafile, 'rb') as fi:
+        seq_id = None
+        pos = 0
+        for line in fi:
+            if line.startswith(b'>'):
+                if seq_id is not None:
+                    _add(seq_id, seqlen, offset, linebases, linewidth)
+                fields = line[1:].split()
+                if not fields:
+                    raise ValueError('Empty seq id at byte ' + str(pos) +
+                                     ' of ' + fastafile)
+                seq_id = fields[0].decode('ascii')
+                seqlen = 0
+                offset = pos + len(line)
+                linebases = linewidth = 0
+                short_line = uneven = False
+            elif seq_id is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if (short_line and bases) or bases > linebases > 0:
+                    uneven = True
+                if not linewidth:
+                    linebases, linewidth = bases, len(line)
+                    if not bases:
+                        short_line = True
+                elif bases != linebases or len(line) != linewidth:
+                    short_line = True
+                seqlen += bases
+            pos += len(line)
+        if seq_id is not None:
+            _add(seq_id, seqlen, offset, linebases, linewidth)
+
+    return index
+
+
+def write_index(fastafile, index):
+    '''Writes an index from build_index to the .fai sidecar file,
+    through a temporary file in the same directory so a reader or a
+    concurrent writer never sees a partial one.'''
+    index_filename = fastafile + '.fai'
+    try:
+        fd, part_file = tempfile.mkstemp(
+            prefix=os.path.basename(index_filename) + '.',
+            suffix='.part', dir=os.path.dirname(index_filename) or '.')
+    except IOError:
+        print('Cannot open', index_filename)
+        return
+    try:
+        with os.fdopen(fd, 'w') as fo:
+            for seq_id, entry in index.items():
+                fo.write(seq_id + "\t" +
+                         "\t".join(str(item) for item in entry) + "\n")
+        os.chmod(part_file, 0o644)
+        os.replace(part_file, index_filename)
+    except IOError:
+        print('Cannot open', index_filename)
+        os.unlink(part_file)
+
+
+def read_index(index_filename):
+    '''Reads a .fai sidecar file into an ordered dict of
+    seq id: (seqlen, offset, linebases, linewidth).'''
+    index = OrderedDict()
+    with open(index_filename, 'r') as fi:
+        for line in fi:
+            fields = line.rstrip('\n').split('\t')
+            index[fields[0]] = tuple(int(item) for item in fields[1:5])
+    return index
+
+
+def index_is_current(fastafile):
+    '''Checks whether the .fai sidecar file of a fasta file exists and
+    is no older than the fasta file.'''
+    index_filename = fastafile + '.fai'
+    return (os.path.exists(index_filename) and
+            os.path.getmtime(index_filename) >= os.path.getmtime(fastafile))
+
+
+def get_index(fastafile):
+    '''Returns the index of a multi-fasta file, reading it from the
+    .fai sidecar file or building and writing it if that is missing or
+    older than the fasta file.'''
+    if index_is_current(fastafile):
+        return read_index(fastafile + '.fai')
+    index = build_index(fastafile)
+    write_index(fastafile, index)
+    return index
+
+
+def get_seqlens(fastafile):
+    '''Returns a list of the seq lengths of a multi-fasta file, in
+    file order, from its index, or by reading the seqs if the file
+    cannot be indexed, e.g. for a duplicate seq id.'''
+    try:
+        index = get_index(fastafile)
+    except ValueError:
+        return [len(seq) for _, seq in read_fasta(fastafile)]
+    return [entry[0] for entry in index.values()]
+
+
+def _get_seq(mm, entry):
+    '''Returns the DNA seq of one index entry from a mapped file.'''
+    seqlen, offset, linebases, linewidth = entry
+    if not seqlen:
+        return ''
+    full_lines, rest = divmod(seqlen, linebases)
+    end = offset + full_lines * linewidth + rest
+    seq = mm[offset:end]
+    if linewidth > linebases:
+        seq = seq.replace(b'\n', b'').replace(b'\r', b'')
+    return seq.decode('ascii')
+
+
+def fetch_seqs(fastafile, seq_ids):
+    '''Generator that yields a (seq id, DNA seq) tuple for each of the
+    seq ids by seeking to it in the mapped fasta file. Raises KeyError
+    for a seq id not in the file, and ValueError for a compressed file
+    or a record with uneven line widths.'''
+    if get_format(fastafile) is not None:
+        raise ValueError('Cannot fetch seqs from compressed ' + fastafile)
+    index = get_index(fastafile)
+    with open(fastafile, 'rb') as fi:
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for seq_id in seq_ids:
+                entry = index[seq_id]
+                if entry[0] and not entry[2]:
+                    raise ValueError('Uneven line widths in record ' +
+                                     seq_id + ' of ' + fastafile)
+                yield seq_id, _get_seq(mm, entry)
+        finally:
+            mm.close()
+
+
+def fetch_seq(fastafile, seq_id):
+    '''Returns the DNA seq of one record of a fasta file by its id.'''
+    return next(fetch_seqs(fastafile, [seq_id]))[1]
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Usage: fasta_index.py <fasta file> ...")
+        sys.exit()
+
+    for filename in sys.argv[1:]:
+        write_index(filename, build_index(filename))
+        print("Indexed", filename)
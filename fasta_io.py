@@ -0,0 +1,189 @@
+#!/usr/bin/env python3.5
+
+'''Shared fasta file reader and writer for the chimp trace read
+modules. Records are streamed one at a time from a buffered file so
+memory use stays flat regardless of file size. Gzip and BGZF files
+are read and .gz files written through gzip_io. Can be run as a script
+to benchmark the streaming reader against the old read().split('>')
+approach, after checking that the two read the same records.'''
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from gzip_io import BUFSIZE
+from gzip_io import open_input
+from gzip_io import open_output
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+def open_text(filename, bufsize=BUFSIZE):
+    '''Opens a text file for reading with a large buffer, decompressing
+    it if it is gzip or BGZF compressed.'''
+    return open_input(filename, 'rt', bufsize)
+
+
+def read_fasta_text(fastafile, bufsize=BUFSIZE):
+    '''Generator that yields the raw text of each record in a multi-
+    fasta file, less its leading '>' and final line break.'''
+    try:
+        fi = open_text(fastafile, bufsize)
+    except IOError:
+        print('Cannot open', fastafile)
+        return
+
+    with fi:
+        # Text ahead of the first header is not a record, but blank
+        # lines or spaces ahead of it are skipped
+        first = fi.read(1)
+        while first and first.isspace():
+            first = fi.read(1)
+        started = first == '>'
+        # Carry any partial record over from one chunk to the next
+        tail = ''
+        while True:
+            chunk = fi.read(bufsize)
+            if not chunk:
+                break
+            block = tail + chunk
+            cut = block.rfind('\n>')
+            if cut == -1:
+                tail = block
+                continue
+            tail = block[cut + 2:]
+            for entry in block[:cut].split('\n>'):
+                if started:
+                    yield entry
+                started = True
+        if started:
+            yield tail.rstrip('\n')
+
+
+def read_fasta(fastafile, bufsize=BUFSIZE):
+    '''Generator that yields a tuple for each record in a multi-fasta
+    file: (header, seq). The header is the text after the '>' and the
+    seq is the DNA sequence with line breaks removed.'''
+    for entry in read_fasta_text(fastafile, bufsize):
+        yield _parse_entry(entry)
+
+
+def get_seq_id(entry):
+    '''Returns the seq id, the first word of the header, of the raw
+    text of a record from read_fasta_text.'''
+    end = entry.find('\n')
+    header = entry if end == -1 else entry[:end]
+    words = header.split(None, 1)
+    return words[0] if words else ''
+
+
+def _parse_entry(entry):
+    '''Splits the text of a single fasta record, less its leading
+    '>', into (header, seq).'''
+    header, _, seq = entry.partition('\n')
+    return header, seq.replace('\n', '')
+
+
+def format_fasta(header, seq, width=60):
+    '''Returns a fasta record as text with the seq wrapped at width
+    bases per line.'''
+    lines = ['>' + header]
+    lines.extend(seq[i:i + width] for i in range(0, len(seq), width))
+    return '\n'.join(lines) + '\n'
+
+
+def write_fasta(fastafile, records, width=60, bufsize=BUFSIZE,
+                compress=None):
+    '''Writes an iterable of (header, seq) tuples to a fasta file in
+    large buffered writes, BGZF compressed with compress or if the
+    file name ends in .gz. Returns the number of records written.'''
+    num_records = 0
+    try:
+        with open_output(fastafile, 'wt', bufsize, compress) as fo:
+            for header, seq in records:
+                fo.write(format_fasta(header, seq, width))
+                num_records += 1
+    except IOError:
+        print('Cannot open', fastafile)
+    return num_records
+
+
+def _split_fasta(fastafile):
+    '''The original whole-file reader, kept for benchmarking only.'''
+    with open(fastafile, 'r') as fi:
+        return [(part[0],
+                part[2].replace('\n', ''))
+                for part in
+                [entry.partition('\n')
+                for entry in fi.read().split('>')[1:]]]
+
+
+# Fasta texts that the streaming reader must read as the split reader
+# does
+check_texts = ['>a\nACGT\n>b\nAC\n',
+               '\n>a\nACGT\n>b\nAC\n',
+               '  \n\n>a x\nACGT\nAC\n>b\nAC',
+               '>a\n\n>b\nACGT\n',
+               'preamble\n>a\nACGT\n',
+               '']
+
+
+def check_reader(bufsizes=(1, 3, BUFSIZE)):
+    '''Checks that read_fasta reads the same records as the split
+    reader from each of check_texts, with each buffer size. Prints and
+    returns the number of mismatches.'''
+    num_failed = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fastafile = os.path.join(tmp_dir, 'check.fa')
+        for text in check_texts:
+            with open(fastafile, 'w') as fo:
+                fo.write(text)
+            expected = _split_fasta(fastafile)
+            for bufsize in bufsizes:
+                records = list(read_fasta(fastafile, bufsize))
+                if records != expected:
+                    num_failed += 1
+                    print("read_fasta of {!r} with bufsize {}: {} not "
+                          "{}".format(text, bufsize, records, expected))
+    print("read_fasta check:", "FAILED" if num_failed else "ok")
+    return num_failed
+
+
+def benchmark(fastafile, repeat=3):
+    '''Prints the best wall time, throughput and peak memory of the
+    streaming reader and the split reader over a fasta file.'''
+
+    def _run(reader):
+        best_time = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            total = sum(len(seq) for _, seq in reader(fastafile))
+            elapsed = time.perf_counter() - start
+            if best_time is None or elapsed < best_time:
+                best_time = elapsed
+        tracemalloc.start()
+        sum(len(seq) for _, seq in reader(fastafile))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return best_time, total, peak
+
+    for name, reader in (('split', _split_fasta), ('stream', read_fasta)):
+        elapsed, total, peak = _run(reader)
+        print("{:<7}: {:8.3f} s  {:8.1f} Mbases/s  peak {:8.1f} MB".format(
+              name, elapsed, total / elapsed / 1e6, peak / 1e6))
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2:
+        print("Usage: fasta_io.py <fasta file>")
+        sys.exit()
+
+    if check_reader():
+        sys.exit(1)
+    benchmark(sys.argv[1])
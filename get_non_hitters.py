@@ -1,6 +1,34 @@
 #!/usr/bin/env python3.5
 
+'''Puts the sequences of a fasta file that have no hit in the
+corresponding blastn output file into a new fasta file. Can be run
+as a batch script on all blastn csv and fasta files in the working
+directory, taking the hitter ids from the csv files or from the
+chimp_blast_on_homo table of the chimp_trace_25k db. The input files
+may be gzip or BGZF compressed, and the new fasta files can be written
+BGZF compressed.'''
+
+from concurrent.futures import ProcessPoolExecutor
 from os import listdir
+import argparse
+import os
+import sqlite3
+
+from fasta_io import BUFSIZE
+from fasta_io import get_seq_id
+from fasta_io import read_fasta_text
+from gzip_io import open_input
+from gzip_io import open_output
+from gzip_io import strip_gz
+from instrument import add_report_arguments
+from instrument import finish_from_args
+from instrument import stage
+from instrument import start_from_args
+from instrument import worker
+from instrument import worker_result
+from make_db import get_seqfile_id
+from make_db import list_blast_files
+from make_db import pair_by_seqfile
 
 
 __author__ = "Jeffrey P Tomkins, PhD"
@@ -8,61 +36,167 @@ __copyright__ = "Copyright 2016, Institute for Creation Research"
 __email__ = "jtomkins@icr.org"
 
 
-def get_non_hitters(in_csvfile, in_fastafile):
-	'''Takes fasta file and corresponding blastn output file
-	in csv format as input. Puts all non hitting sequences in 
-	a new fasta file.'''
-
-    fi_fasta = open(in_fastafile, 'r')
-    fi_csv = open(in_csvfile, 'r')
-    fo = open(in_fastafile.split('.')[0] + "_non_hitters.fa", 'w')
-
-    # Get id nums and put in a set
-    id_list = []
-    for line in fi_csv:
-        id_line = line.split(',')
-        id_list.append(id_line[0])
-
-    # Step through input fasta file and check ID against set
-    # Write out fasta seqs to file not in set
-    id_fset = frozenset(id_list)
-    for line in fi_fasta:
-        if line.startswith('>'):
-            id_num = str(line.lstrip('>').split(' ')[0])
-            if id_num not in id_fset:
-                fo.write(line)
-                reject_flag = False
-            else:
-                reject_flag = True
-        else:
-            if not reject_flag:
-                fo.write(line)
-
-    fi_fasta.close()
-    fi_csv.close()
-    fo.close()
-
-
-def file_batch():
-    '''Run this module as a batch script on all blastn csv and 
-    fasta files in the working directory.'''
-
-    csv_files = sorted([file for file in listdir('.')
-                        if file.endswith(r'.csv')])
-    if not csv_files:
-        print("No files with *.csv found!")
+def get_hitter_ids(in_csvfile):
+    '''Returns a frozenset of the qseqids in the first column of a
+    blastn csv file, reading one line at a time.'''
+    with stage('hitter ids') as st, \
+            open_input(in_csvfile, 'rt', BUFSIZE) as fi:
+        id_fset = frozenset(line.split(',', 1)[0] for line in fi)
+        st.add(len(id_fset), os.path.getsize(in_csvfile))
+    return id_fset
+
+
+def get_db_hitter_ids(db_name, seqfile):
+    '''Returns a frozenset of the qseqids of a seqfile in the
+    chimp_blast_on_homo table.'''
+    conn = sqlite3.connect(db_name)
+    try:
+        with stage('db hitter ids') as st:
+            id_fset = frozenset(
+                row[0] for row in
+                conn.execute('select qseqid from chimp_blast_on_homo '
+                             'where seqfile = ?', (seqfile,)))
+            st.add(len(id_fset))
+        return id_fset
+    finally:
+        conn.close()
+
+
+def get_loaded_seqfiles(db_name):
+    '''Returns the set of seqfile ids whose blastn csv file has been
+    loaded into the chimp_blast_on_homo table, from the ingest_manifest
+    table, or from the blast table itself for a db with no manifest.'''
+    conn = sqlite3.connect(db_name)
+    try:
+        try:
+            return set(get_seqfile_id(row[0]) for row in
+                       conn.execute('select path from ingest_manifest '
+                                    'where db_table = ?',
+                                    ('chimp_blast_on_homo',)))
+        except sqlite3.OperationalError:
+            return set(row[0] for row in
+                       conn.execute('select distinct seqfile '
+                                    'from chimp_blast_on_homo'))
+    finally:
+        conn.close()
+
+
+def write_non_hitters(in_fastafile, id_fset, compress=False):
+    '''Copies the fasta records of a fasta file whose ids are not in
+    id_fset to a new *_non_hitters.fa file, or a BGZF compressed
+    *_non_hitters.fa.gz file with compress, whole records at a time.
+    Returns the number of records written.'''
+    num_records = 0
+    out_fastafile = os.path.join(
+        os.path.dirname(in_fastafile),
+        os.path.basename(in_fastafile).split('.')[0] + "_non_hitters.fa")
+    if compress:
+        out_fastafile += '.gz'
+    with stage('non-hitter fasta') as st, \
+            open_output(out_fastafile, 'wt', BUFSIZE, compress) as fo:
+        for entry in read_fasta_text(in_fastafile):
+            if get_seq_id(entry) not in id_fset:
+                fo.write('>' + entry + '\n')
+                num_records += 1
+        st.add(num_records, os.path.getsize(in_fastafile))
+    return num_records
+
+
+def get_non_hitters(in_csvfile, in_fastafile, compress=False):
+    '''Takes fasta file and corresponding blastn output file
+    in csv format as input. Puts all non hitting sequences in
+    a new fasta file.'''
+    return write_non_hitters(in_fastafile, get_hitter_ids(in_csvfile),
+                             compress)
+
+
+def get_db_non_hitters(db_name, in_fastafile, compress=False):
+    '''Takes a fasta file and puts all sequences with no hit for its
+    seqfile in the chimp_blast_on_homo table in a new fasta file.'''
+    seqfile = get_seqfile_id(in_fastafile)
+    return write_non_hitters(in_fastafile,
+                             get_db_hitter_ids(db_name, seqfile), compress)
+
+
+def _get_non_hitters(args):
+    '''Unpacks (csv, fasta, compress) args for the process pool.'''
+    return get_non_hitters(*args)
+
+
+def _get_db_non_hitters(args):
+    '''Unpacks (db, fasta, compress) args for the process pool.'''
+    return get_db_non_hitters(*args)
+
+
+def file_batch(jobs=1, db_name=None, compress=False):
+    '''Run this module as a batch script on all blastn csv and
+    fasta files in the working directory, compressed or not. With
+    db_name the hitter ids are read from the db instead of the csv
+    files, and a fasta file whose seqfile is not loaded in the db is
+    skipped. With jobs > 1 the files are handled in a pool of worker
+    processes. With compress the new fasta files are BGZF compressed.'''
 
     fasta_files = sorted([file for file in listdir('.')
-                          if file.endswith(r'.fa')])
+                          if strip_gz(file).endswith(r'.fa') and
+                          not strip_gz(file).endswith('_non_hitters.fa')])
     if not fasta_files:
         print("No files with *.fa found!")
 
+    if db_name is None:
+        csv_files = [os.path.basename(file)
+                     for file in list_blast_files('.')]
+        pairs = pair_by_seqfile(csv_files, fasta_files)
+        func = _get_non_hitters
+    else:
+        loaded = get_loaded_seqfiles(db_name)
+        pairs = []
+        for fa_file in fasta_files:
+            if get_seqfile_id(fa_file) in loaded:
+                pairs.append((db_name, fa_file))
+            else:
+                print("No blastn data for", fa_file, "in", db_name +
+                      ", skipping")
+        func = _get_db_non_hitters
+
     print("Creating non-hitter fasta files for...")
 
-    for csv_file, fa_file in zip(csv_files, fasta_files):
-        get_non_hitters(csv_file, fa_file)
-        print(csv_file, "and", fa_file)
+    args = [pair + (compress,) for pair in pairs]
+    if jobs > 1:
+        with stage('non-hitter pool') as st, \
+                ProcessPoolExecutor(max_workers=jobs) as pool:
+            st.add(len(pairs))
+            for pair, output in zip(pairs, pool.map(worker(func), args)):
+                worker_result(output)
+                print(pair[0], "and", pair[1])
+    else:
+        for pair, arg in zip(pairs, args):
+            func(arg)
+            print(pair[0], "and", pair[1])
+
+
+def add_arguments(parser):
+    '''Adds the command line options of file_batch to an argparse
+    parser.'''
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('--db',
+                        help='read hitter ids from the chimp_blast_on_homo '
+                             'table of this sqlite db')
+    parser.add_argument('--compress', action='store_true',
+                        help='write BGZF compressed *_non_hitters.fa.gz '
+                             'files')
+    add_report_arguments(parser)
+
+
+def main(args):
+    '''Runs file_batch with add_arguments args.'''
+    start_from_args('get_non_hitters', args)
+    file_batch(args.jobs, args.db, args.compress)
+    finish_from_args(args)
 
 
 if __name__ == '__main__':
-    file_batch()
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -1,15 +1,41 @@
 #!/usr/bin/env python3.5
 '''Extracts the minmum and maximum run years from the xml
-sequencing info file and puts into a csv file with seqfile
-name. If xml file contains no year tags, 'NULL' is used.
-e.g.
+sequencing info file of each seqfile and puts them into the
+chimp_seq_year table of the chimp_trace_25k db, and optionally
+into a csv file with seqfile name. If xml file contains no year
+tags, NULL is used. e.g.
 001,2000,2002
 005,2002,2002
 012,NULL,NULL
-022,2002,2002'''
+022,2002,2002
 
+The xml files are parsed as a stream, one trace element at a time,
+so RUN_DATE tags may span lines and memory use does not grow with
+the file size. The files may be gzip or BGZF compressed. Files can be
+parsed in a pool of worker processes and the number of traces for
+each run date can also be stored, in the chimp_seq_run_dates table.'''
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from os import listdir
+import argparse
+import os
 import re
+import sqlite3
+import xml.etree.ElementTree as ET
+
+from gzip_io import open_input
+from gzip_io import strip_gz
+from instrument import add_report_arguments
+from instrument import finish_from_args
+from instrument import stage
+from instrument import start_from_args
+from instrument import worker
+from instrument import worker_result
+from make_db import create_tables
+from make_db import insert_rows
+from make_db import run_date_names
+from make_db import seq_year_names
 
 
 __author__ = "Jeffrey P Tomkins, PhD"
@@ -17,31 +43,174 @@ __copyright__ = "Copyright 2016, Institute for Creation Research"
 __email__ = "jtomkins@icr.org"
 
 
-# Put all the DNA seq xml files in a list
-xml_files = sorted([file for file in listdir('.')
-                    if file.startswith('xml')])
-
 regex_yr = re.compile(r'(\d{4})')
 
-seq_file = []
-run_years = []
-
-# Populate the seq_file and run_years lists from each xml file
-for filename in xml_files:
-    seq_file.append(filename[-3:])
-    years = []
-    with open(filename, 'r') as fi:
-    	for line in fi:
-            if '<RUN_DATE>' in line:
-                year = re.search(regex_yr, line).group(0)       
-                if year not in years:
-                    years.append(year)
-    if not years:
-    	run_years.append(['NULL', 'NULL'])
-    else:
-        run_years.append(years)
-
-# Write out the csv file as depicted above
-with open("seq_year.csv", "w") as fo:
-	for seqfile, year in zip(seq_file, run_years):
-	    fo.write(seqfile + "," + min(year) + "," + max(year) + "\n")
+
+def get_seqfile_id(xml_filename):
+    '''Returns the seqfile id of an xml file, the last 3 chars of its
+    name less any .gz.'''
+    return strip_gz(os.path.basename(xml_filename))[-3:]
+
+
+def local_name(tag):
+    '''Returns an element tag without its {namespace}.'''
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_run_dates(xml_filename):
+    '''Generator that yields the text of each RUN_DATE element of an
+    xml file. The file is parsed incrementally and each child of the
+    root element is cleared once it ends. A file that is malformed, or
+    holds more than one xml document, is reported and read only up to
+    the error, so one bad file does not stop a batch.'''
+    depth = 0
+    root = None
+    try:
+        with open_input(xml_filename, 'rb') as fi:
+            for event, elem in ET.iterparse(fi, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+                depth -= 1
+                if local_name(elem.tag) == 'RUN_DATE' and elem.text:
+                    yield elem.text.strip()
+                if depth == 1:
+                    root.clear()
+    except ET.ParseError as err:
+        print('Cannot parse', xml_filename, err)
+
+
+def get_run_dates(xml_filename):
+    '''Returns a Counter of the number of traces for each run date of
+    an xml file. The date is the RUN_DATE text up to any time.'''
+    return Counter(text.split()[0] for text in iter_run_dates(xml_filename)
+                   if text)
+
+
+def get_seq_year(xml_filename, distribution=False):
+    '''Returns (seqfile id, min year, max year, run dates) for an xml
+    file. The years are None if it has no RUN_DATE tags. run dates is
+    the get_run_dates Counter with distribution, otherwise None.'''
+    with stage('xml parsing') as st:
+        run_dates = get_run_dates(xml_filename)
+        st.add(sum(run_dates.values()), os.path.getsize(xml_filename))
+    years = set()
+    for run_date in run_dates:
+        match = regex_yr.search(run_date)
+        if match:
+            years.add(match.group(0))
+    return (get_seqfile_id(xml_filename),
+            min(years) if years else None,
+            max(years) if years else None,
+            run_dates if distribution else None)
+
+
+def _get_seq_year(args):
+    '''Unpacks (xml file, distribution) args for the process pool.'''
+    return get_seq_year(*args)
+
+
+def get_seq_years(xml_files, jobs=1, distribution=False):
+    '''Returns the get_seq_year results of a list of xml files in file
+    order. With jobs > 1 the files are parsed in a pool of worker
+    processes.'''
+    args = [(xml_file, distribution) for xml_file in xml_files]
+    if jobs > 1:
+        with stage('xml parsing pool') as st, \
+                ProcessPoolExecutor(max_workers=jobs) as pool:
+            st.add(len(args))
+            return [worker_result(output) for output in
+                    pool.map(worker(_get_seq_year), args)]
+    return [_get_seq_year(arg) for arg in args]
+
+
+def write_seq_year_db(db_name, results):
+    '''Replaces the chimp_seq_year table with get_seq_year results in
+    one transaction, and the chimp_seq_run_dates rows of the seqfiles
+    with run dates.'''
+    create_tables(db_name)
+    conn = sqlite3.connect(db_name)
+    try:
+        with stage('db write') as st:
+            _write_seq_years(conn, results)
+            st.add(len(results))
+    finally:
+        conn.close()
+
+
+def _write_seq_years(conn, results):
+    '''Writes get_seq_year results over a connection and commits.'''
+    try:
+        conn.execute('delete from chimp_seq_year')
+        insert_rows(conn, 'chimp_seq_year', seq_year_names,
+                    (result[:3] for result in results))
+        for seqfile, _, _, run_dates in results:
+            if run_dates is None:
+                continue
+            conn.execute('delete from chimp_seq_run_dates '
+                         'where seqfile_id = ?', (seqfile,))
+            insert_rows(conn, 'chimp_seq_run_dates', run_date_names,
+                        ((seqfile, run_date, num_traces)
+                         for run_date, num_traces
+                         in sorted(run_dates.items())))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def write_seq_year_csv(csv_filename, results):
+    '''Writes get_seq_year results to a csv file as depicted above,
+    the seq_year_csv file loaded by make_db.'''
+    try:
+        with open(csv_filename, 'w') as fo:
+            for seqfile, min_yr, max_yr, _ in results:
+                fo.write(seqfile + "," + (min_yr or 'NULL') + "," +
+                         (max_yr or 'NULL') + "\n")
+    except IOError:
+        print('Cannot open', csv_filename)
+
+
+def add_arguments(parser):
+    '''Adds the command line options of get_xml_seqyear to an argparse
+    parser.'''
+    parser.add_argument('--db', default='chimp_trace_25k.sqlite',
+                        help='sqlite db file (default chimp_trace_25k.sqlite)')
+    parser.add_argument('--csv',
+                        help='also write the years to this csv file, '
+                             'e.g. seq_year_csv')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('--dates', action='store_true',
+                        help='also store the number of traces for each '
+                             'run date')
+    add_report_arguments(parser)
+
+
+def main(args):
+    '''Gets the run years of the xml files in the working directory
+    with add_arguments args.'''
+    start_from_args('get_xml_seqyear', args)
+
+    # Put all the DNA seq xml files in a list
+    xml_files = sorted([file for file in listdir('.')
+                        if file.startswith('xml')])
+    if not xml_files:
+        print("No files with xml* found!")
+
+    results = get_seq_years(xml_files, args.jobs, args.dates)
+    write_seq_year_db(args.db, results)
+    if args.csv is not None:
+        write_seq_year_csv(args.csv, results)
+    print("chimp_seq_year: {} seqfiles, {} with years".format(
+          len(results), sum(1 for result in results if result[1])))
+    finish_from_args(args)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    main(parser.parse_args())
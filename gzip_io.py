@@ -0,0 +1,346 @@
+#!/usr/bin/env python3.5
+
+'''Transparent reading of gzip and BGZF compressed input files, and
+BGZF compressed output, for the pipeline scripts. open_input opens a
+file for reading whether or not it is compressed, going by its first
+bytes rather than its name:
+
+- BGZF files, as written by bgzip, samtools or open_output, are a
+  series of gzip members of under 64 KB each, and are decompressed a
+  block at a time in a pool of threads, as zlib releases the GIL
+- other gzip files are decompressed by pigz if there is one on the
+  PATH, which reads, inflates and checks in separate threads, or else
+  by the gzip module
+- other files are opened as they are
+
+open_output writes BGZF, compressing blocks in a pool of threads, when
+the file name ends in .gz or compress is set, so any gzip reader can
+read the file and open_input can read it back in parallel. Can be run
+as a script to compress files to BGZF, or to benchmark the ways of
+reading a compressed file.'''
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import argparse
+import gzip
+import io
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+# Read and write buffer size in bytes
+BUFSIZE = 1024 * 1024
+
+# Threads that decompress or compress BGZF blocks
+THREADS = min(8, os.cpu_count() or 1)
+
+# Blocks decompressed or compressed ahead for each thread
+BLOCKS_AHEAD = 4
+
+# Uncompressed bytes in each BGZF block written, as bgzip writes them,
+# so even a block that does not compress fits in 64 KB
+BGZF_BLOCK_SIZE = 0xff00
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# The empty block that ends a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff060042430200'
+                         '1b0003000000000000000000')
+
+
+def strip_gz(filename):
+    '''Returns a file name less any .gz suffix, for matching the file
+    extensions of compressed files.'''
+    return filename[:-3] if filename.endswith('.gz') else filename
+
+
+def get_format(filename):
+    '''Returns 'bgzf', 'gzip' or None for an uncompressed file, from the
+    header of the file.'''
+    with open(filename, 'rb') as fi:
+        header = fi.read(16)
+    if header[:2] != GZIP_MAGIC:
+        return None
+    if (len(header) == 16 and header[3] & 4 and
+            header[12:16] == b'BC\x02\x00'):
+        return 'bgzf'
+    return 'gzip'
+
+
+def read_block(fi):
+    '''Reads the next BGZF block of a binary file and returns the rest
+    of the block after its header: the deflate data and the CRC32 and
+    ISIZE trailer. Returns None at the end of the file.'''
+    header = fi.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+        raise IOError('Bad BGZF block header in ' + fi.name)
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fi.read(xlen)
+    bsize = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        sub_len = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b'BC' and sub_len == 2:
+            bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+        pos += 4 + sub_len
+    if bsize is None:
+        raise IOError('BGZF block with no size in ' + fi.name)
+    rest_len = bsize + 1 - 12 - xlen
+    rest = fi.read(rest_len)
+    if len(rest) != rest_len:
+        raise IOError('Truncated BGZF block in ' + fi.name)
+    return rest
+
+
+def inflate_block(rest):
+    '''Decompresses the deflate data of a read_block block and checks
+    it against the block's CRC32 and length.'''
+    data = zlib.decompress(rest[:-8], -15)
+    crc, isize = struct.unpack('<II', rest[-8:])
+    if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+        raise IOError('BGZF block fails its CRC check')
+    return data
+
+
+def deflate_block(data, level=6):
+    '''Compresses up to BGZF_BLOCK_SIZE bytes into a BGZF block.'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                         66, 67, 2, len(cdata) + 25)
+    return (header + cdata +
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class BgzfReader(io.RawIOBase):
+    '''Raw binary reader of a BGZF file. The compressed blocks are read
+    in order and decompressed in a pool of threads, up to BLOCKS_AHEAD
+    blocks a thread ahead of the reader.'''
+
+    def __init__(self, filename, threads=THREADS):
+        super().__init__()
+        self.name = filename
+        self._fi = open(filename, 'rb', buffering=BUFSIZE)
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._ahead = threads * BLOCKS_AHEAD
+        self._data = memoryview(b'')
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _next_block(self):
+        '''Returns the next decompressed block, or None at the end.'''
+        while not self._eof and len(self._pending) < self._ahead:
+            rest = read_block(self._fi)
+            if rest is None:
+                self._eof = True
+            else:
+                self._pending.append(self._pool.submit(inflate_block, rest))
+        if not self._pending:
+            return None
+        return self._pending.popleft().result()
+
+    def readinto(self, buffer):
+        while not self._data:
+            data = self._next_block()
+            if data is None:
+                return 0
+            self._data = memoryview(data)
+        num_bytes = min(len(buffer), len(self._data))
+        buffer[:num_bytes] = self._data[:num_bytes]
+        self._data = self._data[num_bytes:]
+        return num_bytes
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown(wait=True)
+            self._fi.close()
+        super().close()
+
+
+class BgzfWriter(io.RawIOBase):
+    '''Raw binary writer of a BGZF file. The data is cut into blocks
+    that are compressed in a pool of threads and written in order,
+    ending with the BGZF end of file block when closed.'''
+
+    def __init__(self, filename, threads=THREADS, level=6):
+        super().__init__()
+        self.name = filename
+        self._fo = open(filename, 'wb', buffering=BUFSIZE)
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._pending = deque()
+        self._ahead = threads * BLOCKS_AHEAD
+        self._level = level
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def _submit(self, data):
+        '''Compresses a block in the pool, writing out the oldest blocks
+        once there are enough of them pending.'''
+        self._pending.append(self._pool.submit(deflate_block, data,
+                                               self._level))
+        while len(self._pending) > self._ahead:
+            self._fo.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                    self._buffer = bytearray()
+                while self._pending:
+                    self._fo.write(self._pending.popleft().result())
+                self._fo.write(BGZF_EOF)
+            finally:
+                self._pool.shutdown(wait=True)
+                self._fo.close()
+        super().close()
+
+
+class PipeReader(io.RawIOBase):
+    '''Raw binary reader of the output of a command, e.g. pigz -dc.
+    Raises IOError at the end of the output if the command failed.'''
+
+    def __init__(self, command):
+        super().__init__()
+        self.name = command[-1]
+        self._command = command
+        self._proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                      bufsize=0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        num_bytes = self._proc.stdout.readinto(buffer)
+        if not num_bytes and self._proc.wait():
+            raise IOError(' '.join(self._command) + ' failed with exit ' +
+                          str(self._proc.returncode))
+        return num_bytes
+
+    def close(self):
+        if not self.closed:
+            # pigz exits on a broken pipe if closed before the end
+            self._proc.stdout.close()
+            self._proc.wait()
+        super().close()
+
+
+def _text_or_binary(binary, mode):
+    '''Returns a binary file object, wrapped for text unless mode has
+    a b.'''
+    if 'b' in mode:
+        return binary
+    return io.TextIOWrapper(binary)
+
+
+def open_input(filename, mode='rt', bufsize=BUFSIZE, threads=THREADS):
+    '''Opens a file for reading in mode 'rt' or 'rb', decompressing it
+    if it is gzip or BGZF compressed as described above. With threads
+    1 BGZF is read in a single thread and pigz is not used.'''
+    file_format = get_format(filename)
+    if file_format == 'bgzf':
+        raw = BgzfReader(filename, threads)
+    elif file_format == 'gzip':
+        pigz = shutil.which('pigz') if threads > 1 else None
+        if pigz is None:
+            return _text_or_binary(gzip.open(filename, 'rb'), mode)
+        raw = PipeReader([pigz, '-dc', filename])
+    else:
+        return open(filename, mode, buffering=bufsize)
+    return _text_or_binary(io.BufferedReader(raw, bufsize), mode)
+
+
+def open_output(filename, mode='wt', bufsize=BUFSIZE, compress=None,
+                threads=THREADS):
+    '''Opens a file for writing in mode 'wt' or 'wb', BGZF compressed
+    if compress is set or, by default, if the file name ends in .gz.'''
+    if compress is None:
+        compress = filename.endswith('.gz')
+    if not compress:
+        return open(filename, mode, buffering=bufsize)
+    return _text_or_binary(
+        io.BufferedWriter(BgzfWriter(filename, threads), bufsize), mode)
+
+
+def compress_file(filename, threads=THREADS):
+    '''Writes a BGZF compressed copy of a file to <file>.gz and returns
+    its name.'''
+    out_filename = filename + '.gz'
+    with open_input(filename, 'rb') as fi, \
+            open_output(out_filename, 'wb', compress=True,
+                        threads=threads) as fo:
+        shutil.copyfileobj(fi, fo, BUFSIZE)
+    return out_filename
+
+
+def benchmark(filename, repeat=3):
+    '''Prints the best time to read a compressed file through the
+    gzip module, pigz if present and open_input with 1 and THREADS
+    threads.'''
+    readers = [('gzip', lambda: gzip.open(filename, 'rb'))]
+    if shutil.which('pigz') is not None:
+        readers.append(('pigz', lambda: io.BufferedReader(
+            PipeReader([shutil.which('pigz'), '-dc', filename]), BUFSIZE)))
+    for threads in sorted(set([1, THREADS])):
+        readers.append(('{} thread'.format(threads),
+                        lambda threads=threads: open_input(filename, 'rb',
+                                                           threads=threads)))
+
+    for name, reader in readers:
+        best_time = None
+        for _ in range(repeat):
+            start = perf_counter()
+            with reader() as fi:
+                total = sum(len(block) for block in
+                            iter(lambda: fi.read(BUFSIZE), b''))
+            elapsed = perf_counter() - start
+            if best_time is None or elapsed < best_time:
+                best_time = elapsed
+        print("{:<9}: {:8.3f} s  {:8.1f} MB/s".format(
+              name, best_time, total / best_time / 1e6))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Compresses files to BGZF, or benchmarks reading a '
+                    'compressed file.')
+    parser.add_argument('files', nargs='+', help='files to compress')
+    parser.add_argument('--threads', type=int, default=THREADS,
+                        help='compression threads (default {})'.format(
+                             THREADS))
+    parser.add_argument('--bench', action='store_true',
+                        help='benchmark reading the files instead')
+    args = parser.parse_args()
+
+    for filename in args.files:
+        if args.bench:
+            print("<{}> {}".format(filename, get_format(filename)))
+            benchmark(filename)
+        else:
+            print("Compressed", compress_file(filename, args.threads))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3.5
+
+'''Lightweight stage timing for the pipeline scripts. A block of work
+is timed as a named stage with
+
+    with stage('csv parsing') as st:
+        df = ...
+        st.add(records=len(df), num_bytes=os.path.getsize(csvfile))
+
+Each stage adds up its wall time, calls, records and bytes processed
+and keeps the RSS high-water mark (ru_maxrss) of its process at its
+end. That is the peak of the whole process so far, not of the stage
+alone, so a stage that runs after a heavy one shows that one's peak.
+Timing a stage costs a couple of clock and getrusage calls, so the
+stages are always on. A script writes them as a json run report with
+--report, and can also capture a cProfile profile (--profile) and
+tracemalloc peaks (--trace-memory), which do slow it down.
+
+A function run in a process pool through worker() returns the stages
+it timed with its result, and worker_result() merges them into the
+stages of the parent process, so parallel runs get the same stage
+breakdown as serial ones. The wall times of a stage add up over the
+workers that ran it. The profiler modules are only imported when a
+profile is asked for.'''
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from time import perf_counter
+from time import strftime
+import json
+import resource
+import sys
+import tracemalloc
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+# Functions listed in the report from a cProfile profile
+PROFILE_TOP = 25
+
+# Bytes in the unit of ru_maxrss: bytes on macOS, kilobytes on Linux
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# Added to every report, to say what the stage fields cover
+STAGE_NOTE = ('Stages timed in worker processes (--jobs > 1) are merged '
+              'in, with their wall times added up over the workers. '
+              'rss_high_water_mb is the highest ru_maxrss of the '
+              'processes that ran a stage, read at its end: the peak of '
+              'the process so far, not of the stage alone.')
+
+
+class StageStats(object):
+    '''Totals of a named stage over all the times it ran.'''
+
+    __slots__ = ('name', 'calls', 'wall', 'records', 'bytes',
+                 'rss_high_water_mb', 'peak_traced_mb')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.records = 0
+        self.bytes = 0
+        self.rss_high_water_mb = 0.0
+        self.peak_traced_mb = None
+
+    def add(self, records=0, num_bytes=0):
+        '''Adds records and bytes processed to the stage.'''
+        self.records += records
+        self.bytes += num_bytes
+
+    def merge(self, other):
+        '''Adds the totals of the same stage run in another process.'''
+        self.calls += other.calls
+        self.wall += other.wall
+        self.records += other.records
+        self.bytes += other.bytes
+        self.rss_high_water_mb = max(self.rss_high_water_mb,
+                                     other.rss_high_water_mb)
+        if other.peak_traced_mb is not None:
+            self.peak_traced_mb = max(self.peak_traced_mb or 0.0,
+                                      other.peak_traced_mb)
+
+    def as_dict(self):
+        '''Returns the stage totals and rates as a dict.'''
+        result = OrderedDict([('name', self.name),
+                              ('calls', self.calls),
+                              ('wall', round(self.wall, 6)),
+                              ('records', self.records),
+                              ('bytes', self.bytes)])
+        if self.wall > 0 and self.records:
+            result['records_per_sec'] = round(self.records / self.wall, 1)
+        if self.wall > 0 and self.bytes:
+            result['mb_per_sec'] = round(self.bytes / 1e6 / self.wall, 3)
+        result['rss_high_water_mb'] = round(self.rss_high_water_mb, 1)
+        if self.peak_traced_mb is not None:
+            result['peak_traced_mb'] = round(self.peak_traced_mb, 3)
+        return result
+
+
+# Stages of the current run in the order they first ran, and the run
+# name, start time and profiler
+stages = OrderedDict()
+run = {'name': None, 'started': None, 'start': perf_counter(),
+       'profiler': None}
+
+
+def maxrss_to_mb(maxrss):
+    '''Converts a getrusage ru_maxrss to MB.'''
+    return maxrss * RSS_UNIT / (1024 * 1024)
+
+
+def peak_rss_mb():
+    '''Returns the peak resident memory of this process in MB.'''
+    return maxrss_to_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+@contextmanager
+def stage(name):
+    '''Context manager that times a block as the named stage and yields
+    its StageStats for the block to add records and bytes to. With
+    tracemalloc on, the peak traced memory since the block began is
+    kept; nested stages share one peak.'''
+    stats = stages.get(name)
+    if stats is None:
+        stats = stages[name] = StageStats(name)
+    tracing = tracemalloc.is_tracing()
+    if tracing and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    start = perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.wall += perf_counter() - start
+        stats.calls += 1
+        stats.rss_high_water_mb = max(stats.rss_high_water_mb,
+                                      peak_rss_mb())
+        if tracing:
+            traced = tracemalloc.get_traced_memory()[1] / 1e6
+            stats.peak_traced_mb = max(stats.peak_traced_mb or 0.0, traced)
+
+
+def _run_worker(func, *args):
+    '''Runs func(*args) with the stages cleared, as in a worker
+    process, and returns (result, the StageStats of the stages timed).'''
+    stages.clear()
+    result = func(*args)
+    return result, list(stages.values())
+
+
+def worker(func):
+    '''Wraps a module level function for a process pool so that it
+    returns its result with the stages it timed, for worker_result.'''
+    return partial(_run_worker, func)
+
+
+def worker_result(output):
+    '''Merges the stages of a worker() output into the stages of this
+    process and returns the result of the function.'''
+    result, worker_stages = output
+    for other in worker_stages:
+        stats = stages.get(other.name)
+        if stats is None:
+            stats = stages[other.name] = StageStats(other.name)
+        stats.merge(other)
+    return result
+
+
+def start_run(name, profile=False, trace_memory=False):
+    '''Starts a new run report, clearing any stages so far. Optionally
+    starts a cProfile profile and tracemalloc memory tracing.'''
+    stages.clear()
+    run['name'] = name
+    run['started'] = strftime('%Y-%m-%d %H:%M:%S')
+    run['start'] = perf_counter()
+    run['profiler'] = None
+    if trace_memory:
+        tracemalloc.start()
+    if profile:
+        import cProfile
+        run['profiler'] = cProfile.Profile()
+        run['profiler'].enable()
+
+
+def profile_top(profiler, num_functions=PROFILE_TOP):
+    '''Returns the functions of a cProfile profile with the most
+    cumulative time as a list of dicts.'''
+    import pstats
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, function), (_, calls, tottime, cumtime, _) in \
+            stats.stats.items():
+        rows.append(OrderedDict([
+            ('function', '{}:{}({})'.format(filename, line, function)),
+            ('calls', calls),
+            ('tottime', round(tottime, 6)),
+            ('cumtime', round(cumtime, 6))]))
+    rows.sort(key=lambda row: row['cumtime'], reverse=True)
+    return rows[:num_functions]
+
+
+def get_report():
+    '''Returns the run report as a dict: run name, start time, argv,
+    total wall time, peak RSS, a note on the stage fields and the
+    stages.'''
+    report = OrderedDict([('run', run['name']),
+                          ('started', run['started']),
+                          ('argv', sys.argv),
+                          ('wall', round(perf_counter() - run['start'], 6)),
+                          ('peak_rss_mb', round(peak_rss_mb(), 1))])
+    if tracemalloc.is_tracing():
+        report['peak_traced_mb'] = round(
+            tracemalloc.get_traced_memory()[1] / 1e6, 3)
+    report['note'] = STAGE_NOTE
+    report['stages'] = [stats.as_dict() for stats in stages.values()]
+    return report
+
+
+def write_report(report_filename):
+    '''Stops any profile and memory tracing and writes the run report
+    to a json file. A profile is also dumped to <report>.prof for
+    pstats or snakeviz and its top functions added to the report.'''
+    profiler = run['profiler']
+    if profiler is not None:
+        profiler.disable()
+    report = get_report()
+    if profiler is not None:
+        profiler.dump_stats(report_filename + '.prof')
+        report['profile'] = profile_top(profiler)
+        run['profiler'] = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    try:
+        with open(report_filename, 'w') as fo:
+            json.dump(report, fo, indent=2)
+            fo.write("\n")
+    except IOError:
+        print('Cannot open', report_filename)
+
+
+def add_report_arguments(parser):
+    '''Adds the --report, --profile and --trace-memory options to an
+    argparse parser.'''
+    parser.add_argument('--report',
+                        help='write a json run report of the stage times '
+                             'to this file')
+    parser.add_argument('--profile', action='store_true',
+                        help='also profile the run with cProfile '
+                             '(slower, needs --report)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also trace memory peaks with tracemalloc '
+                             '(slower, needs --report)')
+
+
+def start_from_args(name, args):
+    '''Starts a run report with the add_report_arguments options.'''
+    start_run(name, args.report is not None and args.profile,
+              args.report is not None and args.trace_memory)
+
+
+def finish_from_args(args):
+    '''Writes the run report if --report was given.'''
+    if args.report is not None:
+        write_report(args.report)
@@ -4,120 +4,292 @@
 database from fasta files and blastn data. This module was
 edited for python standards compliance using pep8.'''
 
-from shutil import copyfileobj
-from shutil import move
+from math import isclose
+from time import perf_counter
+import argparse
+import hashlib
 import os
+import re
 import sqlite3
 
-import pandas as pd
+from fasta_io import BUFSIZE
+from fasta_io import read_fasta
+from gzip_io import open_input
+from gzip_io import strip_gz
+from instrument import add_report_arguments
+from instrument import finish_from_args
+from instrument import stage
+from instrument import start_from_args
+from seq_pack import SEQ_FORMATS
+from seq_pack import encode_seq
 
 __author__ = "Jeffrey P Tomkins, PhD"
 __copyright__ = "Copyright 2016, Institute for Creation Research"
 __email__ = "jtomkins@icr.org"
 
 
-def add_seqfile_column(filename):
-    '''Adds the name of the seqfile as 10th column in a csv file.'''
-
-    seqfile_num = filename[4:7]
-    with open(filename, "r") as fi:
-        with open(filename.rstrip(".csv") + "_.csv", "w") as fo:
-            for line in fi:
-                fo.write(line.rstrip("\n") + "," + seqfile_num + "\n")
-
-
-def concat_files(concat_outfilename, file_extension):
-    '''Concatenates files in directory - outfile name and file extension
-    of target files to concat as args.'''
-
-    files = sorted([file for file in os.listdir('.')
-                    if file.endswith(file_extension)])
-
-    if not files:
-        print("No files with " + file_extension + " found!")
-
-    try:
-        fo = open(concat_outfilename, 'w')
-    except IOError:
-        print('Cannot open', concat_outfilename)
-
-    for file in files:
-        try:
-            fi = open(file, 'r')
-            copyfileobj(fi, fo)
-            fi.close()
-        except IOError:
-            print('Cannot open', file)
-    fo.close()
+# Names of the blastn csv files of the trace reads on homo and of the
+# non-hitters, e.g. pan_001_25k_on_homo.csv, with the seqfile id in
+# group 1. Other csv files in the same dirs, such as seqfile_stats
+# reports, are not blast data.
+blast_csv_pattern = re.compile(r'^pan_(\d{3})_.*_on_homo\.csv(\.gz)?$')
+nonhitter_csv_pattern = re.compile(r'^pan_(\d{3})_.*\.csv(\.gz)?$')
+
+# Column names of the db tables loaded from blastn csv and fasta data
+blast_names = ['qseqid', 'qstart', 'qend', 'mismatch', 'gapopen',
+               'pident', 'nident', 'length', 'qlen', 'seqfile']
+seq_names = ['gnl_num', 'dna_seq', 'seqfile']
+seq_year_names = ['seqfile_id', 'min_date', 'max_date']
+run_date_names = ['seqfile_id', 'run_date', 'num_traces']
+
+# Column names of the summary tables, in the order of summary_select
+# and histogram_select
+summary_names = ['seqfile', 'num_hits', 'avg_pident', 'min_pident',
+                 'avg_gapopen', 'avg_mismatch', 'avg_aln_len', 'avg_qlen',
+                 'avg_nident', 'sum_nident', 'num_seqs_99_8', 'perc_hits',
+                 'overall_ident']
+histogram_names = ['seqfile', 'pident_bin', 'num_hits', 'sum_pident',
+                   'sum_gapopen', 'sum_mismatch', 'sum_length',
+                   'sum_nident', 'sum_qlen']
+
+# Rows per executemany call and page cache size (negative is KiB)
+# used while bulk loading tables
+BATCH_SIZE = 10000
+LOAD_CACHE_SIZE = -512000
+
+# Number of trace reads in each seqfile, as used in chimp_trace_25k.sql
+SEQS_PER_FILE = 25000
+
+# Secondary indexes of each table for the queries in chimp_trace_25k.sql,
+# as (index name, columns). The blast table indexes cover the columns
+# aggregated by seqfile or in pident ranges, so those queries read only
+# the index. They are created after a bulk load rather than maintained
+# row by row during it. Primary keys are indexed by sqlite already.
+table_indexes = {
+    'chimp_seq_data': [
+        ('seqfile_idx_seq_data', '(seqfile)')],
+    'chimp_blast_on_homo': [
+        ('homo_seqfile_cover',
+         '(seqfile, pident, gapopen, mismatch, length, qlen, nident)'),
+        ('homo_pident_cover', '(pident, gapopen, mismatch, length)')],
+    'nonhitter_blast_on_chimp': [
+        ('pan_seqfile_cover', '(seqfile, pident, gapopen, mismatch)')]}
+
+# Indexes of earlier versions of the db that duplicate a primary key or
+# are covered by table_indexes
+old_indexes = ['gnl_num_idx', 'qseqid_idx_on_homo', 'qseqid_idx_on_pan',
+               'seqfile_idx_on_homo', 'seqfile_idx_on_pan']
+
+# Named sets of bin edges for the hit_bins and file_bins views: the
+# pident ranges of chimp_trace_25k.sql, 0.5% pident steps and the 90%
+# overall ident split of the blastn_proc final stats
+default_bin_edges = {
+    'aln_ranges': [60.0, 70.0, 80.0, 90.0, 100.0],
+    'pident_0.5': [60.0 + 0.5 * i for i in range(81)],
+    'overall_ident': [0.0, 90.0, 100.0]}
+
+# Csv fields loaded into the db as NULL
+NULL_VALUES = frozenset(['', 'NULL'])
 
 
 def fasta_to_csv(fasta_filename, out_csvfilename):
     '''Puts a fasta format file into a csv file with two cols:
     the first being the seq id and then the DNA seq.'''
 
-    def _get_fastadata(fastafile):
-        '''Makes a list of tuples, each with a list containing fasta
-        header data and a string containing DNA seq ([info], 'seq').'''
-        try:
-            with open(fastafile, 'r') as fi:
-                return [(part[0],
-                        part[2].replace('\n', ''))
-                        for part in
-                        [entry.partition('\n')
-                        for entry in fi.read().split('>')[1:]]]
-        except IOError:
-            print('Cannot open', fasta_file)
-
     try:
         with open(out_csvfilename, 'w') as fo:
-            for entry in _get_fastadata(fasta_filename):
+            for entry in read_fasta(fasta_filename):
                 fo.write(entry[0].split()[0] + "," + entry[1] + "\n")
     except IOError:
         print('Cannot open', out_csvfilename)
 
 
-def csv_to_db(db_name, csvfile, db_table, names):
-    '''Populates an sqlite table from a csv file using the pandas library.'''
+def set_load_pragmas(conn):
+    '''Sets fast pragmas on a connection for a bulk load. The write
+    ahead log with normal syncing keeps the db consistent if a load
+    crashes, losing at most the transaction in progress.'''
+    conn.execute('pragma journal_mode = wal')
+    conn.execute('pragma synchronous = normal')
+    conn.execute('pragma cache_size = ' + str(LOAD_CACHE_SIZE))
+
+
+def restore_pragmas(conn):
+    '''Restores the default, safe pragmas after a bulk load.'''
+    conn.execute('pragma journal_mode = delete')
+    conn.execute('pragma synchronous = full')
+    conn.execute('pragma cache_size = -2000')
+
+
+def insert_rows(conn, db_table, names, rows, batch_size=BATCH_SIZE):
+    '''Inserts an iterable of row sequences into an sqlite table with
+    executemany in batches of batch_size rows. Does not commit.
+    Returns the number of rows inserted.'''
+    sql = ('insert into ' + db_table + ' (' + ','.join(names) +
+           ') values (' + ','.join('?' * len(names)) + ')')
+    num_rows = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            conn.executemany(sql, batch)
+            num_rows += len(batch)
+            batch = []
+    if batch:
+        conn.executemany(sql, batch)
+        num_rows += len(batch)
+    return num_rows
+
+
+def read_csv_rows(csvfile):
+    '''Generator that yields each row of a csv file as a list, with
+    empty and 'NULL' fields as None. The csv files loaded here are
+    written without quoting, so rows are simply split on commas. Gzip
+    and BGZF files are decompressed as they are read.'''
+    try:
+        fi = open_input(csvfile, 'rt', BUFSIZE)
+    except IOError:
+        print('Cannot open', csvfile)
+        return
+
+    with fi:
+        for line in fi:
+            row = line.rstrip('\n').split(',')
+            if NULL_VALUES.isdisjoint(row):
+                yield row
+            else:
+                yield [None if field in NULL_VALUES else field
+                       for field in row]
+
+
+def bulk_rows_to_db(db_name, loads):
+    '''Populates sqlite tables from row iterables over one connection
+    and in one transaction. loads is a list of (db_table, names, rows)
+    tuples. Prints the rows/sec for each table.'''
     conn = sqlite3.connect(db_name)
+    set_load_pragmas(conn)
+    try:
+        for db_table, names, rows in loads:
+            start = perf_counter()
+            num_rows = insert_rows(conn, db_table, names, rows)
+            elapsed = perf_counter() - start
+            print("{}: {:,} rows in {:.1f} s ({:,.0f} rows/sec)".format(
+                  db_table, num_rows, elapsed,
+                  num_rows / elapsed if elapsed else 0))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        restore_pragmas(conn)
+        conn.close()
+
+
+def bulk_csv_to_db(db_name, loads):
+    '''Populates sqlite tables from csv files over one connection and
+    in one transaction. loads is a list of (csvfile, db_table, names)
+    tuples.'''
+    bulk_rows_to_db(db_name, [(db_table, names, read_csv_rows(csvfile))
+                              for csvfile, db_table, names in loads])
 
-    df = pd.read_csv(csvfile, header=None)
-    df.columns = names
-    df.to_sql(db_table, conn, flavor='sqlite',
-              schema=None, if_exists='append', index=None,
-              index_label=None, chunksize=None, dtype=None)
 
-    conn.close()
+def csv_to_db(db_name, csvfile, db_table, names):
+    '''Populates an sqlite table from a csv file.'''
+    bulk_csv_to_db(db_name, [(csvfile, db_table, names)])
+
+
+def get_seqfile_id(filename):
+    '''Returns the seqfile id of a blastn csv or fasta file, e.g.
+    '001' for pan_001_25k_on_homo.csv.'''
+    return os.path.basename(filename)[4:7]
+
+
+def pair_by_seqfile(csvfiles, fastafiles):
+    '''Returns a list of (csv file, fasta file) pairs of the files with
+    the same seqfile id, in csv file order. Files with no partner are
+    printed and left out, so one missing file does not shift the
+    pairs as pairing the sorted lists by position would.'''
+    fasta_by_id = {}
+    for fastafile in fastafiles:
+        fasta_by_id.setdefault(get_seqfile_id(fastafile), fastafile)
+    pairs = []
+    for csvfile in csvfiles:
+        fastafile = fasta_by_id.pop(get_seqfile_id(csvfile), None)
+        if fastafile is None:
+            print("No fasta file for", csvfile)
+        else:
+            pairs.append((csvfile, fastafile))
+    for fastafile in sorted(fasta_by_id.values()):
+        print("No blastn csv file for", fastafile)
+    return pairs
+
+
+def list_files(directory, file_extension):
+    '''Returns a sorted list of the paths of files in directory with
+    the file extension, or the extension and .gz.'''
+    files = sorted([os.path.join(directory, file)
+                    for file in os.listdir(directory)
+                    if strip_gz(file).endswith(file_extension)])
+    if not files:
+        print("No files with *" + file_extension + " found! in", directory)
+    return files
 
 
-# CSV file prep and development of the chimp_trace_25k database
-if __name__ == '__main__':
+def list_blast_files(directory, pattern=blast_csv_pattern):
+    '''Returns a sorted list of the paths of the blastn csv files in
+    directory whose names match pattern, e.g. blast_csv_pattern.'''
+    files = sorted([os.path.join(directory, file)
+                    for file in os.listdir(directory)
+                    if pattern.match(file)])
+    if not files:
+        print("No blastn csv files found! in", directory)
+    return files
+
+
+def blast_rows(csvfiles):
+    '''Generator that yields the rows of each blastn csv file with
+    the seqfile id of the file added as the 10th column.'''
+    for csvfile in csvfiles:
+        seqfile = get_seqfile_id(csvfile)
+        for row in read_csv_rows(csvfile):
+            row.append(seqfile)
+            yield row
+
 
-    # Target directory constants and db name
-    DIR1 = '/Users/jtomkins/data/chimp_trace/25k_test'
-    DIR2 = '/Users/jtomkins/data/chimp_trace/25k_test/non_hitters/on_chimp'
-    DB_NAME = 'chimp_trace_25k.sqlite'
+def fasta_rows(fastafiles, seq_format='text'):
+    '''Generator that yields a (seq id, DNA seq, seqfile id) row for
+    each record in each fasta file. The DNA seq is encoded in one of
+    the seq_pack.SEQ_FORMATS.'''
+    for fastafile in fastafiles:
+        seqfile = get_seqfile_id(fastafile)
+        for header, seq in read_fasta(fastafile):
+            yield header.split()[0], encode_seq(seq, seq_format), seqfile
 
-    # Directory safety check - should be in DIR1
-    if os.getcwd() != DIR1:
-        print('Not in proper directory!')
-        exit()
 
-    # Create the chimp_trace_25k db and it's tables.'''
-    conn = sqlite3.connect(DB_NAME)
+def create_tables(db_name):
+    '''Creates the chimp_trace_25k db and it's tables.'''
+    conn = sqlite3.connect(db_name)
     c = conn.cursor()
 
-    c.execute('create table chimp_seq_data '
+    c.execute('create table if not exists chimp_seq_data '
               '(gnl_num varchar(17) not null '
               ',dna_seq text not null '
+              ',seqfile varchar(3) not null '
               ',primary key (gnl_num))')
 
-    c.execute('create table chimp_seq_year '
+    c.execute('create table if not exists chimp_seq_year '
               '(seqfile_id varchar(3) not null '
               ',min_date varchar(4) '
               ',max_date varchar(4) '
               ',primary key (seqfile_id))')
 
-    c.execute('create table chimp_blast_on_homo '
+    # Number of traces of each seqfile by run date, from get_xml_seqyear
+    c.execute('create table if not exists chimp_seq_run_dates '
+              '(seqfile_id varchar(3) not null '
+              ',run_date varchar(10) not null '
+              ',num_traces integer not null '
+              ',primary key (seqfile_id, run_date))')
+
+    c.execute('create table if not exists chimp_blast_on_homo '
               '(qseqid varchar(17) not null '
               ',qstart integer not null '
               ',qend integer not null '
@@ -130,7 +302,7 @@ if __name__ == '__main__':
               ',seqfile varchar(3) not null '
               ',primary key (qseqid))')
 
-    c.execute('create table nonhitter_blast_on_chimp '
+    c.execute('create table if not exists nonhitter_blast_on_chimp '
               '(qseqid varchar(17) not null '
               ',qstart integer not null '
               ',qend integer not null '
@@ -143,67 +315,499 @@ if __name__ == '__main__':
               ',seqfile varchar(3) not null '
               ',primary key (qseqid))')
 
-    c.execute('create index gnl_num_idx on chimp_seq_data (gnl_num)')
-    c.execute('create index qseqid_idx_on_homo on chimp_blast_on_homo (qseqid)')
-    c.execute('create index qseqid_idx_on_pan on nonhitter_blast_on_chimp (qseqid)')
+    c.execute('create table if not exists ingest_manifest '
+              '(path text not null '
+              ',db_table text not null '
+              ',size integer not null '
+              ',mtime real not null '
+              ',hash varchar(40) not null '
+              ',num_rows integer not null '
+              ',primary key (path))')
+
+    c.execute('create table if not exists seqfile_summary '
+              '(seqfile varchar(3) not null '
+              ',num_hits integer not null '
+              ',avg_pident real '
+              ',min_pident real '
+              ',avg_gapopen real '
+              ',avg_mismatch real '
+              ',avg_aln_len real '
+              ',avg_qlen real '
+              ',avg_nident real '
+              ',sum_nident integer '
+              ',num_seqs_99_8 integer not null '
+              ',perc_hits integer not null '
+              ',overall_ident real '
+              ',primary key (seqfile))')
+
+    # Hit counts and sums in 0.1% pident bins - pident_bin is pident
+    # in tenths of a percent rounded down
+    c.execute('create table if not exists pident_histogram '
+              '(seqfile varchar(3) not null '
+              ',pident_bin integer not null '
+              ',num_hits integer not null '
+              ',sum_pident real not null '
+              ',sum_gapopen integer not null '
+              ',sum_mismatch integer not null '
+              ',sum_length integer not null '
+              ',sum_nident integer not null '
+              ',sum_qlen integer not null '
+              ',primary key (seqfile, pident_bin))')
+
+    # Bin i of a set of edges holds bin_lo <= value < bin_hi, the last
+    # bin (closed = 1) also holds bin_hi
+    c.execute('create table if not exists bin_edges '
+              '(name text not null '
+              ',bin_lo real not null '
+              ',bin_hi real not null '
+              ',closed integer not null '
+              ',primary key (name, bin_lo))')
+
+    c.execute('create view if not exists hit_bins as ' + hit_bins_select)
+    c.execute('create view if not exists file_bins as ' + file_bins_select)
+
+    if c.execute('select 1 from bin_edges limit 1').fetchone() is None:
+        for name, edges in sorted(default_bin_edges.items()):
+            insert_bin_edges(conn, name, edges)
+
+    for index_name in old_indexes:
+        c.execute('drop index if exists ' + index_name)
 
     conn.commit()
     conn.close()
 
-    # Add the seqfile name as 10th column in csv files
-    csvfiles1 = [file for file in os.listdir(DIR1)
-                 if file.endswith('.csv')]
-    csvfiles2 = [file for file in os.listdir(DIR2)
-                 if file.endswith('.csv')]
-
-    if not csvfiles1:
-        print("No files with *.csv found! in", DIR1)
-        
-    if not csvfiles2:
-        print("No files with *.csv found! in", DIR2)
-
-    os.chdir(DIR1)
-    for file in csvfiles1:
-        add_seqfile_column(file)
-
-    os.chdir(DIR2)
-    for file in csvfiles2:
-        add_seqfile_column(file)
-
-    # Process files in target directories based on file extension
-    os.chdir(DIR1)
-    concat_files('concat_chimp_blast_on_homo.csv', '_.csv')
-    concat_files('concat_fasta_data.fa', '.fa')
-    fasta_to_csv('concat_fasta_data.fa', 'concat_fasta_data.csv')
-    os.chdir(DIR2)
-    concat_files('concat_nonhitter_blastdat.csv', '_.csv')
-
-    # Populate the chimp_blast_on_homo table
-    os.chdir(DIR1)
-    names1 = ['qseqid', 'qstart', 'qend', 'mismatch', 'gapopen',
-              'pident', 'nident', 'length', 'qlen', 'seqfile']
-    csv_to_db(DB_NAME, 'concat_chimp_blast_on_homo.csv', 'chimp_blast_on_homo',
-              names=names1)
-
-    # Populate the chimp_seq_data table
-    names2 = ['gnl_num', 'dna_seq']
-    csv_to_db(DB_NAME, 'concat_fasta_data.csv', 'chimp_seq_data', names=names2)
-
-    # Populate the chimp_seq_year table from csv file created by
-    # get_xml_seqyear.py script.
-    names3 = ['seqfile_id', 'min_date', 'max_date']
-    csv_to_db(DB_NAME, 'seq_year_csv', 'chimp_seq_year', names=names3)
-
-    # Populate the nonhitter_blast_on_chimp table from csv file created by
-    move(DIR2 + '/concat_nonhitter_blastdat.csv', DIR1 + '/concat_nonhitter_blastdat.csv')
-    names4 = ['qseqid', 'qstart', 'qend', 'mismatch', 'gapopen',
-              'pident', 'nident', 'length', 'qlen', 'seqfile']
-    csv_to_db(DB_NAME, 'concat_nonhitter_blastdat.csv',
-            'nonhitter_blast_on_chimp', names=names4)
-
-    # Clean up the tmp files
-    for file in os.listdir():
-        if file.endswith('_.csv') or file.startswith('concat_'):
-            os.unlink(file)
-            
-    exit()
+
+# Count and averages of the hits in each bin of pident, in one pass
+# over the homo_pident_cover index
+hit_bins_select = (
+    'select e.name, e.bin_lo, e.bin_hi '
+    ',count(h.pident) as num_hits '
+    ',avg(h.pident) as avg_pident '
+    ',avg(h.gapopen) as avg_gapopen '
+    ',avg(h.mismatch) as avg_mismatch '
+    ',avg(h.length) as avg_aln_len '
+    'from bin_edges e left join chimp_blast_on_homo h '
+    '  on h.pident between e.bin_lo and e.bin_hi '
+    '  and (h.pident < e.bin_hi or e.closed) '
+    'group by e.name, e.bin_lo, e.bin_hi')
+
+# Number of seqfiles and their averages in each bin of overall ident
+file_bins_select = (
+    'select e.name, e.bin_lo, e.bin_hi '
+    ',count(s.seqfile) as num_files '
+    ',avg(s.avg_pident) as avg_pident '
+    ',avg(s.avg_gapopen) as avg_gapopen '
+    ',avg(s.avg_mismatch) as avg_mismatch '
+    ',avg(s.avg_aln_len) as avg_aln_len '
+    ',avg(s.perc_hits) as avg_perc_hits '
+    ',avg(s.overall_ident) as overall_ident '
+    'from bin_edges e left join seqfile_summary s '
+    '  on s.overall_ident between e.bin_lo and e.bin_hi '
+    '  and (s.overall_ident < e.bin_hi or e.closed) '
+    'group by e.name, e.bin_lo, e.bin_hi')
+
+
+def bin_edge_rows(name, edges):
+    '''Returns the (name, bin_lo, bin_hi, closed) bin_edges rows of a
+    named set of ascending bin edges.'''
+    return [(name, lo, hi, int(i == len(edges) - 2))
+            for i, (lo, hi) in enumerate(zip(edges, edges[1:]))]
+
+
+def insert_bin_edges(conn, name, edges):
+    '''Replaces a named set of bin edges in the bin_edges table. Does
+    not commit.'''
+    conn.execute('delete from bin_edges where name = ?', (name,))
+    conn.executemany('insert into bin_edges (name, bin_lo, bin_hi, closed) '
+                     'values (?, ?, ?, ?)', bin_edge_rows(name, edges))
+
+
+def set_bin_edges(db_name, name, edges):
+    '''Sets a named set of ascending bin edges for the hit_bins and
+    file_bins views, e.g. set_bin_edges(db, 'pident_0.1', [60.0, 60.1,
+    ..., 100.0]) and then select * from hit_bins where name =
+    'pident_0.1'.'''
+    conn = sqlite3.connect(db_name)
+    try:
+        insert_bin_edges(conn, name, edges)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def drop_indexes(conn, db_table):
+    '''Drops the table_indexes of a table before a bulk load.'''
+    for index_name, _ in table_indexes.get(db_table, []):
+        conn.execute('drop index if exists ' + index_name)
+    conn.commit()
+
+
+def create_indexes(conn, db_table):
+    '''Creates the missing table_indexes of a table and updates its
+    query planner stats if any were created.'''
+    existing = set(row[0] for row in
+                   conn.execute('select name from sqlite_master '
+                                 'where type = ? and tbl_name = ?',
+                                 ('index', db_table)))
+    created = False
+    for index_name, columns in table_indexes.get(db_table, []):
+        if index_name in existing:
+            continue
+        start = perf_counter()
+        with stage('create index'):
+            conn.execute('create index ' + index_name + ' on ' +
+                         db_table + ' ' + columns)
+        print("{}: created index {} in {:.1f} s".format(
+              db_table, index_name, perf_counter() - start))
+        created = True
+    if created:
+        with stage('analyze'):
+            conn.execute('analyze ' + db_table)
+    conn.commit()
+
+
+def is_empty(conn, db_table):
+    '''Checks whether a db table has no rows.'''
+    return conn.execute('select 1 from ' + db_table +
+                        ' limit 1').fetchone() is None
+
+
+# Per seqfile aggregates of chimp_blast_on_homo, the same as the views
+# in chimp_trace_25k.sql
+summary_select = (
+    'select seqfile '
+    ',count(*) '
+    ',avg(pident) '
+    ',min(pident) '
+    ',avg(gapopen) '
+    ',avg(mismatch) '
+    ',avg(length) '
+    ',avg(qlen) '
+    ',avg(nident) '
+    ',sum(nident) '
+    ',sum(pident > 99.7) '
+    ',count(*)*100/' + str(SEQS_PER_FILE) + ' '
+    ',(sum(nident) / (' + str(SEQS_PER_FILE) + ' * avg(qlen)))*100 '
+    'from chimp_blast_on_homo ')
+
+histogram_select = (
+    'select seqfile '
+    ',cast(round(pident * 1000) as integer) / 100 as pident_bin '
+    ',count(*) '
+    ',sum(pident) '
+    ',sum(gapopen) '
+    ',sum(mismatch) '
+    ',sum(length) '
+    ',sum(nident) '
+    ',sum(qlen) '
+    'from chimp_blast_on_homo ')
+
+
+def refresh_summaries(conn, db_table, seqfile):
+    '''Recomputes the seqfile_summary and pident_histogram rows of a
+    seqfile after its chimp_blast_on_homo rows change. Does nothing for
+    other tables. Does not commit.'''
+    if db_table != 'chimp_blast_on_homo':
+        return
+    conn.execute('delete from seqfile_summary where seqfile = ?', (seqfile,))
+    conn.execute('delete from pident_histogram where seqfile = ?',
+                 (seqfile,))
+    conn.execute('insert into seqfile_summary ' + summary_select +
+                 'where seqfile = ? group by seqfile', (seqfile,))
+    conn.execute('insert into pident_histogram ' + histogram_select +
+                 'where seqfile = ? group by seqfile, pident_bin',
+                 (seqfile,))
+
+
+def fill_summaries(conn):
+    '''Recomputes the seqfile_summary and pident_histogram tables for
+    every seqfile over a connection and commits.'''
+    try:
+        with stage('summaries'):
+            conn.execute('delete from seqfile_summary')
+            conn.execute('delete from pident_histogram')
+            conn.execute('insert into seqfile_summary ' + summary_select +
+                         'group by seqfile')
+            conn.execute('insert into pident_histogram ' +
+                         histogram_select + 'group by seqfile, pident_bin')
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def summaries_missing(conn):
+    '''Checks whether any seqfile loaded into chimp_blast_on_homo has
+    no seqfile_summary row, as after a bulk load or one interrupted
+    before its summaries were filled.'''
+    loaded = set(get_seqfile_id(row[0]) for row in
+                 conn.execute('select path from ingest_manifest '
+                              'where db_table = ? and num_rows > 0',
+                              ('chimp_blast_on_homo',)))
+    summarized = set(row[0] for row in
+                     conn.execute('select seqfile from seqfile_summary'))
+    return not loaded <= summarized
+
+
+def rebuild_summaries(db_name):
+    '''Recomputes the seqfile_summary and pident_histogram tables for
+    every seqfile, e.g. for a db loaded before they were added.'''
+    conn = sqlite3.connect(db_name)
+    try:
+        fill_summaries(conn)
+    finally:
+        conn.close()
+
+
+def check_summaries(db_name, rel_tol=1e-9):
+    '''Compares the seqfile_summary and pident_histogram tables with
+    the live aggregates of chimp_blast_on_homo. Prints each mismatch
+    and returns True if they all agree.'''
+    conn = sqlite3.connect(db_name)
+    try:
+        checks = [('seqfile_summary',
+                   conn.execute('select * from seqfile_summary').fetchall(),
+                   conn.execute(summary_select +
+                                'group by seqfile').fetchall(), 1),
+                  ('pident_histogram',
+                   conn.execute('select * from pident_histogram').fetchall(),
+                   conn.execute(histogram_select +
+                                'group by seqfile, pident_bin').fetchall(),
+                   2)]
+    finally:
+        conn.close()
+
+    consistent = True
+    for db_table, stored, live, key_len in checks:
+        stored = dict((row[:key_len], row[key_len:]) for row in stored)
+        live = dict((row[:key_len], row[key_len:]) for row in live)
+        for key in sorted(set(stored) | set(live)):
+            if key not in stored or key not in live:
+                consistent = False
+                print(db_table, key, "stored" if key in stored else "live",
+                      "only")
+                continue
+            for stored_value, live_value in zip(stored[key], live[key]):
+                if stored_value == live_value:
+                    continue
+                if (stored_value is None or live_value is None or
+                        not isclose(stored_value, live_value,
+                                    rel_tol=rel_tol)):
+                    consistent = False
+                    print(db_table, key, "stored", stored[key], "live",
+                          live[key])
+                    break
+    print("Summary tables", "consistent" if consistent else "INCONSISTENT",
+          "with chimp_blast_on_homo")
+    return consistent
+
+
+def file_hash(filename):
+    '''Returns the sha1 hex digest of the contents of a file.'''
+    digest = hashlib.sha1()
+    with stage('file hash') as st, open(filename, 'rb') as fi:
+        for block in iter(lambda: fi.read(BUFSIZE), b''):
+            digest.update(block)
+            st.add(num_bytes=len(block))
+    return digest.hexdigest()
+
+
+def is_unchanged(conn, path):
+    '''Checks a file against its entry in the ingest_manifest table.
+    Size and mtime are compared first and the contents are only hashed
+    when they differ. Returns (unchanged, size, mtime, hash).'''
+    stat = os.stat(path)
+    entry = conn.execute('select size, mtime, hash from ingest_manifest '
+                         'where path = ?', (path,)).fetchone()
+    if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime):
+        return True, stat.st_size, stat.st_mtime, entry[2]
+
+    digest = file_hash(path)
+    if entry is not None and entry[2] == digest:
+        # Touched but not changed - just record the new mtime
+        conn.execute('update ingest_manifest set size = ?, mtime = ? '
+                     'where path = ?', (stat.st_size, stat.st_mtime, path))
+        conn.commit()
+        return True, stat.st_size, stat.st_mtime, digest
+    return False, stat.st_size, stat.st_mtime, digest
+
+
+def load_file(conn, path, db_table, names, rows, seqfile=None, bulk=False):
+    '''Replaces the rows of one source file in a db table in a single
+    transaction: rows with the seqfile id are deleted (all rows if
+    seqfile is None), the new rows inserted and the file recorded in
+    the ingest_manifest table. With bulk, for a table that was empty
+    when the load started, the delete and the summary refresh are
+    skipped. Skips files that are unchanged since they were last
+    loaded. Returns the number of rows inserted.'''
+    unchanged, size, mtime, digest = is_unchanged(conn, path)
+    if unchanged:
+        print("{}: {} unchanged, skipped".format(db_table, path))
+        return 0
+
+    start = perf_counter()
+    try:
+        with stage('load ' + db_table) as st:
+            if seqfile is None:
+                conn.execute('delete from ' + db_table)
+            elif not bulk:
+                conn.execute('delete from ' + db_table +
+                             ' where seqfile = ?', (seqfile,))
+            num_rows = insert_rows(conn, db_table, names, rows)
+            if not bulk:
+                refresh_summaries(conn, db_table, seqfile)
+            conn.execute('insert or replace into ingest_manifest '
+                         '(path, db_table, size, mtime, hash, num_rows) '
+                         'values (?, ?, ?, ?, ?, ?)',
+                         (path, db_table, size, mtime, digest, num_rows))
+            conn.commit()
+            st.add(num_rows, size)
+    except Exception:
+        conn.rollback()
+        raise
+    elapsed = perf_counter() - start
+    print("{}: {} {:,} rows in {:.1f} s ({:,.0f} rows/sec)".format(
+          db_table, path, num_rows, elapsed,
+          num_rows / elapsed if elapsed else 0))
+    return num_rows
+
+
+def remove_missing(conn, db_table, paths):
+    '''Deletes the rows and manifest entries of files previously
+    loaded into a db table that are not in paths.'''
+    loaded = conn.execute('select path from ingest_manifest '
+                          'where db_table = ?', (db_table,)).fetchall()
+    for (path,) in loaded:
+        if path in paths:
+            continue
+        try:
+            seqfile = get_seqfile_id(path)
+            conn.execute('delete from ' + db_table + ' where seqfile = ?',
+                         (seqfile,))
+            refresh_summaries(conn, db_table, seqfile)
+            conn.execute('delete from ingest_manifest where path = ?',
+                         (path,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print("{}: {} no longer present, removed".format(db_table, path))
+
+
+def ingest(db_name, blast_dir, nonhitter_dir, seq_year_csv,
+           seq_format='text'):
+    '''Populates the db tables from the source files: the blastn csv
+    and fasta files in blast_dir, the non-hitter blastn csv files in
+    nonhitter_dir and the csv file created by the get_xml_seqyear.py
+    script. Each file is read once with no intermediate files written
+    and loaded in its own transaction, so only new or changed files
+    are loaded when the db is rebuilt and an interrupted build can be
+    resumed. A table that is empty is bulk loaded with its indexes
+    dropped, and they are created once its files are in. DNA seqs are
+    stored in seq_format, one of the
+    seq_pack.SEQ_FORMATS - packed seqs are read back with the seq_pack
+    accessors.'''
+    fastafiles = [file for file in list_files(blast_dir, '.fa')
+                  if not strip_gz(file).endswith('_non_hitters.fa')]
+    sources = [('chimp_blast_on_homo', blast_names, blast_rows,
+                list_blast_files(blast_dir)),
+               ('chimp_seq_data', seq_names,
+                lambda files: fasta_rows(files, seq_format), fastafiles),
+               ('nonhitter_blast_on_chimp', blast_names, blast_rows,
+                list_blast_files(nonhitter_dir, nonhitter_csv_pattern))]
+
+    conn = sqlite3.connect(db_name)
+    set_load_pragmas(conn)
+    try:
+        for db_table, names, get_rows, files in sources:
+            paths = [os.path.abspath(file) for file in files]
+            bulk = is_empty(conn, db_table)
+            if bulk:
+                drop_indexes(conn, db_table)
+            else:
+                create_indexes(conn, db_table)
+            remove_missing(conn, db_table, paths)
+            for path in paths:
+                load_file(conn, path, db_table, names, get_rows([path]),
+                          get_seqfile_id(path), bulk)
+            create_indexes(conn, db_table)
+        if summaries_missing(conn):
+            fill_summaries(conn)
+        if os.path.exists(seq_year_csv):
+            load_file(conn, os.path.abspath(seq_year_csv), 'chimp_seq_year',
+                      seq_year_names, read_csv_rows(seq_year_csv))
+        else:
+            print('Cannot open', seq_year_csv)
+    finally:
+        restore_pragmas(conn)
+        conn.close()
+
+
+def ingest_seqfile(db_name, csvfile, fastafile, seq_format='text'):
+    '''Loads the blastn csv file and fasta file of one seqfile into the
+    chimp_blast_on_homo and chimp_seq_data tables, each in its own
+    transaction, and refreshes the seqfile's summary rows. The tables'
+    indexes are created first if missing, so rows are added to them as
+    they load. Returns the number of (blast, seq) rows inserted, 0 for
+    a file that is unchanged since it was last loaded.'''
+    conn = sqlite3.connect(db_name)
+    set_load_pragmas(conn)
+    try:
+        num_rows = []
+        for db_table, names, rows, file in (
+                ('chimp_blast_on_homo', blast_names,
+                 blast_rows([csvfile]), csvfile),
+                ('chimp_seq_data', seq_names,
+                 fasta_rows([fastafile], seq_format), fastafile)):
+            create_indexes(conn, db_table)
+            num_rows.append(load_file(conn, os.path.abspath(file), db_table,
+                                      names, rows, get_seqfile_id(file)))
+        return tuple(num_rows)
+    finally:
+        restore_pragmas(conn)
+        conn.close()
+
+
+def add_arguments(parser):
+    '''Adds the command line options of the db build to an argparse
+    parser.'''
+    parser.add_argument('blast_dir',
+                        help='dir of blastn on homo csv and fasta files')
+    parser.add_argument('nonhitter_dir',
+                        help='dir of non-hitter blastn on chimp csv files')
+    parser.add_argument('--db', default='chimp_trace_25k.sqlite',
+                        help='sqlite db file (default chimp_trace_25k.sqlite)')
+    parser.add_argument('--seq-year',
+                        help='seqfile year csv file from get_xml_seqyear.py '
+                             '(default seq_year_csv in blast_dir)')
+    parser.add_argument('--seq-format', choices=SEQ_FORMATS, default='text',
+                        help='storage format of chimp_seq_data.dna_seq '
+                             '(default text)')
+    parser.add_argument('--check-summary', action='store_true',
+                        help='check the seqfile summary tables against '
+                             'the live aggregates after loading')
+    add_report_arguments(parser)
+
+
+def main(args):
+    '''Builds or updates the db with add_arguments args. Returns 1 if
+    the summary check fails, otherwise 0.'''
+    seq_year_csv = args.seq_year
+    if seq_year_csv is None:
+        seq_year_csv = os.path.join(args.blast_dir, 'seq_year_csv')
+
+    start_from_args('make_db', args)
+    create_tables(args.db)
+    ingest(args.db, args.blast_dir, args.nonhitter_dir, seq_year_csv,
+           args.seq_format)
+    consistent = not args.check_summary or check_summaries(args.db)
+    finish_from_args(args)
+    return 0 if consistent else 1
+
+
+# Development of the chimp_trace_25k database
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    exit(main(parser.parse_args()))
@@ -1,54 +1,124 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3.5
 """parse_multi_fasta.py
 	Creator :     Jeff Tomkins <jtomkins@icr.org>
-	Create date :  April 27, 2015 
+	Create date :  April 27, 2015
 	Description :  Selects 25000 random seqs and parses into new fasta file.
 	Modifications : JP Tomkins, improved filename var usage, 11/16/2015
+	                Python 3, single pass reservoir sampling of one or
+	                more subsets, gzip input and buffered output,
+	                BGZF input and compressed output
 """
 
-from __future__ import print_function
-import sys
+from math import exp
+from math import floor
+from math import log
+import argparse
+import itertools
 import random
+import sys
+
+from fasta_io import read_fasta
+from fasta_io import write_fasta
+
+
+def long_records(fastafile, min_len=100):
+    '''Generator that yields the (header, seq) records of a fasta file
+    with seqs of min_len bases or more.'''
+    for record in read_fasta(fastafile):
+        if len(record[1]) >= min_len:
+            yield record
+
+
+def reservoir_sample(records, k, rng=random):
+    '''Returns a uniform random sample of k items from an iterable in
+    a single pass, keeping only k items in memory (Algorithm L, Li
+    1994). Returns all the items if there are fewer than k.'''
+    records = iter(records)
+    reservoir = list(itertools.islice(records, k))
+    if len(reservoir) < k:
+        return reservoir
 
-from Bio import SeqIO
+    # 1 - random() is in (0, 1] so log() is always defined
+    w = exp(log(1.0 - rng.random()) / k)
+    while True:
+        skip = floor(log(1.0 - rng.random()) / log(1.0 - w)) if w < 1 else 0
+        # Consume skip items and take the next one
+        record = next(itertools.islice(records, skip, None), None)
+        if record is None:
+            return reservoir
+        reservoir[rng.randrange(k)] = record
+        w *= exp(log(1.0 - rng.random()) / k)
 
 
-args = sys.argv[1:]
+def subset_filenames(in_filename, num_records, num_subsets=1,
+                     compress=False):
+    '''Returns the new fasta file names for the subsets, e.g.
+    pan_001_25000_seqs.fa for pan_001.fa, or pan_001_25000_seqs.fa to
+    pan_101_25000_seqs.fa for pan.fa with 101 subsets. With compress
+    the names end in .fa.gz.'''
+    base = in_filename
+    if base.endswith('.gz'):
+        base = base[:-3]
+    base = base.rsplit('.', 1)[0]
+    ext = "_seqs.fa.gz" if compress else "_seqs.fa"
+    if num_subsets == 1:
+        return [base + "_" + str(num_records) + ext]
+    return [base + "_{:03d}_".format(i) + str(num_records) + ext
+            for i in range(1, num_subsets + 1)]
 
-if len(args) != 2 :
-    print("Error!  2 args: fasta file and number of seqs for new fasta file")
-    sys.exit()
-    
-in_filename = args[0]
-num_records = int(args[1])
-new_filename = in_filename.rsplit('.',1)[0] + "_" + str(num_records) + "_seqs.fa"
 
-#Open files for read/write
-fi = open(in_filename, 'rU')
-fo = open(new_filename, 'w')
+def parse_subsets(in_filename, num_records, num_subsets=1, min_len=100,
+                  seed=None, compress=False):
+    '''Draws num_subsets disjoint random subsets of num_records seqs of
+    min_len bases or more from a fasta file in one pass, writes each
+    to a new fasta file, BGZF compressed with compress, and returns the
+    new file names. Returns None if the file has too few seqs.'''
+    rng = random.Random(seed)
+    needed = num_records * num_subsets
+    sample = reservoir_sample(long_records(in_filename, min_len),
+                              needed, rng)
 
-#Parse individual fasta records into a list
-records = list(SeqIO.parse(fi, "fasta"))
+    # Make sure there are enough seqs
+    if len(sample) < needed:
+        print("Error! Need a fasta file of at least", needed, "seqs of",
+              min_len, "bases or more!")
+        return None
 
-#Only use sequences of 100 bases or more
-records = [rec for rec in records if len(rec) >= 100]
+    # Randomize the order, then split into subsets
+    rng.shuffle(sample)
+    filenames = subset_filenames(in_filename, num_records, num_subsets,
+                                 compress)
+    for i, filename in enumerate(filenames):
+        write_fasta(filename,
+                    sample[i * num_records:(i + 1) * num_records])
+    return filenames
 
-#Make sure there are enough seqs
-if len(records) <= 25000:
-    print("Error! Need a fasta file of at least 25,000 seqs!")
-    sys.exit()
 
-#Randomize
-random.shuffle(records)
+if __name__ == '__main__':
 
-#Get specified number of fasta records and print to new file
-for i in records[0:num_records] :
-	SeqIO.write(i, fo, "fasta")
+    parser = argparse.ArgumentParser(
+        description='Selects random seqs and parses into new fasta files.')
+    parser.add_argument('in_filename',
+                        help='fasta file, may be gzip or BGZF compressed')
+    parser.add_argument('num_records', type=int,
+                        help='number of seqs for each new fasta file')
+    parser.add_argument('--subsets', type=int, default=1,
+                        help='number of disjoint subsets to draw (default 1)')
+    parser.add_argument('--min-len', type=int, default=100,
+                        help='only use seqs of this many bases or more '
+                             '(default 100)')
+    parser.add_argument('--seed', type=int,
+                        help='random seed for a repeatable sample')
+    parser.add_argument('--compress', action='store_true',
+                        help='write BGZF compressed .fa.gz files')
+    args = parser.parse_args()
 
-#Print the new file name
-print("New file: ", new_filename)
+    new_filenames = parse_subsets(args.in_filename, args.num_records,
+                                  args.subsets, args.min_len, args.seed,
+                                  args.compress)
+    if new_filenames is None:
+        sys.exit(1)
 
-#Close files and exit
-fi.close()
-fo.close()
-sys.exit()
+    #Print the new file names
+    for new_filename in new_filenames:
+        print("New file: ", new_filename)
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3.5
+
+'''Runs the queries of chimp_trace_25k.sql with one of two engines:
+
+sqlite   on a chimp_trace_25k db built by make_db.py
+duckdb   straight from the source files, with no db to build
+
+For ad hoc re-analysis the duckdb engine saves the long make_db run.
+Its tables are views over the files make_db would load:
+
+chimp_blast_on_homo       the pan_NNN_*_on_homo.csv blastn files in
+                          --blast-dir, with the seqfile id of each
+                          file's name
+nonhitter_blast_on_chimp  the pan_NNN_*.csv blastn files in
+                          --nonhitter-dir
+chimp_seq_data            the seq lengths (seq_len, in place of dna_seq)
+                          of the fasta files in --blast-dir, from their
+                          .fai indexes, which are built if missing
+chimp_seq_year            the --seq-year csv file of get_xml_seqyear
+seqfile_summary,          the make_db summary aggregates, computed as
+pident_histogram          they are queried
+bin_edges, hit_bins,      the default make_db bin edges and the same
+file_bins                 views
+
+duckdb reads the csv files and runs the aggregates a vector of rows at
+a time in --threads threads. With --cache the blastn csv files are
+read through the Arrow cache of blast_cache instead. The statements are
+written for sqlite, so to_duckdb rewrites the sqlite-isms they use.
+Needs the duckdb package. --bench builds a synthetic data set, times
+the db build and the queries with each engine and checks that the two
+engines give the same results.'''
+
+from contextlib import redirect_stdout
+from math import isclose
+from time import perf_counter
+import argparse
+import decimal
+import os
+import re
+import sqlite3
+import sys
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from fasta_index import build_index
+from fasta_index import index_is_current
+from fasta_index import write_index
+from gzip_io import strip_gz
+from instrument import add_report_arguments
+from instrument import finish_from_args
+from instrument import stage
+from instrument import start_from_args
+from make_db import bin_edge_rows
+from make_db import blast_csv_pattern
+from make_db import default_bin_edges
+from make_db import file_bins_select
+from make_db import histogram_names
+from make_db import histogram_select
+from make_db import hit_bins_select
+from make_db import list_blast_files
+from make_db import list_files
+from make_db import nonhitter_csv_pattern
+from make_db import summary_names
+from make_db import summary_select
+from query_plans import read_statements
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+ENGINES = ['sqlite', 'duckdb']
+
+# duckdb types of the blastn csv columns, in file order
+blast_types = [('qseqid', 'VARCHAR'), ('qstart', 'INTEGER'),
+               ('qend', 'INTEGER'), ('mismatch', 'INTEGER'),
+               ('gapopen', 'INTEGER'), ('pident', 'DOUBLE'),
+               ('nident', 'INTEGER'), ('length', 'INTEGER'),
+               ('qlen', 'INTEGER')]
+
+# duckdb types of the .fai index columns
+fai_types = [('gnl_num', 'VARCHAR'), ('seq_len', 'INTEGER'),
+             ('offset', 'BIGINT'), ('linebases', 'INTEGER'),
+             ('linewidth', 'INTEGER')]
+
+# Seqfile id of a file read by read_csv with filename = true, as
+# make_db.get_seqfile_id takes it from the file name
+seqfile_sql = 'substr(parse_filename(filename), 5, 3) as seqfile'
+
+# sqlite orders seqfile ids as numbers with seqfile + 0
+plus_zero_pattern = re.compile(r'\b([\w.]+) \+ 0\b')
+aggregate_pattern = re.compile(r'\b(?:count|sum|avg|min|max|total)\s*\(',
+                               re.IGNORECASE)
+alias_pattern = re.compile(r'^(.*?)(\s+as\s+\w+)?(\s*)$',
+                           re.IGNORECASE | re.DOTALL)
+clause_pattern = re.compile(r'\b(select|from|where|group by|order by|'
+                            r'limit)\b|[()]', re.IGNORECASE)
+
+
+def _check_duckdb():
+    '''Raises ImportError if duckdb is not installed.'''
+    if duckdb is None:
+        raise ImportError('The duckdb engine needs the duckdb package')
+
+
+def split_top_level(text):
+    '''Splits text on the commas that are not inside parentheses.'''
+    parts = []
+    depth = 0
+    start = 0
+    for pos, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            parts.append(text[start:pos])
+            start = pos + 1
+    parts.append(text[start:])
+    return parts
+
+
+def get_clauses(statement):
+    '''Returns a dict of the clause names of the first select in a
+    statement that are not inside parentheses, e.g. 'select' or 'group
+    by', to the (start, body start, end) of the clause in the
+    statement.'''
+    clauses = {}
+    depth = 0
+    name = None
+    for match in clause_pattern.finditer(statement):
+        token = match.group(0).lower()
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0 and (name is not None or token == 'select'):
+            if name is not None:
+                clauses[name] = clauses[name][:2] + (match.start(),)
+            if token in clauses:
+                break
+            name = token
+            clauses[name] = (match.start(), match.end(), len(statement))
+    return clauses
+
+
+def to_duckdb(statement):
+    '''Rewrites an sqlite statement of chimp_trace_25k.sql for duckdb:
+
+    - seqfile + 0 is cast(seqfile as integer), as duckdb does not add
+      numbers to strings
+    - in a select with aggregates, a column that is not grouped by is
+      any_value(column), which is what sqlite takes for it
+    - a select with aggregates and no group by, which has one row,
+      drops its order by
+
+    The connection is set for integer division, as in sqlite.'''
+    statement = plus_zero_pattern.sub(r'cast(\1 as integer)', statement)
+    clauses = get_clauses(statement)
+    if 'select' not in clauses:
+        return statement
+    _, start, end = clauses['select']
+    items = split_top_level(statement[start:end])
+    if not any(aggregate_pattern.search(item) for item in items):
+        return statement
+
+    grouped = set()
+    if 'group by' in clauses:
+        _, group_start, group_end = clauses['group by']
+        grouped = set(item.strip().lower() for item in
+                      split_top_level(statement[group_start:group_end]))
+    elif 'order by' in clauses:
+        order_start, _, order_end = clauses['order by']
+        statement = statement[:order_start] + statement[order_end:]
+    new_items = []
+    for item in items:
+        expression, alias, trailing = alias_pattern.match(item).groups()
+        if (not aggregate_pattern.search(item) and
+                expression.strip().lower() not in grouped):
+            leading = expression[:len(expression) - len(expression.lstrip())]
+            item = (leading + 'any_value(' + expression.strip() + ')' +
+                    (alias or '') + trailing)
+        new_items.append(item)
+    return statement[:start] + ','.join(new_items) + statement[end:]
+
+
+def update_indexes(fastafiles):
+    '''Builds the .fai index of each fasta file that has none or an
+    out of date one, and returns the index file names.'''
+    for fastafile in fastafiles:
+        if not index_is_current(fastafile):
+            write_index(fastafile, build_index(fastafile))
+    return [fastafile + '.fai' for fastafile in fastafiles]
+
+
+def _sql_list(filenames):
+    '''Returns a list of file names as a duckdb list literal.'''
+    return '[' + ', '.join("'" + filename.replace("'", "''") + "'"
+                           for filename in filenames) + ']'
+
+
+def _sql_columns(types):
+    '''Returns (name, type) pairs as a duckdb read_csv columns struct.'''
+    return '{' + ', '.join("'{}': '{}'".format(name, sql_type)
+                           for name, sql_type in types) + '}'
+
+
+def create_file_view(conn, name, filenames, types, columns, delim=','):
+    '''Creates a view of the rows of csv files, read with the given
+    (name, type) column types, or an empty table of the types if there
+    are no files. columns is the select list of the view. The format of
+    the files is given rather than sniffed, which would read the start
+    of each file every time the view is queried.'''
+    if not filenames:
+        conn.execute('create table ' + name + ' (' +
+                     ', '.join(' '.join(pair) for pair in types) +
+                     ', seqfile VARCHAR)')
+        return
+    conn.execute('create view ' + name + ' as select ' + columns +
+                 ' from read_csv(' + _sql_list(filenames) +
+                 ", auto_detect = false, header = false, delim = '" +
+                 delim + "', filename = true, columns = " +
+                 _sql_columns(types) + ')')
+
+
+def register_blast_cache(conn, name, csvfiles):
+    '''Creates a view of blastn csv files read through the Arrow cache
+    of blast_cache.'''
+    import pyarrow as pa
+    from blast_cache import read_blast_table
+
+    tables = [read_blast_table(csvfile) for csvfile in csvfiles]
+    conn.register(name + '_arrow', pa.concat_tables(
+        [table.replace_schema_metadata(None) for table in tables]))
+    conn.execute('create view ' + name + ' as select ' +
+                 ', '.join(column for column, _ in blast_types) +
+                 ', cast(seqfile as varchar) as seqfile from ' + name +
+                 '_arrow')
+
+
+def open_duckdb(blast_dir='.', nonhitter_dir='.', seq_year_csv=None,
+                threads=None, use_cache=False):
+    '''Returns an in-memory duckdb connection with the tables of
+    chimp_trace_25k.sql as views of the source files.'''
+    _check_duckdb()
+    config = {} if threads is None else {'threads': threads}
+    conn = duckdb.connect(config=config)
+    conn.execute('set integer_division = true')
+
+    blast_columns = ', '.join(name for name, _ in blast_types)
+    for name, directory, pattern in (
+            ('chimp_blast_on_homo', blast_dir, blast_csv_pattern),
+            ('nonhitter_blast_on_chimp', nonhitter_dir,
+             nonhitter_csv_pattern)):
+        csvfiles = list_blast_files(directory, pattern)
+        if use_cache and csvfiles:
+            register_blast_cache(conn, name, csvfiles)
+        else:
+            create_file_view(conn, name, csvfiles, blast_types,
+                             blast_columns + ', ' + seqfile_sql)
+
+    fastafiles = [file for file in list_files(blast_dir, '.fa')
+                  if not strip_gz(file).endswith('_non_hitters.fa')]
+    with stage('fasta indexes'):
+        index_files = update_indexes(fastafiles)
+    create_file_view(conn, 'chimp_seq_data', index_files, fai_types,
+                     'gnl_num, seq_len, ' + seqfile_sql, '\t')
+
+    year_types = [('seqfile_id', 'VARCHAR'), ('min_date', 'VARCHAR'),
+                  ('max_date', 'VARCHAR')]
+    if seq_year_csv is not None and os.path.exists(seq_year_csv):
+        conn.execute("create view chimp_seq_year as select * from "
+                     "read_csv(" + _sql_list([seq_year_csv]) +
+                     ", auto_detect = false, header = false, delim = ',', "
+                     "nullstr = ['NULL', ''], columns = " +
+                     _sql_columns(year_types) + ")")
+    else:
+        if seq_year_csv is not None:
+            print('Cannot open', seq_year_csv)
+        conn.execute('create table chimp_seq_year (' +
+                     ', '.join(' '.join(pair) for pair in year_types) + ')')
+
+    conn.execute('create view seqfile_summary (' + ', '.join(summary_names) +
+                 ') as ' + summary_select + 'group by seqfile')
+    conn.execute('create view pident_histogram (' +
+                 ', '.join(histogram_names) + ') as ' + histogram_select +
+                 'group by seqfile, pident_bin')
+    conn.execute('create table bin_edges (name VARCHAR, bin_lo DOUBLE, '
+                 'bin_hi DOUBLE, closed INTEGER)')
+    for name, edges in sorted(default_bin_edges.items()):
+        conn.executemany('insert into bin_edges values (?, ?, ?, ?)',
+                         bin_edge_rows(name, edges))
+    conn.execute('create view hit_bins as ' + hit_bins_select)
+    conn.execute('create view file_bins as ' + file_bins_select)
+    return conn
+
+
+def run_queries(conn, statements, translate=None, max_rows=10):
+    '''Runs the selects of a read_statements list on a connection,
+    printing the time and first max_rows rows of each. Views are
+    created first as temp views and the drop view statements skipped,
+    so queries can use a view wherever it is defined in the script.
+    translate rewrites each statement for the engine. Returns a list
+    of (label, statement, seconds, rows) results.'''
+    results = []
+    for label, statement in statements:
+        lowered = statement.lower()
+        if not (lowered.startswith('create view') or
+                lowered.startswith('select')):
+            continue
+        if lowered.startswith('create view'):
+            statement = statement.replace('create view',
+                                          'create temp view', 1)
+        sql = statement if translate is None else translate(statement)
+        start = perf_counter()
+        rows = conn.execute(sql).fetchall()
+        elapsed = perf_counter() - start
+        if lowered.startswith('create view'):
+            continue
+        results.append((label, statement, elapsed, rows))
+
+        if max_rows:
+            print("{:8.4f} s  {} ({:,} rows)".format(elapsed, label,
+                                                     len(rows)))
+            for row in rows[:max_rows]:
+                print("            ", ", ".join(str(value) for value in row))
+    return results
+
+
+def query_file(engine, sql_filename='chimp_trace_25k.sql',
+               db_name='chimp_trace_25k.sqlite', blast_dir='.',
+               nonhitter_dir='.', seq_year_csv=None, threads=None,
+               use_cache=False, max_rows=10):
+    '''Runs the selects of an sql script with an engine, sqlite on a
+    db or duckdb on the source files. Returns the run_queries results
+    and the seconds taken to open the db or create the views.'''
+    statements = read_statements(sql_filename)
+    start = perf_counter()
+    with stage('open ' + engine):
+        if engine == 'sqlite':
+            if not os.path.exists(db_name):
+                raise IOError('No db ' + db_name)
+            conn = sqlite3.connect(db_name)
+            translate = None
+        else:
+            conn = open_duckdb(blast_dir, nonhitter_dir, seq_year_csv,
+                               threads, use_cache)
+            translate = to_duckdb
+    open_time = perf_counter() - start
+    try:
+        with stage('queries') as st:
+            results = run_queries(conn, statements, translate, max_rows)
+            st.add(len(results))
+    finally:
+        conn.close()
+    return results, open_time
+
+
+def _comparable(value):
+    '''Returns a query result value as an int, float or str.'''
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def _last_place(value):
+    '''Returns the value of the last decimal place of a float, e.g.
+    0.01 for 65.23.'''
+    text = repr(value)
+    if 'e' in text or '.' not in text:
+        return 0.0
+    return 10.0 ** -len(text.split('.')[1])
+
+
+def is_same_value(value, other_value, rel_tol=1e-9):
+    '''Checks whether two result values agree. Floats may differ by
+    rel_tol, or by one in the last place of a value rounded in the sql,
+    as sqlite and duckdb round a value that is halfway in decimal but
+    not quite in binary, e.g. 65.225, in different directions.'''
+    if value == other_value:
+        return True
+    if (isinstance(value, str) or isinstance(other_value, str) or
+            value is None or other_value is None):
+        return False
+    return (isclose(value, other_value, rel_tol=rel_tol) or
+            abs(value - other_value) <= 1.000001 * max(
+                _last_place(value), _last_place(other_value)))
+
+
+def compare_results(results, other_results, rel_tol=1e-9):
+    '''Compares the rows of each query of two run_queries results,
+    in order if the query has an order by clause. Queries with a limit
+    are skipped, as their rows are a sample, as are aggregates of the
+    whole table with a bare column, whose value is from any row. Prints
+    each mismatch and returns the number of queries compared and the
+    number that differ.'''
+    num_compared = 0
+    num_differ = 0
+    for (label, statement, _, rows), (_, _, _, other_rows) in zip(
+            results, other_results):
+        if (re.search(r'\blimit\b', statement, re.IGNORECASE) or
+                ('any_value(' in to_duckdb(statement) and
+                 'group by' not in get_clauses(statement))):
+            continue
+        num_compared += 1
+        rows = [tuple(_comparable(value) for value in row) for row in rows]
+        other_rows = [tuple(_comparable(value) for value in row)
+                      for row in other_rows]
+        if not re.search(r'\border by\b', statement, re.IGNORECASE):
+            rows = sorted(rows, key=repr)
+            other_rows = sorted(other_rows, key=repr)
+
+        same = len(rows) == len(other_rows)
+        for row, other_row in zip(rows, other_rows):
+            if not all(is_same_value(value, other_value, rel_tol)
+                       for value, other_value in zip(row, other_row)):
+                same = False
+        if not same:
+            num_differ += 1
+            print("DIFFERS:", label)
+            print("           ", rows[:3], "...")
+            print("           ", other_rows[:3], "...")
+    return num_compared, num_differ
+
+
+def benchmark(work_dir, num_seqfiles=101, num_seqs=2500, threads=None,
+              sql_filename='chimp_trace_25k.sql', use_cache=False):
+    '''Generates a synthetic data set in work_dir, or reuses it, and
+    times building the db with make_db and running the queries on it
+    against running them with duckdb on the files, indexing the fasta
+    files from scratch. Prints the times and any queries whose results
+    differ. Returns True if none differ.'''
+    from get_xml_seqyear import get_seq_years
+    from get_xml_seqyear import write_seq_year_csv
+    from glob import glob
+    from make_db import create_tables
+    from make_db import ingest
+    from synthetic_data import generate
+
+    data_dir = os.path.abspath(work_dir)
+    sql_filename = os.path.abspath(sql_filename)
+    done_flag = os.path.join(data_dir, '.generated')
+    if not os.path.exists(done_flag):
+        generate(data_dir, num_seqfiles, num_seqs)
+        write_seq_year_csv(os.path.join(data_dir, 'seq_year_csv'),
+                           get_seq_years(sorted(glob(os.path.join(
+                               data_dir, 'xml*')))))
+        open(done_flag, 'w').close()
+    db_name = os.path.join(data_dir, 'chimp_trace_25k.sqlite')
+    seq_year_csv = os.path.join(data_dir, 'seq_year_csv')
+    nonhitter_dir = os.path.join(data_dir, 'nh')
+    for filename in glob(db_name + '*') + glob(os.path.join(data_dir,
+                                                            '*.fai')):
+        os.unlink(filename)
+
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = perf_counter()
+        create_tables(db_name)
+        ingest(db_name, data_dir, nonhitter_dir, seq_year_csv)
+        build_time = perf_counter() - start
+        sqlite_results, sqlite_open = query_file(
+            'sqlite', sql_filename, db_name, max_rows=0)
+        duckdb_results, duckdb_open = query_file(
+            'duckdb', sql_filename, blast_dir=data_dir,
+            nonhitter_dir=nonhitter_dir, seq_year_csv=seq_year_csv,
+            threads=threads, use_cache=use_cache, max_rows=0)
+
+    sqlite_time = sum(result[2] for result in sqlite_results)
+    duckdb_time = sum(result[2] for result in duckdb_results)
+    print("{} seqfiles of {:,} reads, {} queries".format(
+          num_seqfiles, num_seqs, len(sqlite_results)))
+    print("{:<7} {:>10} {:>10} {:>10}".format("engine", "setup s",
+                                              "queries s", "total s"))
+    for engine, setup, queries in (
+            ('sqlite', build_time + sqlite_open, sqlite_time),
+            ('duckdb', duckdb_open, duckdb_time)):
+        print("{:<7} {:10.3f} {:10.3f} {:10.3f}".format(
+              engine, setup, queries, setup + queries))
+    print("{:<40} {:>9} {:>9}".format("query", "sqlite s", "duckdb s"))
+    for sqlite_result, duckdb_result in zip(sqlite_results,
+                                            duckdb_results):
+        print("{:<40.40} {:9.4f} {:9.4f}".format(
+              sqlite_result[0], sqlite_result[2], duckdb_result[2]))
+
+    num_compared, num_differ = compare_results(sqlite_results,
+                                               duckdb_results)
+    print("{} of {} queries give the same results with both engines".format(
+          num_compared - num_differ, num_compared))
+    return num_differ == 0
+
+
+def add_arguments(parser):
+    '''Adds the command line options of the queries to an argparse
+    parser.'''
+    parser.add_argument('--engine', choices=ENGINES, default='sqlite',
+                        help='sqlite on the db, or duckdb on the source '
+                             'files (default sqlite)')
+    parser.add_argument('--sql', default='chimp_trace_25k.sql',
+                        help='sql script (default chimp_trace_25k.sql)')
+    parser.add_argument('--db', default='chimp_trace_25k.sqlite',
+                        help='sqlite db file (default chimp_trace_25k.sqlite)')
+    parser.add_argument('--blast-dir', default='.',
+                        help='dir of blastn on homo csv and fasta files, '
+                             'for duckdb (default .)')
+    parser.add_argument('--nonhitter-dir', default='nh',
+                        help='dir of non-hitter blastn on chimp csv files, '
+                             'for duckdb (default nh)')
+    parser.add_argument('--seq-year',
+                        help='seqfile year csv file from get_xml_seqyear.py, '
+                             'for duckdb (default seq_year_csv in '
+                             'blast_dir)')
+    parser.add_argument('--threads', type=int,
+                        help='duckdb threads (default one per cpu)')
+    parser.add_argument('--cache', action='store_true',
+                        help='read the blast data through the columnar '
+                             'cache (needs pyarrow)')
+    parser.add_argument('--rows', type=int, default=10,
+                        help='rows of each query to print (default 10)')
+    parser.add_argument('--bench', type=int, metavar='SEQFILES',
+                        help='instead compare the engines on a synthetic '
+                             'data set of this many seqfiles')
+    parser.add_argument('--seqs', type=int, default=2500,
+                        help='reads per synthetic seqfile (default 2500)')
+    parser.add_argument('--work-dir', default='query_bench',
+                        help='dir for the synthetic data set (default '
+                             'query_bench)')
+    add_report_arguments(parser)
+
+
+def main(args):
+    '''Runs the queries, or the benchmark, with add_arguments args.
+    Returns 1 if the db is missing or the benchmark finds results that
+    differ, otherwise 0.'''
+    start_from_args('query_engine', args)
+    status = 0
+    if (args.bench is None and args.engine == 'sqlite' and
+            not os.path.exists(args.db)):
+        print('Cannot open', args.db)
+        status = 1
+    elif args.bench is not None:
+        if not benchmark(args.work_dir, args.bench, args.seqs, args.threads,
+                         args.sql, args.cache):
+            status = 1
+    else:
+        seq_year_csv = args.seq_year
+        if seq_year_csv is None:
+            seq_year_csv = os.path.join(args.blast_dir, 'seq_year_csv')
+        results, open_time = query_file(
+            args.engine, args.sql, args.db, args.blast_dir,
+            args.nonhitter_dir, seq_year_csv, args.threads, args.cache,
+            args.rows)
+        print("{}: {} queries in {:.3f} s, {:.3f} s to open".format(
+              args.engine, len(results),
+              sum(result[2] for result in results), open_time))
+    finish_from_args(args)
+    return status
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    sys.exit(main(parser.parse_args()))
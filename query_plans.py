@@ -0,0 +1,199 @@
+#!/usr/bin/env python3.5
+
+'''Checks the query plans of the queries in chimp_trace_25k.sql. Each
+select is run on a chimp_trace_25k db, either an existing one or a
+synthetic one built with random blastn rows, and its EXPLAIN QUERY
+PLAN is checked for full scans of a table that one of the make_db
+indexes should serve. Prints the time and plan of each query and
+exits with an error if any query scans a table it should not.'''
+
+from time import perf_counter
+import argparse
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+
+from make_db import blast_names
+from make_db import create_indexes
+from make_db import create_tables
+from make_db import fill_summaries
+from make_db import insert_rows
+from make_db import seq_names
+from make_db import seq_year_names
+from make_db import table_indexes
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+# Tables small enough (a row or a few hundred rows per seqfile) that a
+# full scan is fine
+SMALL_TABLES = frozenset(['chimp_seq_year', 'seqfile_summary',
+                          'pident_histogram', 'ingest_manifest'])
+
+# EXPLAIN QUERY PLAN detail of a table scan, "SCAN t" or "SCAN TABLE t"
+# in older sqlite versions, with "USING ... INDEX" if it reads an index
+scan_pattern = re.compile(r'SCAN (?:TABLE )?(\w+)')
+
+
+def read_statements(sql_filename):
+    '''Returns the statements of an sql script as a list of (label,
+    statement) tuples, where label is the last comment line before the
+    statement.'''
+    statements = []
+    label = ''
+    lines = []
+    with open(sql_filename, 'r') as fi:
+        for line in fi:
+            stripped = line.strip()
+            if stripped.startswith('--'):
+                text = stripped.strip('-= ')
+                if text and not lines:
+                    label = text
+                continue
+            if stripped:
+                lines.append(line.split('--')[0].rstrip())
+            if stripped.endswith(';'):
+                statements.append((label, '\n'.join(lines).rstrip(';')))
+                lines = []
+    return statements
+
+
+def make_synthetic_db(db_name, num_seqfiles=101, hits_per_file=2000,
+                      seed=1):
+    '''Builds a chimp_trace_25k db of random rows: hits_per_file blastn
+    on homo hits and a quarter as many non-hitters blastn on chimp for
+    each seqfile, their seqs and seqfile years, some of them NULL.'''
+    rng = random.Random(seed)
+    create_tables(db_name)
+
+    def blast_rows(seqfile, num_rows, first_gnl):
+        for i in range(num_rows):
+            qlen = rng.randint(100, 900)
+            length = rng.randint(50, qlen)
+            pident = round(rng.uniform(60.0, 100.0), 3)
+            nident = int(length * pident / 100)
+            yield ['gnl|ti|' + str(first_gnl + i), 1, length,
+                   length - nident, rng.randint(0, 5), pident, nident,
+                   length, qlen, seqfile]
+
+    seqfiles = ['{:03d}'.format(i) for i in range(1, num_seqfiles + 1)]
+    num_seqs = hits_per_file + hits_per_file // 4
+    conn = sqlite3.connect(db_name)
+    try:
+        for n, seqfile in enumerate(seqfiles):
+            first_gnl = 100000000 + n * num_seqs
+            insert_rows(conn, 'chimp_blast_on_homo', blast_names,
+                        blast_rows(seqfile, hits_per_file, first_gnl))
+            insert_rows(conn, 'nonhitter_blast_on_chimp', blast_names,
+                        blast_rows(seqfile, hits_per_file // 4,
+                                   first_gnl + hits_per_file))
+            insert_rows(conn, 'chimp_seq_data', seq_names,
+                        (['gnl|ti|' + str(first_gnl + i), 'ACGT' * 25,
+                          seqfile] for i in range(num_seqs)))
+        insert_rows(conn, 'chimp_seq_year', seq_year_names,
+                    ([seqfile, None, None] if n % 10 == 0 else
+                     [seqfile, str(2000 + n % 8), str(2002 + n % 8)]
+                     for n, seqfile in enumerate(seqfiles)))
+        conn.commit()
+        for db_table in table_indexes:
+            create_indexes(conn, db_table)
+        fill_summaries(conn)
+    finally:
+        conn.close()
+
+
+def get_plan(conn, statement):
+    '''Returns the EXPLAIN QUERY PLAN details of a statement.'''
+    return [row[-1] for row in
+            conn.execute('explain query plan ' + statement)]
+
+
+def full_scans(plan, tables, statement):
+    '''Returns the tables a plan scans in full that an index should
+    serve: scans not using an index of tables not in SMALL_TABLES.
+    Sample queries with a limit may scan.'''
+    if re.search(r'\blimit\b', statement, re.IGNORECASE):
+        return []
+    scanned = []
+    for detail in plan:
+        match = scan_pattern.search(detail)
+        if (match and 'USING' not in detail and
+                match.group(1) in tables and
+                match.group(1) not in SMALL_TABLES):
+            scanned.append(match.group(1))
+    return scanned
+
+
+def check_query_plans(db_name, sql_filename='chimp_trace_25k.sql'):
+    '''Runs each select of an sql script on a db, printing its time and
+    query plan. Views are created first and the drop view statements
+    skipped, so queries can use a view wherever it is defined in the
+    script. Returns a list of (label, statement, seconds, plan, full
+    scans) results.'''
+    statements = read_statements(sql_filename)
+    conn = sqlite3.connect(db_name)
+    results = []
+    try:
+        tables = set(row[0] for row in
+                     conn.execute('select name from sqlite_master '
+                                  'where type = ?', ('table',)))
+        for label, statement in statements:
+            if statement.lower().startswith('create view'):
+                conn.execute(statement.replace('create view',
+                                               'create temp view', 1))
+
+        for label, statement in statements:
+            if not statement.lower().startswith('select'):
+                continue
+            plan = get_plan(conn, statement)
+            start = perf_counter()
+            conn.execute(statement).fetchall()
+            elapsed = perf_counter() - start
+            scans = full_scans(plan, tables, statement)
+            results.append((label, statement, elapsed, plan, scans))
+
+            print("{:8.4f} s  {}{}".format(
+                  elapsed, label, "  FULL SCAN: " + ", ".join(scans)
+                  if scans else ""))
+            for detail in plan:
+                print("            ", detail)
+    finally:
+        conn.close()
+
+    num_failed = sum(1 for result in results if result[4])
+    print("{} queries, {} with full scans, {:.3f} s in all".format(
+          len(results), num_failed, sum(result[2] for result in results)))
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db',
+                        help='existing chimp_trace_25k db to check '
+                             '(default a synthetic db)')
+    parser.add_argument('--sql', default='chimp_trace_25k.sql',
+                        help='sql script (default chimp_trace_25k.sql)')
+    parser.add_argument('--seqfiles', type=int, default=101,
+                        help='seqfiles in the synthetic db (default 101)')
+    parser.add_argument('--hits', type=int, default=2000,
+                        help='hits per seqfile in the synthetic db '
+                             '(default 2000)')
+    args = parser.parse_args()
+
+    if args.db is not None:
+        results = check_query_plans(args.db, args.sql)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_name = os.path.join(tmp_dir, 'chimp_trace_25k.sqlite')
+            make_synthetic_db(db_name, args.seqfiles, args.hits)
+            results = check_query_plans(db_name, args.sql)
+
+    if any(result[4] for result in results):
+        sys.exit(1)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3.5
+
+'''Renders the figures of a blastn run report to image files, with no
+display needed. The figures are
+
+overall_ident       overall ident of each data set, from the csv
+                    summary file of blastn_proc
+pident_NNN          histogram of the pident of the hits of each
+                    seqfile, from its blastn csv file
+ident_by_year       overall ident of each data set against its run
+                    years, from the seq_year_csv of get_xml_seqyear
+
+Figures are drawn with the matplotlib Agg canvas rather than pyplot,
+so MPLBACKEND and the display do not matter. Each process draws all
+of its figures on one reused Figure, and the figures are spread over
+a pool of worker processes, each of which also reads the blastn csv
+files of its histograms.'''
+
+from concurrent.futures import ProcessPoolExecutor
+from time import strftime
+import argparse
+import os
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from blastn_proc import csv_outfilename
+from blastn_proc import get_blast_dataframe
+from instrument import add_report_arguments
+from instrument import finish_from_args
+from instrument import stage
+from instrument import start_from_args
+from instrument import worker
+from instrument import worker_result
+from make_db import get_seqfile_id
+from make_db import list_blast_files
+from make_db import read_csv_rows
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+# Size in inches, resolution and margins (fractions of the figure) of
+# each figure. Fixed margins are much faster than a tight layout.
+FIGSIZE = (8.0, 5.0)
+DPI = 100
+MARGINS = {'left': 0.1, 'right': 0.96, 'bottom': 0.11, 'top': 0.92}
+
+# Figures rendered by each worker per batch sent to it
+CHUNK_SIZE = 8
+
+# The one Figure, with its Agg canvas and axes, of this process, made
+# on first use
+_figure = {}
+
+
+def get_axes():
+    '''Returns the Figure of this process and its cleared axes. The
+    Figure, canvas and axes are made once and reused.'''
+    if not _figure:
+        fig = Figure(figsize=FIGSIZE, dpi=DPI)
+        FigureCanvasAgg(fig)
+        fig.subplots_adjust(**MARGINS)
+        _figure['fig'] = fig
+        _figure['ax'] = fig.add_subplot(1, 1, 1)
+    _figure['ax'].clear()
+    return _figure['fig'], _figure['ax']
+
+
+def draw_overall_ident(ax, file_ids, idents):
+    '''Line graphs the overall ident of each data set, by the number in
+    its file id, e.g. 1 for pan001.'''
+    ax.plot([int(file_id[3:7]) for file_id in file_ids], idents,
+            color='green', marker='o', linestyle='solid')
+    ax.set_title("Overall Identity of Each Fasta Trace Read Data Set")
+    ax.set_ylabel("Overall Data Set Percent Identity")
+    ax.set_xlabel("Fasta Trace Read Data Sets (001 to 101)")
+    ax.set_xlim(0, 102)
+
+
+def draw_pident_histogram(ax, csv_filename, bin_edges, use_cache=False):
+    '''Draws a histogram of the pident of the hits of a blastn csv file
+    in bins with the given edges.'''
+    df = get_blast_dataframe(csv_filename, use_cache, 0)
+    counts, _ = np.histogram(df['pident'], bin_edges)
+    ax.hist(bin_edges[:-1], bin_edges, weights=counts,
+            histtype='stepfilled', color='steelblue')
+    ax.set_title("Hit Identity of Seqfile {} ({:,} hits)".format(
+                 get_seqfile_id(csv_filename), len(df)))
+    ax.set_ylabel("Number of Hits")
+    ax.set_xlabel("Percent Identity of the Hit Alignment (pident)")
+    ax.set_xlim(bin_edges[0], bin_edges[-1])
+
+
+def draw_ident_by_year(ax, years, idents):
+    '''Plots the overall ident of each data set against its run years,
+    with a bar across the years of a data set run over several.'''
+    years = np.asarray(years, dtype=np.float64)
+    ax.errorbar((years[:, 0] + years[:, 1]) / 2, idents,
+                xerr=(years[:, 1] - years[:, 0]) / 2, color='green',
+                marker='o', linestyle='none', capsize=3)
+    ax.set_title("Overall Identity of Each Data Set by Run Year")
+    ax.set_ylabel("Overall Data Set Percent Identity")
+    ax.set_xlabel("Run Year")
+
+
+# Draw function of each kind of figure
+draw_functions = {'overall_ident': draw_overall_ident,
+                  'pident': draw_pident_histogram,
+                  'ident_by_year': draw_ident_by_year}
+
+
+def render_figure(task):
+    '''Draws a (kind, file name less extension, formats, draw args)
+    figure task on this process's Figure and saves it in each format,
+    e.g. png or svg. Returns the names of the files written.'''
+    kind, name, formats, draw_args = task
+    fig, ax = get_axes()
+    draw_functions[kind](ax, *draw_args)
+    filenames = []
+    for file_format in formats:
+        filenames.append(name + '.' + file_format)
+        fig.savefig(filenames[-1])
+    return filenames
+
+
+def read_summary(summary_filename):
+    '''Returns the (file id, overall ident) of each data set in a csv
+    summary file of blastn_proc.'''
+    rows = read_csv_rows(summary_filename)
+    header = next(rows, None)
+    if header is None:
+        return []
+    ident_col = header.index('overall_ident')
+    return [(row[0], float(row[ident_col])) for row in rows]
+
+
+def read_seq_years(seq_year_csv):
+    '''Returns a dict of seqfile id to (min year, max year) from a
+    seq_year_csv file, leaving out seqfiles with no years.'''
+    return dict((row[0], (int(row[1]), int(row[2])))
+                for row in read_csv_rows(seq_year_csv)
+                if row[1] is not None and row[2] is not None)
+
+
+def get_tasks(summary, csv_files, seq_years, out_dir, formats,
+              bin_edges, use_cache=False):
+    '''Returns the render_figure tasks of a report: the overall ident
+    and ident by year figures of a read_summary list and read_seq_years
+    dict, if they have data, and a pident histogram for each blastn
+    csv file.'''
+    formats = tuple(formats)
+    tasks = []
+    if summary:
+        tasks.append(('overall_ident', os.path.join(out_dir,
+                                                    'overall_ident'),
+                      formats, ([row[0] for row in summary],
+                                [row[1] for row in summary])))
+    dated = [(seq_years[file_id[3:]], ident) for file_id, ident in summary
+             if file_id[3:] in seq_years]
+    if dated:
+        tasks.append(('ident_by_year', os.path.join(out_dir,
+                                                    'ident_by_year'),
+                      formats, ([row[0] for row in dated],
+                                [row[1] for row in dated])))
+    for csv_filename in csv_files:
+        name = os.path.join(out_dir,
+                            'pident_' + get_seqfile_id(csv_filename))
+        tasks.append(('pident', name, formats,
+                      (csv_filename, bin_edges, use_cache)))
+    return tasks
+
+
+def render_report(summary_filename, csv_files, seq_year_csv=None,
+                  out_dir='.', formats=('png',), jobs=1, bin_width=0.5,
+                  use_cache=False):
+    '''Renders the report figures to out_dir, with jobs > 1 in a pool
+    of worker processes. Returns the names of the files written.'''
+    summary = read_summary(summary_filename)
+    seq_years = {}
+    if seq_year_csv is not None:
+        seq_years = read_seq_years(seq_year_csv)
+    bin_edges = np.arange(60.0, 100.0 + bin_width / 2, bin_width)
+    tasks = get_tasks(summary, csv_files, seq_years, out_dir, formats,
+                      bin_edges, use_cache)
+    os.makedirs(out_dir, exist_ok=True)
+
+    with stage('report figures') as st:
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = [worker_result(output) for output in
+                           pool.map(worker(render_figure), tasks,
+                                    chunksize=CHUNK_SIZE)]
+        else:
+            results = [render_figure(task) for task in tasks]
+        st.add(len(tasks))
+    return [filename for filenames in results for filename in filenames]
+
+
+def add_arguments(parser):
+    '''Adds the command line options of render_report to an argparse
+    parser.'''
+    parser.add_argument('--summary', default=csv_outfilename,
+                        help='csv summary file of blastn_proc (default '
+                             "today's, {})".format(csv_outfilename))
+    parser.add_argument('--seq-year', default='seq_year_csv',
+                        help='seqfile year csv file from get_xml_seqyear.py '
+                             '(default seq_year_csv)')
+    parser.add_argument('--out-dir', default='report_' +
+                        strftime('%m_%d_%Y'),
+                        help='dir to write the figures to (default '
+                             'report_<date>)')
+    parser.add_argument('--format', nargs='+', default=['png'],
+                        choices=['png', 'svg', 'pdf'],
+                        help='image formats to write (default png)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('--bin-width', type=float, default=0.5,
+                        help='pident histogram bin width (default 0.5)')
+    parser.add_argument('--cache', action='store_true',
+                        help='read the blast data through the columnar '
+                             'cache (needs pyarrow)')
+    add_report_arguments(parser)
+
+
+def main(args):
+    '''Renders the figures of the blastn csv files in the working
+    directory with add_arguments args.'''
+    start_from_args('report_figures', args)
+    csv_files = [os.path.basename(file) for file in list_blast_files('.')]
+    seq_year_csv = args.seq_year
+    if not os.path.exists(seq_year_csv):
+        print('Cannot open', seq_year_csv)
+        seq_year_csv = None
+
+    filenames = render_report(args.summary, csv_files, seq_year_csv,
+                              args.out_dir, args.format, args.jobs,
+                              args.bin_width, args.cache)
+    print("Wrote {} figure files to {}".format(len(filenames),
+                                               args.out_dir))
+    finish_from_args(args)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3.5
+
+'''Compact storage of DNA sequences for the chimp_seq_data table.
+Sequences are packed into BLOBs either as 2-bit codes with a list of
+exception runs for N and other IUPAC characters, or zlib compressed
+text. The first byte of a packed BLOB names its format, so packed and
+plain TEXT values can be mixed in one table and decode_seq handles
+both. numpy is imported on the first 2-bit pack or unpack, so loading
+plain TEXT or zlib seqs does not wait for it. Can be run as a script
+to benchmark encode/decode throughput and packed size on a fasta
+file.'''
+
+from time import perf_counter
+import sqlite3
+import struct
+import sys
+import zlib
+
+from fasta_io import read_fasta
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+# Storage formats for the dna_seq column
+SEQ_FORMATS = ('text', '2bit', 'zlib')
+
+# First byte of a packed BLOB
+TWOBIT = b'\x01'
+ZLIB = b'\x02'
+
+# numpy and the 2-bit code of each base (255 for any other character)
+# and base of each code, set up by _get_tables on first use
+_tables = {}
+
+# Seq length and number of exception runs, then the start and length
+# of each run
+_head = struct.Struct('<II')
+_run = struct.Struct('<II')
+
+
+def _get_tables():
+    '''Returns (numpy, codes, bases) for 2-bit packing, importing numpy
+    and building the code tables on the first call.'''
+    if not _tables:
+        import numpy as np
+        codes = np.full(256, 255, dtype=np.uint8)
+        for code, base in enumerate(b'ACGT'):
+            codes[base] = code
+        _tables.update(np=np, codes=codes,
+                       bases=np.frombuffer(b'ACGT', dtype=np.uint8))
+    return _tables['np'], _tables['codes'], _tables['bases']
+
+
+def pack_2bit(seq):
+    '''Packs a DNA seq string into a 2-bit BLOB. Runs of characters
+    other than A, C, G and T are kept verbatim in an exception list.'''
+    np, _codes, _ = _get_tables()
+    raw = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+    codes = _codes[raw]
+
+    # Find the start and end of each run of exception characters
+    exc = codes == 255
+    runs = []
+    if exc.any():
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], exc, [0]))
+                                       .astype(np.int8)))
+        for start, end in zip(edges[0::2], edges[1::2]):
+            runs.append((int(start), int(end - start)))
+        codes = np.where(exc, 0, codes).astype(np.uint8)
+
+    pad = -len(codes) % 4
+    if pad:
+        codes = np.concatenate((codes, np.zeros(pad, dtype=np.uint8)))
+    packed = ((codes[0::4] << 6) | (codes[1::4] << 4) |
+              (codes[2::4] << 2) | codes[3::4])
+
+    parts = [TWOBIT, _head.pack(len(raw), len(runs))]
+    parts.extend(_run.pack(start, length) for start, length in runs)
+    parts.extend(raw[start:start + length].tobytes()
+                 for start, length in runs)
+    parts.append(packed.tobytes())
+    return b''.join(parts)
+
+
+def unpack_2bit(blob):
+    '''Unpacks a 2-bit BLOB made by pack_2bit into a DNA seq string.'''
+    np, _, _bases = _get_tables()
+    offset = len(TWOBIT)
+    length, num_runs = _head.unpack_from(blob, offset)
+    offset += _head.size
+    runs = [_run.unpack_from(blob, offset + i * _run.size)
+            for i in range(num_runs)]
+    offset += num_runs * _run.size
+    run_bytes = []
+    for _, run_len in runs:
+        run_bytes.append(blob[offset:offset + run_len])
+        offset += run_len
+
+    packed = np.frombuffer(blob, dtype=np.uint8, offset=offset)
+    codes = np.empty((len(packed), 4), dtype=np.uint8)
+    codes[:, 0] = packed >> 6
+    codes[:, 1] = (packed >> 4) & 3
+    codes[:, 2] = (packed >> 2) & 3
+    codes[:, 3] = packed & 3
+    seq = _bases[codes.ravel()[:length]]
+
+    for (start, run_len), chars in zip(runs, run_bytes):
+        seq[start:start + run_len] = np.frombuffer(chars, dtype=np.uint8)
+    return seq.tobytes().decode('ascii')
+
+
+def encode_seq(seq, seq_format='2bit'):
+    '''Encodes a DNA seq string for the dna_seq column in one of the
+    SEQ_FORMATS. 'text' leaves the string as it is.'''
+    if seq_format == '2bit':
+        return pack_2bit(seq)
+    elif seq_format == 'zlib':
+        return ZLIB + zlib.compress(seq.encode('ascii'))
+    elif seq_format == 'text':
+        return seq
+    else:
+        raise ValueError('Unknown seq format: ' + str(seq_format))
+
+
+def decode_seq(value):
+    '''Decodes a dna_seq column value made by encode_seq back into a
+    DNA seq string. Plain TEXT values are returned as they are.'''
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value[:1] == TWOBIT:
+        return unpack_2bit(value)
+    elif value[:1] == ZLIB:
+        return zlib.decompress(value[1:]).decode('ascii')
+    else:
+        raise ValueError('Unknown packed seq format')
+
+
+def connect(db_name):
+    '''Opens an sqlite connection with the decode_seq function
+    registered for use in queries, e.g.
+    select gnl_num, decode_seq(dna_seq) from chimp_seq_data.'''
+    conn = sqlite3.connect(db_name)
+    conn.create_function('decode_seq', 1, decode_seq)
+    return conn
+
+
+def get_seq(conn, gnl_num):
+    '''Returns the decoded DNA seq of a trace read by its gnl_num, or
+    None if it is not in the chimp_seq_data table.'''
+    row = conn.execute('select dna_seq from chimp_seq_data '
+                       'where gnl_num = ?', (gnl_num,)).fetchone()
+    if row is None:
+        return None
+    return decode_seq(row[0])
+
+
+def iter_seqs(conn, seqfile=None):
+    '''Generator that yields a (gnl_num, DNA seq) tuple for each trace
+    read in the chimp_seq_data table, or for one seqfile. Each seq is
+    decoded only when it is reached.'''
+    if seqfile is None:
+        cursor = conn.execute('select gnl_num, dna_seq from chimp_seq_data')
+    else:
+        cursor = conn.execute('select gnl_num, dna_seq from chimp_seq_data '
+                              'where seqfile = ?', (seqfile,))
+    for gnl_num, value in cursor:
+        yield gnl_num, decode_seq(value)
+
+
+def benchmark(fastafile):
+    '''Prints the encode and decode throughput and the packed size
+    relative to plain text of each packed format over a fasta file.'''
+    seqs = [seq for _, seq in read_fasta(fastafile)]
+    total = sum(len(seq) for seq in seqs)
+
+    for seq_format in ('2bit', 'zlib'):
+        start = perf_counter()
+        blobs = [encode_seq(seq, seq_format) for seq in seqs]
+        encode_time = perf_counter() - start
+
+        start = perf_counter()
+        for blob in blobs:
+            decode_seq(blob)
+        decode_time = perf_counter() - start
+
+        size = sum(len(blob) for blob in blobs)
+        print("{:<5}: encode {:7.1f} Mbases/s  decode {:7.1f} Mbases/s  "
+              "size {:5.1f}% of text".format(
+                  seq_format, total / encode_time / 1e6,
+                  total / decode_time / 1e6, size * 100 / total))
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 2:
+        print("Usage: seq_pack.py <fasta file>")
+        sys.exit()
+
+    benchmark(sys.argv[1])
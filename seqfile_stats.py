@@ -1,9 +1,24 @@
 #!/usr/bin/env python3.5
 
 '''Gets basic statistics on DNA sequences in all multi-fasta
-files in directory with extension *.seq.'''
+files in directory with extension *.seq, or *.seq.gz for gzip or
+BGZF compressed files.'''
 
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from os import listdir
+import argparse
+import json
+import os
+
+from fasta_io import read_fasta
+from gzip_io import strip_gz
+from instrument import add_report_arguments
+from instrument import finish_from_args
+from instrument import stage
+from instrument import start_from_args
+from instrument import worker
+from instrument import worker_result
 
 
 __author__ = "Jeffrey P Tomkins, PhD"
@@ -11,34 +26,118 @@ __copyright__ = "Copyright 2016, Institute for Creation Research"
 __email__ = "jtomkins@icr.org"
 
 
-def get_fasta(fastafile):
-    '''Makes a list of tuples, each with a list containing fasta
-    header data and a string containing DNA seq ([info], 'seq')'''
+def get_file_stats(fasta_filename):
+    '''Streams the records of a multi-fasta file and returns a dict
+    of partial stats that can be combined with merge_stats: file_name,
+    num_seqs, total_seqlen, min_seqlen, max_seqlen, gc (G+C count),
+    n (N count) and lengths (a Counter of seq lengths). Seqs are not
+    kept in memory.'''
+    lengths = Counter()
+    gc = 0
+    n = 0
+    with stage('fasta stats') as st:
+        for _, seq in read_fasta(fasta_filename):
+            lengths[len(seq)] += 1
+            gc += (seq.count('G') + seq.count('C') +
+                   seq.count('g') + seq.count('c'))
+            n += seq.count('N') + seq.count('n')
+        st.add(sum(lengths.values()), os.path.getsize(fasta_filename))
+
+    return {'file_name': fasta_filename,
+            'num_seqs': sum(lengths.values()),
+            'total_seqlen': sum(seqlen * num
+                                for seqlen, num in lengths.items()),
+            'min_seqlen': min(lengths) if lengths else 0,
+            'max_seqlen': max(lengths) if lengths else 0,
+            'gc': gc,
+            'n': n,
+            'lengths': lengths}
+
+
+def merge_stats(stats_list, file_name='all'):
+    '''Combines a list of get_file_stats dicts into one.'''
+    lengths = Counter()
+    for stats in stats_list:
+        lengths.update(stats['lengths'])
+    return {'file_name': file_name,
+            'num_seqs': sum(stats['num_seqs'] for stats in stats_list),
+            'total_seqlen': sum(stats['total_seqlen']
+                                for stats in stats_list),
+            'min_seqlen': min(lengths) if lengths else 0,
+            'max_seqlen': max(lengths) if lengths else 0,
+            'gc': sum(stats['gc'] for stats in stats_list),
+            'n': sum(stats['n'] for stats in stats_list),
+            'lengths': lengths}
+
+
+def length_quantile(lengths, q):
+    '''Returns the exact q quantile (0 to 1, lower value) of a Counter
+    of seq lengths.'''
+    num_seqs = sum(lengths.values())
+    target = q * (num_seqs - 1)
+    seen = 0
+    for seqlen in sorted(lengths):
+        seen += lengths[seqlen]
+        if seen > target:
+            return seqlen
+    return 0
+
+
+def n50(lengths):
+    '''Returns the N50 of a Counter of seq lengths: the length of the
+    seq at which the seqs, longest first, cover half the total.'''
+    total = sum(seqlen * num for seqlen, num in lengths.items())
+    covered = 0
+    for seqlen in sorted(lengths, reverse=True):
+        covered += seqlen * lengths[seqlen]
+        if covered * 2 >= total:
+            return seqlen
+    return 0
+
+
+def stats_report(stats):
+    '''Returns an ordered list of (name, value) report fields for a
+    get_file_stats or merge_stats dict.'''
+    num_seqs = stats['num_seqs']
+    total = stats['total_seqlen']
+    lengths = stats['lengths']
+    acgt = total - stats['n']
+    return [('file_name', stats['file_name']),
+            ('num_seqs', num_seqs),
+            ('total_seqlen', total),
+            ('ave_seqlen', total // num_seqs if num_seqs else 0),
+            ('min_seqlen', stats['min_seqlen']),
+            ('q1_seqlen', length_quantile(lengths, 0.25)),
+            ('median_seqlen', length_quantile(lengths, 0.5)),
+            ('q3_seqlen', length_quantile(lengths, 0.75)),
+            ('max_seqlen', stats['max_seqlen']),
+            ('n50', n50(lengths)),
+            ('gc_perc', round(stats['gc'] * 100 / acgt, 2) if acgt else 0.0),
+            ('n_perc', round(stats['n'] * 100 / total, 3) if total else 0.0)]
+
+
+def write_stats_reports(stats_list, all_stats, basename='seq_num_report'):
+    '''Writes the per file and overall stats to machine readable
+    <basename>.csv and <basename>.json files.'''
+    reports = [stats_report(stats) for stats in stats_list]
+    reports.append(stats_report(all_stats))
+
     try:
-        with open(fastafile, 'r') as fi:
-            return [(part[0],
-                    part[2].replace('\n', ''))
-                    for part in
-                    [entry.partition('\n')
-                    for entry in fi.read().split('>')[1:]]]
+        with open(basename + '.csv', 'w') as fo:
+            fo.write(",".join(name for name, _ in reports[0]) + "\n")
+            for report in reports:
+                fo.write(",".join(str(value) for _, value in report) +
+                         "\n")
     except IOError:
-        print('Cannot open', fasta_file)
-
-
-def get_seqfile_info(fasta_filename):
-    '''Returns info from multi-fasta file in a 5-element
-    tuple: (num_seqs, ave_seqlen, min_seqlen, max_seqlen,
-    total_seqlen) utilizing the get_fasta function.'''
+        print('Cannot open', basename + '.csv')
 
-    fasta_tuple = get_fasta(fasta_filename)
-    num_seqs = len(fasta_tuple)
-    seqlen_list = [len(item[1]) for item in fasta_tuple]
-    total_seqlen = sum(seqlen_list)
-    ave_seqlen = total_seqlen // num_seqs
-    min_seqlen = min(seqlen_list)
-    max_seqlen = max(seqlen_list)
-
-    return (num_seqs, ave_seqlen, min_seqlen, max_seqlen, total_seqlen)
+    try:
+        with open(basename + '.json', 'w') as fo:
+            json.dump({'files': [dict(report) for report in reports[:-1]],
+                       'all': dict(reports[-1])}, fo, indent=2)
+            fo.write("\n")
+    except IOError:
+        print('Cannot open', basename + '.json')
 
 
 def median(target_list):
@@ -74,48 +173,57 @@ def genome_coverage(seqlen, genome_size):
     return str(round(seqlen/genome_size, 2))
 
 
-def get_all_stats(file_extension='seq'):
+def get_all_stats(file_extension='seq', jobs=1, stats_dir='seq_num_report'):
     '''Writes out a basic statistical summary of DNA sequences and
-    prints the file to standard out.'''
+    prints the file to standard out. The files are streamed in a pool
+    of jobs worker processes and their stats merged. Also writes the
+    stats to seq_num_report.csv and seq_num_report.json in stats_dir,
+    which is created if needed, so the csv report is not taken for a
+    blastn csv file in the working directory.'''
 
-    # Put file names with extension *seq in list.
+    # Put file names with extension *seq or *seq.gz in list.
     files = [file for file in listdir('.') if
-             file.endswith(file_extension)]
+             strip_gz(file).endswith(file_extension)]
 
     if not files:
         print("No files with extension", file_extension, "found!")
+        return
+
+    if jobs > 1:
+        with stage('fasta stats pool') as st, \
+                ProcessPoolExecutor(max_workers=jobs) as pool:
+            stats_list = [worker_result(output) for output in
+                          pool.map(worker(get_file_stats), files)]
+            st.add(sum(stats['num_seqs'] for stats in stats_list))
+    else:
+        stats_list = [get_file_stats(file) for file in files]
+    all_stats = merge_stats(stats_list)
 
     # Get the basic seq stats and print to file
     with open('seq_num_report.txt', 'w') as fo:
 
-        seqnum_list = []
-        minseqlen_list = []
-        maxseqlen_list = []
-        seqlen_list = []
+        seqnum_list = [stats['num_seqs'] for stats in stats_list]
 
         # Write out intial header line
         fo.write("file_name     num     ave  min  max\n")
 
         # Process each seqfile and write out stats
-        for file in files:
-            # Get data for each file from 3-element tuple
-            seq_data = get_seqfile_info(file)
+        for stats in stats_list:
+            ave_seqlen = (stats['total_seqlen'] // stats['num_seqs']
+                          if stats['num_seqs'] else 0)
 
             # Add commas and write out str data for each file
-            num_str = comma(seq_data[0])
-            aveseqlen_str = comma(seq_data[1])
-            minlen_str = str(seq_data[2])
-            maxlen_str = comma(seq_data[3])
-            fo.write(file + "   " + num_str + "  " + aveseqlen_str +
-                     "  " + minlen_str + "  " + maxlen_str + "\n")
-
-            # Generate lists for summary of all files
-            seqnum_list.append(seq_data[0])
-            minseqlen_list.append(seq_data[2])
-            maxseqlen_list.append(seq_data[3])
-            seqlen_list.append(seq_data[4])
-
-        overall_seqlen_mean = sum(seqlen_list) // sum(seqnum_list)
+            num_str = comma(stats['num_seqs'])
+            aveseqlen_str = comma(ave_seqlen)
+            minlen_str = str(stats['min_seqlen'])
+            maxlen_str = comma(stats['max_seqlen'])
+            fo.write(stats['file_name'] + "   " + num_str + "  " +
+                     aveseqlen_str + "  " + minlen_str + "  " +
+                     maxlen_str + "\n")
+
+        overall_seqlen_mean = (all_stats['total_seqlen'] //
+                               all_stats['num_seqs']
+                               if all_stats['num_seqs'] else 0)
 
         # Write out summary of all seq files
         fo.write("======================================\n")
@@ -127,12 +235,17 @@ def get_all_stats(file_extension='seq'):
                  comma(sum(seqnum_list)//len(seqnum_list)) + " seqs\n")
         fo.write("Median file size: " + comma(median(seqnum_list)) +
                  " seqs\n")
-        fo.write("Total seqs: " + comma(sum(seqnum_list)) + "\n")
-        fo.write("Min seqlen: " + str(min(minseqlen_list)) + "\n")
-        fo.write("Max seqlen: " + comma(max(maxseqlen_list)) + "\n")
+        fo.write("Total seqs: " + comma(all_stats['num_seqs']) + "\n")
+        fo.write("Min seqlen: " + str(all_stats['min_seqlen']) + "\n")
+        fo.write("Max seqlen: " + comma(all_stats['max_seqlen']) + "\n")
         fo.write("Mean seqlen: " + comma(overall_seqlen_mean) + "\n")
         fo.write("Genome coverage: " +
-                 genome_coverage(sum(seqlen_list), 3000000000) + "\n")
+                 genome_coverage(all_stats['total_seqlen'],
+                                 3000000000) + "\n")
+
+    os.makedirs(stats_dir, exist_ok=True)
+    write_stats_reports(stats_list, all_stats,
+                        os.path.join(stats_dir, 'seq_num_report'))
 
     # Print the output file to screen
     with open('seq_num_report.txt', 'r') as fi:
@@ -140,5 +253,28 @@ def get_all_stats(file_extension='seq'):
             print(line)
 
 
+def add_arguments(parser):
+    '''Adds the command line options of get_all_stats to an argparse
+    parser.'''
+    parser.add_argument('--ext', default='seq',
+                        help='extension of the fasta files (default seq)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('--stats-dir', default='seq_num_report',
+                        help='dir for the seq_num_report.csv and .json '
+                             'files (default seq_num_report)')
+    add_report_arguments(parser)
+
+
+def main(args):
+    '''Runs get_all_stats with add_arguments args.'''
+    start_from_args('seqfile_stats', args)
+    get_all_stats(args.ext, args.jobs, args.stats_dir)
+    finish_from_args(args)
+
+
 if __name__ == '__main__':
-    get_all_stats()
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3.5
+
+'''Generates a synthetic chimp trace read data set for benchmarking
+the pipeline without the trace archive or a human genome blast db.
+For each seqfile it writes, in one dir:
+
+pan_NNN_25000_seqs.fa     trace reads of about 650 bases
+pan_NNN_25k_on_homo.csv   blastn outfmt 10 hits on homo for most reads
+xml_pan_NNN               trace info xml with a RUN_DATE per read
+nh/pan_NNN_nh_on_chimp.csv  hits on chimp for some of the non-hitters
+
+The read lengths, hit rate and pident distribution (mostly close to
+100% with a long tail down to 60%) are roughly those of the real
+data. The output depends only on the seed and the seqfile number, so
+a larger data set contains the smaller ones.'''
+
+import argparse
+import os
+import random
+
+from fasta_io import BUFSIZE
+from fasta_io import format_fasta
+
+
+__author__ = "Jeffrey P Tomkins, PhD"
+__copyright__ = "Copyright 2016, Institute for Creation Research"
+__email__ = "jtomkins@icr.org"
+
+
+# Bases each seqfile's reads are cut from
+POOL_SIZE = 1 << 20
+
+# Read length distribution, clipped to MIN_LEN..MAX_LEN
+MEAN_LEN = 650
+SD_LEN = 180
+MIN_LEN = 100
+MAX_LEN = 1100
+
+# Fraction of reads with a hit on homo, and of the non-hitters with a
+# hit on chimp
+HIT_FRAC = 0.8
+NH_HIT_FRAC = 0.4
+
+# Fraction of hits with a near full ident, the rest are spread down to
+# MIN_PIDENT, and of the near full ident hits that are exact, pident
+# 100.0
+HI_FRAC = 0.85
+MIN_PIDENT = 60.0
+EXACT_FRAC = 0.2
+
+
+def get_filenames(out_dir, seqfile_num):
+    '''Returns the (fasta, blastn csv, xml, non-hitter csv) file names
+    of a seqfile.'''
+    name = 'pan_{:03d}'.format(seqfile_num)
+    return (os.path.join(out_dir, name + '_25000_seqs.fa'),
+            os.path.join(out_dir, name + '_25k_on_homo.csv'),
+            os.path.join(out_dir, 'xml_' + name),
+            os.path.join(out_dir, 'nh', name + '_nh_on_chimp.csv'))
+
+
+def read_length(rng):
+    '''Returns a random trace read length.'''
+    return min(MAX_LEN, max(MIN_LEN, int(rng.gauss(MEAN_LEN, SD_LEN))))
+
+
+def pident_value(rng, hi_frac=HI_FRAC):
+    '''Returns a random blastn pident.'''
+    if rng.random() < hi_frac:
+        if rng.random() < EXACT_FRAC:
+            return 100.0
+        pident = 100.0 - rng.gammavariate(1.2, 0.8)
+    else:
+        pident = rng.uniform(MIN_PIDENT, 97.0)
+    return round(max(MIN_PIDENT, pident), 3)
+
+
+def hit_row(rng, qseqid, qlen, pident):
+    '''Returns an outfmt 10 line (qseqid qstart qend mismatch gapopen
+    pident nident length qlen) for a hit of a read.'''
+    length = qlen - rng.randint(0, qlen // 5)
+    qstart = rng.randint(1, qlen - length + 1)
+    nident = int(round(length * pident / 100))
+    gapopen = min(length - nident, int(rng.expovariate(1.0) *
+                                       (100.0 - pident) / 4))
+    mismatch = length - nident - gapopen
+    return "{},{},{},{},{},{:.3f},{},{},{}\n".format(
+        qseqid, qstart, qstart + length - 1, mismatch, gapopen, pident,
+        nident, length, qlen)
+
+
+def run_years(seqfile_num):
+    '''Returns the range of run years of a seqfile, or None for the
+    one in ten seqfiles with no run dates.'''
+    if seqfile_num % 10 == 0:
+        return None
+    first = 1999 + seqfile_num % 6
+    return first, first + seqfile_num % 3
+
+
+def write_seqfile(out_dir, seqfile_num, num_seqs=25000, seed=1):
+    '''Writes the fasta, blastn csv, xml and non-hitter csv files of
+    one seqfile. Returns (num seqs, num hits).'''
+    rng = random.Random(seed * 1000003 + seqfile_num)
+    pool = ''.join(rng.choice('ACGT') for _ in range(POOL_SIZE))
+    pool += pool[:MAX_LEN]
+    years = run_years(seqfile_num)
+    fasta_file, csv_file, xml_file, nh_file = get_filenames(out_dir,
+                                                            seqfile_num)
+
+    num_hits = 0
+    with open(fasta_file, 'w', buffering=BUFSIZE) as fa, \
+            open(csv_file, 'w', buffering=BUFSIZE) as csv, \
+            open(xml_file, 'w', buffering=BUFSIZE) as xml, \
+            open(nh_file, 'w', buffering=BUFSIZE) as nh:
+        xml.write('<?xml version="1.0"?>\n<trace_volume>\n')
+        for i in range(num_seqs):
+            ti = seqfile_num * 10000000 + i
+            qseqid = 'gnl|ti|' + str(ti)
+            qlen = read_length(rng)
+            start = rng.randrange(POOL_SIZE)
+            fa.write(format_fasta(qseqid + ' pan_trace',
+                                  pool[start:start + qlen]))
+
+            if rng.random() < HIT_FRAC:
+                csv.write(hit_row(rng, qseqid, qlen, pident_value(rng)))
+                num_hits += 1
+            elif rng.random() < NH_HIT_FRAC:
+                nh.write(hit_row(rng, qseqid, qlen, pident_value(rng, 0.5)))
+
+            xml.write('<trace><TI>{}</TI><SPECIES_CODE>PAN TROGLODYTES'
+                      '</SPECIES_CODE>'.format(ti))
+            if years is not None:
+                xml.write('<RUN_DATE>{}-{:02d}-{:02d} 00:00:00</RUN_DATE>'
+                          .format(rng.randint(*years), rng.randint(1, 12),
+                                  rng.randint(1, 28)))
+            xml.write('</trace>\n')
+        xml.write('</trace_volume>\n')
+    return num_seqs, num_hits
+
+
+def generate(out_dir, num_seqfiles, num_seqs=25000, seed=1):
+    '''Writes the files of seqfiles 001 to num_seqfiles to out_dir and
+    returns the total (num seqs, num hits).'''
+    os.makedirs(os.path.join(out_dir, 'nh'), exist_ok=True)
+    total_seqs = 0
+    total_hits = 0
+    for seqfile_num in range(1, num_seqfiles + 1):
+        num, hits = write_seqfile(out_dir, seqfile_num, num_seqs, seed)
+        total_seqs += num
+        total_hits += hits
+    return total_seqs, total_hits
+
+
+def dir_size(directory):
+    '''Returns the total size in bytes of the files under a dir.'''
+    return sum(os.path.getsize(os.path.join(path, file))
+               for path, _, files in os.walk(directory) for file in files)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Generates a synthetic chimp trace read data set.')
+    parser.add_argument('out_dir', help='dir to write the files to')
+    parser.add_argument('num_seqfiles', type=int,
+                        help='number of seqfiles, e.g. 101')
+    parser.add_argument('--seqs', type=int, default=25000,
+                        help='reads per seqfile (default 25000)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='random seed (default 1)')
+    args = parser.parse_args()
+
+    num_seqs, num_hits = generate(args.out_dir, args.num_seqfiles,
+                                  args.seqs, args.seed)
+    print("{:,} seqfiles, {:,} reads, {:,} hits in {}".format(
+          args.num_seqfiles, num_seqs, num_hits, args.out_dir))